@@ -15,77 +15,237 @@
 #  along with this program.  If not, see <https://www.gnu.org/licenses/>.
 import asyncio
 import inspect
+import itertools
 import json
+import random
 import time
 import typing
 import warnings
+import zlib
 from typing import Set
 
 import websockets
 
+PUBSUB_URL = 'wss://pubsub-edge.twitch.tv'
+MAX_TOPICS_PER_CONNECTION = 50  # Twitch's limit
+MAX_CONNECTIONS = 10  # Twitch asks for at most 10 connections per IP
+CALLBACK_WORKERS = 4
+CALLBACK_QUEUE_SIZE = 250  # per worker
+MIN_BACKOFF = 1
+MAX_BACKOFF = 120
+
 
 class PubsubWarning(UserWarning):
     pass
 
 
+class _Connection:
+    """One websocket connection and the topics listened to on it."""
+
+    def __init__(self, client: 'PubsubClient', index: int):
+        self.client = client
+        self.index = index
+        self.topics: Set[str] = set()
+        self.task: typing.Optional[asyncio.Task] = None
+        self.connected = False
+        self.connects = 0
+
+        self._to_listen: Set[str] = set()
+        self._to_unlisten: Set[str] = set()
+        self._pending_frames: typing.Dict[str, typing.List[str]] = {}
+        self._wake = asyncio.Event()
+        self._last_pong = 0.0
+
+    def listen(self, topic: str):
+        self.topics.add(topic)
+        self._to_unlisten.discard(topic)
+        self._to_listen.add(topic)
+        self._wake.set()
+
+    def unlisten(self, topic: str):
+        self.topics.discard(topic)
+        if topic in self._to_listen:
+            self._to_listen.discard(topic)
+        else:
+            self._to_unlisten.add(topic)
+        self._wake.set()
+
+    def _frames(self) -> typing.List[dict]:
+        frames = []
+        for type_, topics in (('UNLISTEN', self._to_unlisten), ('LISTEN', self._to_listen)):
+            topics = sorted(topics)
+            for i in range(0, len(topics), self.client.max_topics):
+                nonce = f'{self.index}-{next(self.client.nonces)}'
+                chunk = topics[i:i + self.client.max_topics]
+                data = {'topics': chunk}
+                if type_ == 'LISTEN':
+                    data['auth_token'] = self.client.token
+                    self._pending_frames[nonce] = chunk
+                frames.append({'type': type_, 'nonce': nonce, 'data': data})
+        self._to_listen = set()
+        self._to_unlisten = set()
+        return frames
+
+    async def _sender(self, ws):
+        while True:
+            await self._wake.wait()
+            self._wake.clear()
+            for frame in self._frames():
+                self.client.log_function(f'> {frame}')
+                await ws.send(json.dumps(frame))
+
+    async def _pinger(self, ws):
+        while True:
+            await asyncio.sleep(self.client.ping_time + random.uniform(0, 1))
+            if self._last_pong + self.client.ping_time * 2 < time.monotonic():
+                # no PONG for two ping periods, the connection is dead
+                await ws.close()
+                return
+            await ws.send(json.dumps({'type': 'PING'}))
+
+    def _handle(self, msg: dict) -> bool:
+        """Handle a message from the server, returns False if the connection should be reestablished."""
+        if msg['type'] == 'MESSAGE':
+            topic = msg['data']['topic']
+            self.client.dispatch(topic, json.loads(msg['data']['message']))
+        elif msg['type'] == 'RESPONSE':
+            topics = self._pending_frames.pop(msg.get('nonce'), [])
+            if msg['error']:
+                warnings.warn(f'PUBSUB ERROR {msg["error"]} for topics {topics}', PubsubWarning)
+        elif msg['type'] == 'RECONNECT':
+            return False
+        elif msg['type'] != 'PONG':
+            warnings.warn(f'UNHANDLED PUBSUB MESSAGE TYPE {msg["type"]!r}, msg => {msg}', PubsubWarning)
+        return True
+
+    async def _session(self, ws):
+        self.connected = True
+        self.connects += 1
+        self.client.log_function(f'Connected to pubsub (connection {self.index}, {len(self.topics)} topics)')
+        # everything has to be listened to again on a new connection
+        self._to_listen = set(self.topics)
+        self._to_unlisten = set()
+        self._pending_frames = {}
+        self._wake.set()
+        self._last_pong = time.monotonic()
+        tasks = [asyncio.create_task(self._sender(ws)), asyncio.create_task(self._pinger(ws))]
+        try:
+            async for received in ws:
+                if 'PONG' not in received:
+                    self.client.log_function(f'< {received!r}')
+                msg = json.loads(received)
+                if msg['type'] == 'PONG':
+                    self._last_pong = time.monotonic()
+                if not self._handle(msg):
+                    return
+            for task in tasks:
+                if task.done() and not task.cancelled():
+                    task.result()  # the sender failed, raise what happened
+        finally:
+            self.connected = False
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def run(self):
+        failures = 0
+        while True:
+            started = time.monotonic()
+            try:
+                async with websockets.connect(self.client.url) as ws:
+                    await self._session(ws)
+            except Exception as e:
+                self.client.log_function(f'Pubsub connection {self.index} failed: {e!r}')
+            if time.monotonic() - started > MAX_BACKOFF:
+                failures = 0  # the connection worked for a while, this isn't a reconnect loop
+            delay = random.uniform(0, min(MAX_BACKOFF, self.client.min_backoff * 2 ** failures))
+            failures += 1
+            await asyncio.sleep(delay)
+
+
 class PubsubClient:
+    """
+    Twitch PubSub client.
+
+    Topics are spread over up to `max_connections` websockets with up to `max_topics` topics each. Listens and
+    unlistens made in the same event loop iteration are sent together, up to `max_topics` topics per frame.
+    Callbacks run in `CALLBACK_WORKERS` worker tasks, messages of the same topic are always handled by the same worker
+    and in order. If a worker falls `CALLBACK_QUEUE_SIZE` messages behind further messages for it are dropped.
+    Connections that break reconnect with jittered exponential backoff and only listen to their own topics again.
+    """
     topics: Set[str]
 
-    def __init__(self, token, ping_time=15):
+    def __init__(self, token, ping_time=15, url: str = PUBSUB_URL, max_topics: int = MAX_TOPICS_PER_CONNECTION,
+                 max_connections: int = MAX_CONNECTIONS, min_backoff: float = MIN_BACKOFF):
         self.ping_time = ping_time
-        self.open_lock = asyncio.Lock()
         self.token = token
+        self.url = url
+        self.max_topics = max_topics
+        self.max_connections = max_connections
+        self.min_backoff = min_backoff
 
         self.callbacks = {
 
         }
-        self.is_connected = False
-        self.initialized = False
-        self.socket = None
-        self.send_queue = asyncio.Queue()
+        self.connections: typing.List[_Connection] = []
         self.task = None
+        self.nonces = itertools.count()
 
         self.topics = set()
+        self._topic_connections: typing.Dict[str, _Connection] = {}
+        self._queues: typing.List[asyncio.Queue] = []
+        self._workers: typing.List[asyncio.Task] = []
+        self._changed = asyncio.Event()
+
+        self.dropped_messages = 0
+        self.rejected_topics = 0
 
         self.log_function = print
 
+    @property
+    def is_connected(self):
+        return any(i.connected for i in self.connections)
+
     async def initialize(self):
         self.task = asyncio.get_event_loop().create_task(self._run())
         return self.task
 
-    def send(self, data):
-        self.send_queue.put_nowait(data)
+    def _connection_for_new_topic(self) -> typing.Optional[_Connection]:
+        for conn in self.connections:
+            if len(conn.topics) < self.max_topics:
+                return conn
+        if len(self.connections) >= self.max_connections:
+            return None
+        conn = _Connection(self, len(self.connections))
+        self.connections.append(conn)
+        self._changed.set()
+        return conn
 
     def listen(self, topics: typing.Iterable[str]):
+        topics = list(topics)
         self.log_function('listen', topics)
         for i in topics:
             if i not in self.callbacks:
                 self.callbacks[i] = []
-        self.topics.update(topics)
-        self.send(
-            {
-                'type': 'LISTEN',
-                'nonce': '',
-                'data': {
-                    'topics': topics,
-                    'auth_token': self.token
-                }
-            }
-        )
+            if i in self._topic_connections:
+                continue
+            conn = self._connection_for_new_topic()
+            if conn is None:
+                self.rejected_topics += 1
+                warnings.warn(f'Cannot listen to {i}, all {self.max_connections} pubsub connections are full',
+                              PubsubWarning)
+                continue
+            conn.listen(i)
+            self._topic_connections[i] = conn
+            self.topics.add(i)
 
     def unlisten(self, topics):
         for topic in topics:
-            del self.callbacks[topic]
-        self.topics.difference(topics)
-        self.send(
-            {
-                'type': 'UNLISTEN',
-                'nonce': '',
-                'data': {
-                    'topics': topics
-                }
-            }
-        )
+            self.callbacks.pop(topic, None)
+            conn = self._topic_connections.pop(topic, None)
+            if conn is not None:
+                conn.unlisten(topic)
+            self.topics.discard(topic)
 
     async def stop(self):
         if self.task:
@@ -115,86 +275,49 @@ class PubsubClient:
 
         return decorator
 
-    async def _sender(self, queue, ws):
-        while 1:
-            try:
-                elem = await queue.get()
-                if not ('type' in elem and elem['type'] == 'PING'):
-                    self.log_function(f'> {elem}')
-                await ws.send(json.dumps(elem))
-            except asyncio.CancelledError:
-                break
+    def dispatch(self, topic: str, data: dict):
+        """Queue the callbacks of `topic` to be called with `data`."""
+        if not self._queues:
+            return
+        queue = self._queues[zlib.crc32(topic.encode()) % len(self._queues)]
+        try:
+            queue.put_nowait((topic, data))
+        except asyncio.QueueFull:
+            self.dropped_messages += 1
+            warnings.warn(f'Pubsub callbacks are falling behind, dropped message for {topic}', PubsubWarning)
 
-    async def _pinger(self, queue: asyncio.Queue):
-        while 1:
-            try:
-                await asyncio.sleep(self.ping_time)
-                await queue.put({
-                    'type': 'PING'
-                })
-            except asyncio.CancelledError:
-                break
+    async def _worker(self, queue: asyncio.Queue):
+        while True:
+            topic, data = await queue.get()
+            callbacks = self.callbacks.get(topic)
+            if not callbacks:
+                warnings.warn(f'UNHANDLED PUBSUB MESSAGE TOPIC {topic}', PubsubWarning)
+                continue
+            for f in list(callbacks):
+                try:
+                    if inspect.iscoroutinefunction(f):
+                        await f(topic, data)
+                    else:
+                        f(topic, data)
+                except Exception as e:
+                    self.log_function(f'Pubsub callback {f!r} for {topic} failed: {e!r}')
 
     async def _run(self):
-        is_reconnect = False
-        while 1:
-            last_pong = time.time() + 20
-            try:
-                async with websockets.connect('wss://pubsub-edge.twitch.tv') as ws:
-                    self.log_function('Connected to pubsub')
-                    sender_task = asyncio.create_task(self._sender(self.send_queue, ws))
-                    pinger_task = asyncio.create_task(self._pinger(self.send_queue))
-                    if is_reconnect:
-                        topics = self.topics.copy()
-                        self.listen(list(topics))
-                    is_reconnect = True
-                    try:
-                        while 1:
-                            try:
-                                recved_msg = await asyncio.wait_for(ws.recv(), timeout=5)
-                            except asyncio.TimeoutError:
-                                # haven't received anything for 5 seconds, check if a PONG should have came in.
-                                if last_pong + self.ping_time * 2 < time.time():
-                                    # no pong in last 30 seconds, this means either we aren't sending PINGs
-                                    # or the connection is dead, reconnect
-                                    break
-                                continue
-
-                            if 'PONG' not in recved_msg:
-                                self.log_function(f'< {recved_msg!r}')
-                            msg = json.loads(recved_msg)
-                            if msg['type'] == 'MESSAGE':
-                                topic = msg['data']['topic']
-                                data = json.loads(msg['data']['message'])
-
-                                for f in self.callbacks[topic]:
-                                    if inspect.iscoroutinefunction(f):
-                                        await f(topic, data)
-                                    else:
-                                        f(topic, data)
-                                if not self.callbacks[topic]:
-                                    warnings.warn(f'UNHANDLED PUBSUB MESSAGE TOPIC {topic}', PubsubWarning)
-                            elif msg['type'] == 'RESPONSE':
-                                if msg['error']:
-                                    warnings.warn(f'PUBSUB ERROR {msg["error"]}', PubsubWarning)
-                            elif msg['type'] == 'PONG':
-                                if last_pong + self.ping_time * 2 < time.time():
-                                    # print('reconnect')
-                                    break  # late pong, possible connections issues, better to just reconnect.
-                                last_pong = time.time()
-                                # print('cancel reconnect')
-                            elif msg['type'] == 'RECONNECT':
-                                break
-                            else:
-                                warnings.warn(f'UNHANDLED PUBSUB MESSAGE TYPE {msg["type"]!r}, msg => {msg}',
-                                              PubsubWarning)
-                    except (websockets.InvalidMessage, websockets.ConnectionClosedError):
-                        pass
-                    sender_task.cancel()
-                    await sender_task
-                    pinger_task.cancel()
-                    await pinger_task
-                    await ws.close()
-            except ConnectionAbortedError as e:
-                warnings.warn(f'PUBSUB SSL SHIT AGAIN {e}', PubsubWarning)
-                await asyncio.sleep(5)
+        self._queues = [asyncio.Queue(CALLBACK_QUEUE_SIZE) for _ in range(CALLBACK_WORKERS)]
+        self._workers = [asyncio.create_task(self._worker(i)) for i in self._queues]
+        try:
+            while True:
+                self._changed.clear()
+                for conn in self.connections:
+                    if conn.task is None or conn.task.done():
+                        conn.task = asyncio.create_task(conn.run())
+                await self._changed.wait()
+        finally:
+            tasks = self._workers + [i.task for i in self.connections if i.task is not None]
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            for conn in self.connections:
+                conn.task = None
+            self._queues = []
+            self._workers = []
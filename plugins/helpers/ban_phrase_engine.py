@@ -0,0 +1,196 @@
+#  This is a simple utility bot
+#  Copyright (C) 2020 Mm2PL
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import collections
+import typing
+
+import regex as re
+
+# Below this many literal triggers plain `in` checks are faster than walking the automaton in Python.
+AUTOMATON_MIN_WORDS = 16
+
+# Patterns that use backreferences, named groups or inline flags cannot be safely embedded in a bigger pattern,
+# they are checked separately.
+UNSAFE_TO_COMBINE = re.compile(r'\(\?(?![:=!]|<[=!])|\\[0-9gL]')
+
+INPUT = 'input'
+OUTPUT = 'output'
+
+
+class AhoCorasick:
+    """Multi-pattern substring matcher. :py:meth:`search` returns indexes of all words found in the text."""
+
+    def __init__(self, words: typing.Iterable[str]):
+        self._goto: typing.List[typing.Dict[str, int]] = [{}]
+        self._fail: typing.List[int] = [0]
+        self._out: typing.List[typing.Tuple[int, ...]] = [()]
+        for num, word in enumerate(words):
+            state = 0
+            for ch in word:
+                next_state = self._goto[state].get(ch)
+                if next_state is None:
+                    next_state = len(self._goto)
+                    self._goto[state][ch] = next_state
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._out.append(())
+                state = next_state
+            self._out[state] += (num,)
+
+        queue = collections.deque(self._goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for ch, next_state in self._goto[state].items():
+                queue.append(next_state)
+                fail = self._fail[state]
+                while fail and ch not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[next_state] = self._goto[fail].get(ch, 0)
+                self._out[next_state] += self._out[self._fail[next_state]]
+
+    def search(self, text: str) -> typing.Set[int]:
+        goto = self._goto
+        fail = self._fail
+        out = self._out
+        found = set(out[0])
+        state = 0
+        for ch in text:
+            while state and ch not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(ch, 0)
+            if out[state]:
+                found.update(out[state])
+        return found
+
+
+class PhraseSet:
+    """
+    Ban phrases applying to one channel in one direction, in the order they should be checked.
+
+    :py:meth:`hits` tells which of `phrases` would return a truthy value from `BanPhrase.check()`, using a single
+    pass over the text for literal triggers and a single regex call for most regex triggers.
+    """
+
+    def __init__(self, phrases: list):
+        self.phrases = phrases
+        self._literals: typing.List[typing.Tuple[int, str]] = []
+        self._separate_patterns: typing.List[typing.Tuple[int, typing.Any]] = []
+        self._combined = None
+        self._prefilter = None
+        self._combined_groups: typing.Dict[str, int] = {}
+
+        combinable = []
+        for num, phrase in enumerate(phrases):
+            if phrase.bad:
+                continue
+            if phrase.trigger_is_regex:
+                phrase._ensure_pattern_compiled()
+                if phrase.bad:
+                    continue
+                if phrase.pattern.groupindex or UNSAFE_TO_COMBINE.search(phrase.pattern.pattern):
+                    self._separate_patterns.append((num, phrase.pattern))
+                else:
+                    combinable.append((num, phrase.pattern))
+            else:
+                self._literals.append((num, phrase.trigger))
+
+        self._automaton = None
+        if len(self._literals) >= AUTOMATON_MIN_WORDS:
+            self._automaton = AhoCorasick(word for _, word in self._literals)
+
+        if len(combinable) == 1:
+            self._separate_patterns.extend(combinable)
+        elif combinable:
+            # An alternation only reports one pattern per match position, overlapping triggers would shadow each
+            # other. Optional lookaheads, each capturing into its own group, report every pattern that matches.
+            # The plain alternation is still used to quickly reject messages that don't match anything.
+            source = ''.join(f'(?:(?=[\\s\\S]*?(?P<p{num}>{pattern.pattern})))?' for num, pattern in combinable)
+            try:
+                self._prefilter = re.compile('|'.join(f'(?:{pattern.pattern})' for _, pattern in combinable))
+                self._combined = re.compile(source)
+                self._combined_groups = {f'p{num}': num for num, _ in combinable}
+            except Exception:
+                self._prefilter = self._combined = None
+                self._separate_patterns.extend(combinable)
+            self._separate_patterns.sort()
+
+    def hits(self, text: str) -> typing.Set[int]:
+        found = set()
+        if self._automaton is not None:
+            found.update(self._literals[i][0] for i in self._automaton.search(text))
+        else:
+            found.update(num for num, word in self._literals if word in text)
+
+        if self._combined is not None and self._prefilter.search(text) is not None:
+            for name, value in self._combined.match(text).groupdict().items():
+                if value is not None:
+                    found.add(self._combined_groups[name])
+        for num, pattern in self._separate_patterns:
+            if pattern.search(text) is not None:
+                found.add(num)
+        return found
+
+    def __len__(self):
+        return len(self.phrases)
+
+
+EMPTY_SET = PhraseSet([])
+
+
+class BanPhraseEngine:
+    """
+    Precompiled ban phrases grouped by channel.
+
+    Global phrases are merged into every channel's sets so that a message only has to be checked against one
+    :py:class:`PhraseSet`. Sets are recompiled only for channels whose phrases changed.
+    """
+
+    def __init__(self):
+        self._sets: typing.Dict[typing.Tuple[typing.Optional[str], str], PhraseSet] = {}
+        self._signatures: typing.Dict[typing.Tuple[typing.Optional[str], str], tuple] = {}
+
+    @staticmethod
+    def _signature(phrases: list) -> tuple:
+        return tuple((p.id, p.type, p.trigger, p.trigger_is_regex, p.extra_data) for p in phrases)
+
+    def update(self, phrases: typing.List[typing.Tuple[typing.Optional[str], typing.Any]]):
+        """
+        Replace the phrases known to the engine.
+
+        :param phrases: List of (channel name, BanPhrase) pairs, in checking order. Channel name is None for global
+        phrases.
+        """
+        channels = {channel for channel, _ in phrases if channel is not None}
+        new_sets = {}
+        new_signatures = {}
+        for direction in (INPUT, OUTPUT):
+            for channel in (None, *channels):
+                key = (channel, direction)
+                selected = [p for c, p in phrases
+                            if (c is None or c == channel) and getattr(p, direction)]
+                signature = self._signature(selected)
+                if self._signatures.get(key) == signature:
+                    new_sets[key] = self._sets[key]
+                else:
+                    new_sets[key] = PhraseSet(selected)
+                new_signatures[key] = signature
+        self._sets = new_sets
+        self._signatures = new_signatures
+
+    def get(self, channel: str, direction: str) -> PhraseSet:
+        phrase_set = self._sets.get((channel, direction))
+        if phrase_set is None:
+            return self._sets.get((None, direction), EMPTY_SET)
+        return phrase_set
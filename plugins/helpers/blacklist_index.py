@@ -0,0 +1,106 @@
+#  This is a simple utility bot
+#  Copyright (C) 2019 Mm2PL
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import datetime
+import heapq
+import itertools
+import queue
+import typing
+
+import twitchirc
+
+
+class BlacklistIndex:
+    """
+    Blacklist entries indexed by (channel, user, command).
+
+    Entries that apply to all channels, users or commands are stored with None in that position of the key, so
+    checking a command is at most eight dict lookups. Entries with an expiration date are also kept in a min-heap,
+    only the top of the heap has to be looked at to know if anything expired. Expired entries are removed from
+    `blacklists` and put in `expire_queue` to be deleted from the database.
+    """
+
+    def __init__(self, blacklists: typing.List['BlacklistEntry'], expire_queue: queue.Queue):
+        self.blacklists = blacklists
+        self.expire_queue = expire_queue
+        self._entries: typing.Dict[typing.Tuple[typing.Optional[str], typing.Optional[str], typing.Optional[str]],
+                                   typing.List['BlacklistEntry']] = {}
+        self._keys: typing.Dict[int, tuple] = {}
+        self._expiry_heap: typing.List[typing.Tuple[datetime.datetime, int, 'BlacklistEntry']] = []
+        self._counter = itertools.count()
+
+    @staticmethod
+    def _normalize_command(command: str) -> str:
+        return command.lower().rstrip(' ')
+
+    def _key(self, entry: 'BlacklistEntry'):
+        return (
+            entry.channel.last_known_username.lower() if entry.channel is not None else None,
+            entry.target.last_known_username.lower() if entry.target is not None else None,
+            self._normalize_command(entry.command) if entry.command is not None else None
+        )
+
+    def add(self, entry: 'BlacklistEntry'):
+        if entry.is_active is False or id(entry) in self._keys:
+            return
+        key = self._key(entry)
+        self._keys[id(entry)] = key
+        self._entries.setdefault(key, []).append(entry)
+        if entry.expires_on is not None:
+            heapq.heappush(self._expiry_heap, (entry.expires_on, next(self._counter), entry))
+
+    def remove(self, entry: 'BlacklistEntry'):
+        key = self._keys.pop(id(entry), None)
+        if key is None:
+            return
+        bucket = self._entries[key]
+        bucket.remove(entry)
+        if not bucket:
+            del self._entries[key]
+
+    def rebuild(self, entries: typing.Iterable['BlacklistEntry']):
+        self._entries.clear()
+        self._keys.clear()
+        self._expiry_heap.clear()
+        for entry in entries:
+            self.add(entry)
+
+    def expire(self, now: typing.Optional[datetime.datetime] = None):
+        if now is None:
+            now = datetime.datetime.now()
+        while self._expiry_heap and self._expiry_heap[0][0] <= now:
+            _, _, entry = heapq.heappop(self._expiry_heap)
+            if id(entry) not in self._keys:
+                continue  # removed by a reload
+            self.remove(entry)
+            if entry in self.blacklists:
+                self.blacklists.remove(entry)
+            self.expire_queue.put(entry)
+
+    def find(self, message: twitchirc.ChannelMessage,
+             command: twitchirc.Command) -> typing.Optional['BlacklistEntry']:
+        """Find an entry that blocks `command` from being used by the author of `message`."""
+        if self._expiry_heap:
+            self.expire()
+        if not self._entries:
+            return None
+        channel = message.channel.lower()
+        user = message.user.lower()
+        command_name = self._normalize_command(command.chat_command)
+        for key in itertools.product((channel, None), (user, None), (command_name, None)):
+            bucket = self._entries.get(key)
+            if bucket:
+                return bucket[0]
+        return None
@@ -19,10 +19,15 @@ import typing
 import math
 import io
 
+import numpy
 from PIL import Image, ImageOps, ImageFilter
-import requests
 
-C_SIZE = 2048
+try:
+    from . import image_download
+    from .render_cache import RenderCache
+except ImportError:  # running as a script
+    import image_download
+    from render_cache import RenderCache
 
 SIZE_LIMIT = 10_000_000
 POSITIONS = [
@@ -35,23 +40,12 @@ POSITIONS = [
     0x40,
     0x80
 ]
+# POSITIONS laid out like the pixels in a 2x4 block
+WEIGHTS = numpy.array(POSITIONS, dtype='<u4').reshape(4, 2)
 
 
-async def download_image(url: str) -> Image.Image:
-    r = requests.get(url, stream=True)
-
-    if r.headers.get('Content-Length') and int(r.headers.get('Content-Length')) > SIZE_LIMIT:  # 10M
-        raise ValueError('Response is over the size limit.')
-    img_data = io.BytesIO()
-    num = 0
-    for c in r.iter_content(C_SIZE):
-        num += 1
-        img_data.write(c)
-        if C_SIZE * num > SIZE_LIMIT:
-            raise ValueError('Response is over the size limit.')
-
-    img = Image.open(img_data)
-    return img
+async def download_image(url: str, cache: bool = False) -> Image.Image:
+    return Image.open(io.BytesIO(await image_download.fetch_bytes(url, SIZE_LIMIT, cache=cache)))
 
 
 async def to_braille_from_url(image_url: str, reverse: bool = False, size_percent: typing.Optional[float] = None,
@@ -60,7 +54,7 @@ async def to_braille_from_url(image_url: str, reverse: bool = False, size_percen
                               enable_padding=True, pad_size=(60, 60)):
     if size_percent is None and max_x is None and max_y is None:
         raise RuntimeError('You have to specify either size_percent, max_x or max_y for to_braille to work.')
-    img = download_image(image_url)
+    img = await download_image(image_url)
     return await to_braille_from_image(img, reverse=reverse, size_percent=size_percent, max_x=max_x, max_y=max_y,
                                        sensitivity=sensitivity, enable_padding=enable_padding, pad_size=pad_size)
 
@@ -69,65 +63,54 @@ async def to_braille_from_image(img: Image, reverse: bool = False, size_percent:
                                 max_x: typing.Optional[int] = None, max_y: typing.Optional[int] = None,
                                 sensitivity: typing.Tuple[float, float, float, float] = (0.5, 0.5, 0.5, 0.5),
                                 enable_padding=True, pad_size=(60, 60), enable_processing=True):
-    """this function should be run in a separate thread not to take a long time."""
+    await asyncio.sleep(0)
+    return image_to_braille(img, reverse, size_percent, max_x, max_y, sensitivity, enable_padding, pad_size,
+                            enable_processing)
+
+
+def image_to_braille(img: Image, reverse: bool = False, size_percent: typing.Optional[float] = None,
+                     max_x: typing.Optional[int] = None, max_y: typing.Optional[int] = None,
+                     sensitivity: typing.Tuple[float, float, float, float] = (0.5, 0.5, 0.5, 0.5),
+                     enable_padding=True, pad_size=(60, 60), enable_processing=True) -> str:
+    """Synchronous version of :py:func:`to_braille_from_image`."""
     if size_percent is None and max_x is None and max_y is None:
         raise RuntimeError('You have to specify either size_percent, max_x or max_y for to_braille to work.')
     output: str = ''
     img = img.convert('RGBA')
     if enable_processing:
-        img, output = await crop_and_pad_image(enable_padding, img, max_x, max_y, output, pad_size, size_percent)
+        img, output = crop_and_pad(enable_padding, img, max_x, max_y, output, pad_size, size_percent)
 
-    real_y = 0
+    return output + _braille_from_array(numpy.asarray(img), reverse, sensitivity)
 
-    def _get_pixel(coords):
-        if coords[0] >= img.width or coords[1] >= img.height:
-            return 0, 0
-        else:
-            data = img.getpixel(coords)
-            return data
-
-    for _ in range(math.floor(img.height / 4)):  # iterate through every fourth line. ⣿
-        real_x = 0
-        if real_x % 10 == 0:
-            await asyncio.sleep(0)
-        for _ in range(math.floor(img.width / 2)):  # iterate through ever second pixel.
-            # dank memory saving trick.
-            # collect the pixels into a small array.
-            p = [
-                _get_pixel((real_x, real_y)),
-                _get_pixel((real_x + 1, real_y)),
-
-                _get_pixel((real_x, real_y + 1)),
-                _get_pixel((real_x + 1, real_y + 1)),
-
-                _get_pixel((real_x, real_y + 2)),
-                _get_pixel((real_x + 1, real_y + 2)),
-
-                _get_pixel((real_x, real_y + 3)),
-                _get_pixel((real_x + 1, real_y + 3))
-            ]
-
-            character = 0x2800  # static Braille offset.
-
-            for table_offset, pixel in enumerate(p):
-                color_binary = []
-                for color_num, color in enumerate(pixel):
-                    color_binary.append(color > (255 / sensitivity[color_num]))
-                binary = any(color_binary)
-                del color_binary
-
-                if reverse and not binary or (not reverse and binary):
-                    character += POSITIONS[table_offset]
-            output += chr(character)
-            real_x += 2
-        real_y += 4
-        output += '\n'
-    return output
+
+def _braille_from_array(pixels: numpy.ndarray, reverse: bool,
+                        sensitivity: typing.Tuple[float, float, float, float]) -> str:
+    """
+    Convert a (height, width, 4) RGBA array to braille, one character per 2x4 block of pixels.
+
+    A dot is set if any channel is brighter than `255 / sensitivity` for that channel. Pixels that don't fill a
+    whole block at the right and bottom edges are ignored.
+    """
+    rows = pixels.shape[0] // 4
+    cols = pixels.shape[1] // 2
+    thresholds = numpy.array([255 / sensitivity[i] for i in range(4)])
+    mask = (pixels[:rows * 4, :cols * 2] > thresholds).any(axis=2)
+    if reverse:
+        mask = ~mask
+    blocks = mask.reshape(rows, 4, cols, 2).swapaxes(1, 2)  # (rows, cols, 4, 2)
+    codepoints = numpy.empty((rows, cols + 1), dtype='<u4')
+    codepoints[:, :cols] = numpy.tensordot(blocks, WEIGHTS, axes=2) + 0x2800
+    codepoints[:, cols] = ord('\n')
+    return codepoints.tobytes().decode('utf-32-le')
 
 
 async def crop_and_pad_image(enable_padding, img, max_x, max_y, output, pad_size, size_percent):
-    org_size = (img.width, img.height)
     await asyncio.sleep(0)
+    return crop_and_pad(enable_padding, img, max_x, max_y, output, pad_size, size_percent)
+
+
+def crop_and_pad(enable_padding, img, max_x, max_y, output, pad_size, size_percent):
+    org_size = (img.width, img.height)
     if size_percent is None:
         img.thumbnail((max_x, max_y))
     else:
@@ -136,7 +119,6 @@ async def crop_and_pad_image(enable_padding, img, max_x, max_y, output, pad_size
             img = img.resize((round(new_size[0]), round(new_size[1])))
         else:
             img.thumbnail(new_size)
-    await asyncio.sleep(0)
     percent_area = ((img.width * img.height)
                     / (org_size[0] * org_size[1])
                     * 100)
@@ -152,13 +134,30 @@ async def crop_and_pad_image(enable_padding, img, max_x, max_y, output, pad_size
         output += (f'Converted image to {img.width}X{img.height} or {percent_area:.2f}% area, '
                    f'{percent_x:.2f}% of X, {percent_y:.2f}% of Y of the original size. Added padding of '
                    f'{"x".join([str(i) for i in expand_size])} pixels\n')
-        await asyncio.sleep(0)
     else:
         output += (f'Converted image to {img.width}X{img.height} or {percent_area:.2f}% area, '
                    f'{percent_x:.2f}% of X, {percent_y:.2f}% of Y of the original size.\n')
     return img, output
 
 
+def render_frame(img: Image.Image, reverse: bool, max_x: typing.Optional[int], max_y: typing.Optional[int],
+                 sensitivity: typing.Tuple[float, float, float, float], size_percent: typing.Optional[float],
+                 resize: bool, sobel: bool) -> str:
+    """
+    Convert a single image or GIF frame the way the braillefy command does. This is a plain function taking
+    picklable arguments, so it can be run in a process pool.
+    """
+    if resize:
+        img, output = crop_and_pad(False, img, max_x, max_y, '', (60, 60), size_percent)
+    else:
+        output = ''
+    if sobel:
+        img = img.filter(ImageFilter.FIND_EDGES)
+    return output + image_to_braille(img, reverse=reverse, size_percent=size_percent, max_x=max_x, max_y=max_y,
+                                     sensitivity=sensitivity, enable_padding=False, pad_size=(60, 60),
+                                     enable_processing=False)
+
+
 class _Args:
     source_url: str
     source_file_path: str
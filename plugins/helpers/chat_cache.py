@@ -0,0 +1,239 @@
+#  This is a simple utility bot
+#  Copyright (C) 2019 Mm2PL
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import collections
+import sys
+import typing
+import uuid
+from typing import Dict
+
+import twitchirc
+
+from util_bot.msg import StandardizedMessage
+from util_bot.platform import Platform
+
+
+# Badges are stored as bits in an int, positions are assigned in the order badges are first seen.
+_badge_bits: Dict[str, int] = {}
+_badge_names: typing.List[str] = []
+
+
+def _encode_badges(badges) -> int:
+    if not badges:
+        return 0
+    if isinstance(badges, str):
+        badges = badges.split(',')
+    bitset = 0
+    for badge in badges:
+        bit = _badge_bits.get(badge)
+        if bit is None:
+            bit = len(_badge_names)
+            _badge_bits[badge] = bit
+            _badge_names.append(sys.intern(badge))
+        bitset |= 1 << bit
+    return bitset
+
+
+def _decode_badges(bitset: int) -> str:
+    return ','.join(name for bit, name in enumerate(_badge_names) if bitset >> bit & 1)
+
+
+def _compact_id(value):
+    if value is None:
+        return None
+    if value.isdigit():
+        return int(value)
+    return sys.intern(value)
+
+
+class CachedMessage:
+    """
+    Compact copy of a chat message kept in the cache.
+
+    Only the text, interned user and channel names and a few decoded flags are kept, the full flags dict of the
+    original message is dropped. Use :py:meth:`materialize` to get a :py:class:`StandardizedMessage` back.
+    """
+    __slots__ = ('text', 'user', 'channel', 'platform', 'channel_id', 'user_id', 'msg_id', 'badges',
+                 'display_name')
+
+    def __init__(self, message: twitchirc.ChannelMessage):
+        flags = message.flags
+        self.text: str = message.text
+        self.user: str = sys.intern(message.user)
+        self.channel: str = sys.intern(message.channel)
+        self.platform = getattr(message, 'platform', Platform.TWITCH)
+        self.channel_id = _compact_id(flags.get('room-id'))
+        self.user_id = _compact_id(flags.get('user-id'))
+        self.badges = _encode_badges(flags.get('badges'))
+
+        msg_id = flags.get('id')
+        try:
+            self.msg_id = uuid.UUID(msg_id).int if msg_id else None
+        except ValueError:
+            self.msg_id = msg_id
+
+        display_name = flags.get('display-name')
+        self.display_name = sys.intern(display_name) if display_name else None
+
+    def materialize(self, timestamp: typing.Optional[float] = None, parent=None) -> StandardizedMessage:
+        msg = StandardizedMessage(self.text, self.user, self.channel, self.platform, parent=parent)
+        flags = msg.flags
+        flags['badges'] = _decode_badges(self.badges)
+        if self.channel_id is not None:
+            flags['room-id'] = str(self.channel_id)
+        if self.user_id is not None:
+            flags['user-id'] = str(self.user_id)
+        if self.msg_id is not None:
+            flags['id'] = str(uuid.UUID(int=self.msg_id)) if isinstance(self.msg_id, int) else self.msg_id
+        flags['display-name'] = self.display_name or self.user
+        if timestamp is not None:
+            flags['tmi-sent-ts'] = str(round(timestamp * 1000))
+        return msg
+
+    def estimate_size(self) -> int:
+        # interned names, badge names and the platform are shared between messages
+        total = sys.getsizeof(self) + sys.getsizeof(self.text)
+        for value in (self.channel_id, self.user_id, self.msg_id, self.badges):
+            if value is not None:
+                total += sys.getsizeof(value)
+        return total
+
+
+class ChannelCache:
+    """
+    Fixed-capacity ring buffer of messages sent in one channel.
+
+    Messages are stored as :py:class:`CachedMessage` records and are addressed by a monotonically increasing
+    sequence number, the slot used is the sequence number modulo capacity. Adding a message to a full buffer evicts
+    the oldest one in O(1). A per-user index holds the sequence numbers of every user's messages, another one maps
+    message ids to sequence numbers and timestamps can be bisected as long as they were added in order.
+    """
+
+    def __init__(self, capacity: int, parent=None):
+        self.capacity = capacity
+        self.parent = parent
+        self._messages: typing.List[typing.Optional[CachedMessage]] = [None] * capacity
+        self._timestamps: typing.List[float] = [0.0] * capacity
+        self._start = 0  # sequence number of the oldest message
+        self._end = 0  # sequence number of the next message
+        self._by_user: Dict[str, typing.Deque[int]] = {}
+        self._by_id: Dict[typing.Union[int, str], int] = {}
+
+        # sequence number of the last message with a timestamp older than the message before it, bisecting is
+        # only possible when it's no longer in the buffer.
+        self._last_unordered = -1
+
+    def __len__(self):
+        return self._end - self._start
+
+    def __iter__(self) -> typing.Iterator[typing.Tuple[StandardizedMessage, float]]:
+        for msg, t in self.records():
+            yield msg.materialize(t, self.parent), t
+
+    def records(self) -> typing.Iterator[typing.Tuple[CachedMessage, float]]:
+        for seq in range(self._start, self._end):
+            yield self._messages[seq % self.capacity], self._timestamps[seq % self.capacity]
+
+    def append(self, message: twitchirc.ChannelMessage, timestamp: float):
+        message = CachedMessage(message)
+        if self._end - self._start == self.capacity:
+            self._evict()
+        if self._end > self._start and timestamp < self._timestamps[(self._end - 1) % self.capacity]:
+            self._last_unordered = self._end
+        slot = self._end % self.capacity
+        self._messages[slot] = message
+        self._timestamps[slot] = timestamp
+        if message.user not in self._by_user:
+            self._by_user[message.user] = collections.deque()
+        self._by_user[message.user].append(self._end)
+        if message.msg_id is not None:
+            self._by_id[message.msg_id] = self._end
+        self._end += 1
+
+    def _evict(self):
+        slot = self._start % self.capacity
+        user = self._messages[slot].user
+        user_messages = self._by_user[user]
+        user_messages.popleft()
+        if not user_messages:
+            del self._by_user[user]
+        msg_id = self._messages[slot].msg_id
+        if msg_id is not None and self._by_id.get(msg_id) == self._start:
+            del self._by_id[msg_id]
+        self._messages[slot] = None
+        self._start += 1
+
+    def _bisect_right(self, timestamp: float) -> int:
+        """Sequence number of the first message newer than `timestamp`."""
+        lo, hi = self._start, self._end
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._timestamps[mid % self.capacity] <= timestamp:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def _bisect_left(self, timestamp: float) -> int:
+        """Sequence number of the first message not older than `timestamp`."""
+        lo, hi = self._start, self._end
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._timestamps[mid % self.capacity] < timestamp:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def find(self, user=None, min_timestamp=None, max_timestamp=None,
+             pattern=None) -> typing.List[StandardizedMessage]:
+        if user is not None:
+            sequence_numbers = self._by_user.get(user, ())
+        elif self._last_unordered < self._start:
+            first = self._start if min_timestamp is None else self._bisect_right(min_timestamp)
+            last = self._end if max_timestamp is None else self._bisect_left(max_timestamp)
+            sequence_numbers = range(first, last)
+        else:
+            sequence_numbers = range(self._start, self._end)
+
+        ret_list = []
+        for seq in sequence_numbers:
+            slot = seq % self.capacity
+            t = self._timestamps[slot]
+            msg = self._messages[slot]
+            if ((min_timestamp is None or min_timestamp < t)
+                    and (max_timestamp is None or max_timestamp > t)
+                    and (pattern is None or pattern.search(msg.text))):
+                ret_list.append(msg.materialize(t, self.parent))
+        return ret_list
+
+    def get(self, msg_id: str) -> typing.Optional[StandardizedMessage]:
+        """Find a message by the value of its `id` tag."""
+        try:
+            key = uuid.UUID(msg_id).int
+        except ValueError:
+            key = msg_id
+        seq = self._by_id.get(key)
+        if seq is None:
+            return None
+        slot = seq % self.capacity
+        return self._messages[slot].materialize(self._timestamps[slot], self.parent)
+
+    def estimate_size(self) -> int:
+        """Estimate how many bytes are used by messages in this buffer."""
+        total = sys.getsizeof(self._messages) + sys.getsizeof(self._timestamps) + sys.getsizeof(self._by_id)
+        for msg, t in self.records():
+            total += msg.estimate_size() + sys.getsizeof(t)
+        return total
@@ -0,0 +1,229 @@
+#  This is a simple utility bot
+#  Copyright (C) 2020 Mm2PL
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import abc
+import asyncio
+import json
+import os
+import time
+import typing
+
+import twitchirc
+
+# Emote lists older than this are still used, but refreshed in the background
+EMOTE_TTL = 60 * 60
+# How long to remember that a name isn't a Twitch emote
+MISSING_EMOTE_TTL = 10 * 60
+# Lists that are missing a provider's emotes are retried sooner and not saved
+FAILED_EMOTE_TTL = 60
+SAVE_DELAY = 30
+
+
+class Emote:
+    def __init__(self, name: str, url: str, id_: str, urls=None, **kwargs):
+        if urls is None:
+            urls = {}
+        self.urls = urls
+        self.name = name
+        self.url = url
+        self.id_ = id_
+        self.other_data = kwargs
+
+    def get_url(self, size: str):
+        if size in self.urls:
+            return self.urls[size]
+        return self.url.format(size)
+
+    def __repr__(self):
+        return f'<Emote: {self.name}>'
+
+    def to_json(self) -> dict:
+        return {
+            'name': self.name,
+            'url': self.url,
+            'id': self.id_,
+            'urls': list(self.urls.items()),  # FFZ uses int keys
+            'other_data': self.other_data
+        }
+
+    @classmethod
+    def from_json(cls, data: dict) -> 'Emote':
+        return cls(data['name'], data['url'], data['id'], dict(data['urls']), **data['other_data'])
+
+
+class EmoteProvider(abc.ABC):
+    name: str
+
+    @abc.abstractmethod
+    async def fetch_globals(self) -> typing.Dict[str, Emote]:
+        """:raises ValueError: if the emotes couldn't be fetched."""
+
+    @abc.abstractmethod
+    async def fetch_channel(self, channel_id: str) -> typing.Dict[str, Emote]:
+        """:raises ValueError: if the emotes couldn't be fetched."""
+
+
+class IndexEntry:
+    __slots__ = ('by_provider', 'emotes', 'fetched_at', 'ttl')
+
+    def __init__(self, by_provider: typing.Dict[str, typing.Dict[str, Emote]], fetched_at: float,
+                 providers: typing.List[EmoteProvider], ttl: float = EMOTE_TTL):
+        self.by_provider = by_provider
+        self.fetched_at = fetched_at
+        self.ttl = ttl
+        self.emotes: typing.Dict[str, Emote] = {}
+        for provider in reversed(providers):  # earlier providers win
+            self.emotes.update(by_provider.get(provider.name, {}))
+
+
+class EmoteIndex:
+    """
+    Maps emote names to emotes for every channel, merged from all providers.
+
+    Channels are loaded the first time they're used, concurrent lookups wait for the same request. Emote lists older
+    than `EMOTE_TTL` keep being served while a single background refresh runs. Loaded lists are saved to
+    `cache_file`, so they survive restarts. If a provider fails, its previous emotes are kept and the list is retried
+    after `FAILED_EMOTE_TTL`; a list that has nothing from that provider is also kept out of `cache_file`.
+    """
+    GLOBAL = ''
+
+    def __init__(self, providers: typing.List[EmoteProvider], cache_file: str):
+        self.providers = providers
+        self.cache_file = cache_file
+        self.entries: typing.Dict[str, IndexEntry] = {}
+        self._loading: typing.Dict[str, asyncio.Task] = {}
+        self._save_handle: typing.Optional[asyncio.TimerHandle] = None
+        # Twitch emotes can only be looked up by name
+        self.twitch_names: typing.Dict[str, typing.Tuple[typing.Optional[Emote], float]] = {}
+        self._twitch_loading: typing.Dict[str, asyncio.Task] = {}
+
+    async def find(self, name: str, channel_id: typing.Optional[str] = None) -> typing.Optional[Emote]:
+        keys = [channel_id, self.GLOBAL] if channel_id is not None else [self.GLOBAL]
+        entries = await asyncio.gather(*(self.get(i) for i in keys))
+        for entry in entries:
+            if entry is not None and name in entry.emotes:
+                return entry.emotes[name]
+        return await self._find_twitch_emote(name)
+
+    async def get(self, key: str) -> typing.Optional[IndexEntry]:
+        entry = self.entries.get(key)
+        if entry is None:
+            return await self._refresh(key)
+        if time.time() - entry.fetched_at > entry.ttl:
+            self._refresh(key)
+        return entry
+
+    def _refresh(self, key: str) -> asyncio.Task:
+        task = self._loading.get(key)
+        if task is None:
+            task = self._loading[key] = asyncio.create_task(self._load(key))
+            task.add_done_callback(lambda _: self._loading.pop(key, None))
+        return task
+
+    async def _load(self, key: str) -> typing.Optional[IndexEntry]:
+        if key == self.GLOBAL:
+            coros = [i.fetch_globals() for i in self.providers]
+        else:
+            coros = [i.fetch_channel(key) for i in self.providers]
+        results = await asyncio.gather(*coros, return_exceptions=True)
+
+        old = self.entries.get(key)
+        by_provider = {}
+        failed = False
+        for provider, result in zip(self.providers, results):
+            if isinstance(result, Exception):
+                twitchirc.log('warn', f'Failed to load {provider.name} emotes for {key or "globals"}: {result!r}')
+                failed = True
+                if old is not None and provider.name in old.by_provider:
+                    by_provider[provider.name] = old.by_provider[provider.name]
+            elif isinstance(result, BaseException):
+                raise result
+            else:
+                by_provider[provider.name] = result
+        if not failed:
+            entry = IndexEntry(by_provider, time.time(), self.providers)
+        elif old is not None and all(i.name in by_provider for i in self.providers):
+            # keep what was known about the provider that failed, but don't wait an hour to try it again
+            entry = IndexEntry(by_provider, time.time() - EMOTE_TTL + FAILED_EMOTE_TTL, self.providers)
+        else:
+            # incomplete, served until the retry but kept out of the disk cache
+            entry = IndexEntry(by_provider, time.time(), self.providers, ttl=FAILED_EMOTE_TTL)
+        self.entries[key] = entry
+        if entry.ttl == EMOTE_TTL:
+            self._schedule_save()
+        return entry
+
+    async def _find_twitch_emote(self, name: str) -> typing.Optional[Emote]:
+        cached = self.twitch_names.get(name)
+        if cached is not None:
+            emote, fetched_at = cached
+            ttl = EMOTE_TTL if emote is not None else MISSING_EMOTE_TTL
+            if time.time() - fetched_at <= ttl:
+                return emote
+        task = self._twitch_loading.get(name)
+        if task is None:
+            twitch = next(i for i in self.providers if i.name == 'twitch')
+            task = self._twitch_loading[name] = asyncio.create_task(twitch.fetch_emote(name))
+            task.add_done_callback(lambda _: self._twitch_loading.pop(name, None))
+        try:
+            emote = await asyncio.shield(task)
+        except Exception as e:
+            twitchirc.log('warn', f'Failed to look up Twitch emote {name!r}: {e!r}')
+            return cached[0] if cached is not None else None
+        self.twitch_names[name] = (emote, time.time())
+        return emote
+
+    def load(self):
+        try:
+            with open(self.cache_file, 'r') as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            twitchirc.log('warn', f'Unable to load emote cache from {self.cache_file!r}: {e!r}')
+            return
+        for key, entry in data.items():
+            by_provider = {
+                provider: {name: Emote.from_json(emote) for name, emote in emotes.items()}
+                for provider, emotes in entry['providers'].items()
+            }
+            self.entries[key] = IndexEntry(by_provider, entry['fetched_at'], self.providers)
+        twitchirc.log('info', f'Loaded cached emotes for {len(self.entries)} channels')
+
+    def _schedule_save(self):
+        if self._save_handle is None:
+            self._save_handle = asyncio.get_event_loop().call_later(SAVE_DELAY, self._save_soon)
+
+    def _save_soon(self):
+        self._save_handle = None
+        data = {
+            key: {
+                'fetched_at': entry.fetched_at,
+                'providers': {
+                    provider: {name: emote.to_json() for name, emote in emotes.items()}
+                    for provider, emotes in entry.by_provider.items()
+                }
+            }
+            for key, entry in self.entries.items()
+            if entry.ttl == EMOTE_TTL  # incomplete lists shouldn't outlive a restart
+        }
+        asyncio.get_event_loop().run_in_executor(None, self._write, data)
+
+    def _write(self, data: dict):
+        os.makedirs(os.path.dirname(self.cache_file), exist_ok=True)
+        tmp_path = self.cache_file + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(data, f)
+        os.replace(tmp_path, self.cache_file)
@@ -0,0 +1,157 @@
+#  This is a simple utility bot
+#  Copyright (C) 2020 Mm2PL
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import asyncio
+import hashlib
+import io
+import os
+import typing
+
+import aiohttp
+from PIL import Image
+
+C_SIZE = 16384
+SIZE_LIMIT = 10_000_000
+TIMEOUT = aiohttp.ClientTimeout(total=30, sock_connect=10)
+CONNECTION_LIMIT = 32
+
+CACHE_DIRECTORY = os.path.join('cache', 'images')
+CACHE_MAX_BYTES = 128_000_000
+
+_session: typing.Optional[aiohttp.ClientSession] = None
+
+
+def get_session() -> aiohttp.ClientSession:
+    """Return the ClientSession shared by everything that downloads images, creating it if necessary."""
+    global _session
+    if _session is None or _session.closed:
+        _session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=CONNECTION_LIMIT), timeout=TIMEOUT)
+    return _session
+
+
+async def close_session():
+    global _session
+    if _session is not None:
+        await _session.close()
+        _session = None
+
+
+class DiskCache:
+    """
+    Content-addressed cache of downloaded files.
+
+    Files are stored once per distinct content under `blobs/<sha256 of content>`, `urls/<sha256 of url>` contains
+    the digest of the file the url pointed to. The least recently used files are removed once the cache grows over
+    `max_bytes`. All methods block, use them through :py:func:`asyncio.AbstractEventLoop.run_in_executor`.
+    """
+
+    def __init__(self, directory: str, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._blobs = os.path.join(directory, 'blobs')
+        self._urls = os.path.join(directory, 'urls')
+
+    @staticmethod
+    def _digest(data: bytes) -> str:
+        return hashlib.sha256(data).hexdigest()
+
+    def get(self, url: str) -> typing.Optional[bytes]:
+        try:
+            with open(os.path.join(self._urls, self._digest(url.encode())), 'r') as f:
+                path = os.path.join(self._blobs, f.read().strip())
+            with open(path, 'rb') as f:
+                data = f.read()
+        except (FileNotFoundError, NotADirectoryError):
+            return None
+        os.utime(path)
+        return data
+
+    def put(self, url: str, data: bytes):
+        if len(data) > self.max_bytes:
+            return
+        os.makedirs(self._blobs, exist_ok=True)
+        os.makedirs(self._urls, exist_ok=True)
+        digest = self._digest(data)
+        blob_path = os.path.join(self._blobs, digest)
+        if not os.path.exists(blob_path):
+            self._write(blob_path, data)
+        else:
+            os.utime(blob_path)
+        self._write(os.path.join(self._urls, self._digest(url.encode())), digest.encode())
+        self._evict()
+
+    @staticmethod
+    def _write(path: str, data: bytes):
+        # Write to a temporary file first, so a crash never leaves a truncated file in the cache.
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+    def _evict(self):
+        blobs = []
+        total = 0
+        with os.scandir(self._blobs) as it:
+            for entry in it:
+                stat = entry.stat()
+                blobs.append((stat.st_mtime, stat.st_size, entry.path))
+                total += stat.st_size
+        if total <= self.max_bytes:
+            return
+        blobs.sort()
+        for _, size, path in blobs:
+            if total <= self.max_bytes:
+                break
+            os.remove(path)
+            total -= size
+        # Url entries pointing at removed blobs are treated as misses by get() and overwritten by the next put().
+
+
+disk_cache = DiskCache(CACHE_DIRECTORY, CACHE_MAX_BYTES)
+
+
+async def fetch_bytes(url: str, size_limit: int = SIZE_LIMIT, cache: bool = False) -> bytes:
+    """
+    Download `url` without blocking the event loop, giving up as soon as the response grows over `size_limit`.
+
+    :param cache: Look up and store the response in :py:data:`disk_cache`. Meant for urls with immutable content,
+    like emote images.
+    :raises ValueError: if the response is over the size limit.
+    :raises aiohttp.ClientError: if the request failed.
+    """
+    loop = asyncio.get_event_loop()
+    if cache:
+        data = await loop.run_in_executor(None, disk_cache.get, url)
+        if data is not None:
+            return data
+
+    async with get_session().get(url) as r:
+        r.raise_for_status()
+        if r.content_length is not None and r.content_length > size_limit:
+            raise ValueError('Response is over the size limit.')
+        buf = bytearray()
+        async for chunk in r.content.iter_chunked(C_SIZE):
+            buf += chunk
+            if len(buf) > size_limit:
+                raise ValueError('Response is over the size limit.')
+    data = bytes(buf)
+    if cache:
+        await loop.run_in_executor(None, disk_cache.put, url, data)
+    return data
+
+
+async def download_image(url: str, cache: bool = False) -> Image.Image:
+    """Download and open an image. See :py:func:`fetch_bytes` for the arguments."""
+    return Image.open(io.BytesIO(await fetch_bytes(url, cache=cache)))
@@ -0,0 +1,282 @@
+#  This is a simple utility bot
+#  Copyright (C) 2021 Mm2PL
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import asyncio
+import collections
+import datetime
+import itertools
+import re
+import signal
+import subprocess
+import time
+import typing
+from typing import List
+
+DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
+READ_SIZE = 64 * 1024
+MAX_JOBS = 3
+MAX_JOBS_PER_USER = 1  # running at once, the rest waits in the queue
+MAX_QUEUED_PER_USER = 3
+ROUTES_TTL = 600
+ROUTES_MISS_TTL = 60  # refresh sooner when asked about a channel that no instance had
+
+
+class JustgrepError(Exception):
+    def __init__(self, errors: List[str]):
+        self.errors = errors
+
+    def __repr__(self):
+        return f'<Justgrep error: {", ".join(self.errors)}>'
+
+
+class JobLimitError(Exception):
+    pass
+
+
+def user_arguments(users: List[str], not_users: List[str]) -> typing.Tuple[str, ...]:
+    if len(users) > 1 or not_users:
+        not_user_arg = ()
+        if not_users:
+            not_user_arg = (
+                '-notuser', '|'.join(map(re.escape, not_users)),
+            )
+        return (
+            '-uregex',
+            '-user', '|'.join(map(re.escape, users)),
+            *not_user_arg
+        )
+    elif len(users) == 1:
+        return (
+            '-user', users[0]
+        )
+    else:  # no users
+        return ()
+
+
+def _kill(proc: asyncio.subprocess.Process):
+    try:
+        proc.send_signal(signal.SIGKILL)
+    except ProcessLookupError:
+        pass  # already gone
+
+
+class LogSearch:
+    """
+    One justgrep run, with its output read as it is produced.
+
+    `matched` and `elapsed` can be read while :py:meth:`run` is going to report progress. Once `count` lines have
+    matched the process is killed instead of waiting for it to finish.
+    """
+
+    def __init__(self, address: str, channel: str, users: List[str], not_users: List[str],
+                 regular_expr: typing.Pattern, start: datetime.datetime, end: datetime.datetime, count: int,
+                 executable: str = 'justgrep'):
+        self.args = (
+            executable,
+            '-channel', channel,
+            '-start', start.strftime(DATE_FORMAT),
+            '-end', end.strftime(DATE_FORMAT),
+            '-url', address,
+            *user_arguments(users, not_users),
+            '-regex', regular_expr.pattern,
+            '-max', str(count),
+        )
+        self.count = count
+        self.matched: List[str] = []
+        self.started: typing.Optional[float] = None
+        self.finished: typing.Optional[float] = None
+
+    @property
+    def elapsed(self) -> float:
+        if self.started is None:
+            return 0.0
+        return (self.finished or time.monotonic()) - self.started
+
+    @property
+    def progress(self) -> str:
+        return f'{len(self.matched)} messages matched in {self.elapsed:.1f}s'
+
+    async def run(self) -> List[str]:
+        self.started = time.monotonic()
+        proc = await asyncio.create_subprocess_exec(
+            *self.args,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE
+        )
+        stderr_task = asyncio.create_task(proc.stderr.read())
+        try:
+            rest = b''
+            while len(self.matched) < self.count:
+                chunk = await proc.stdout.read(READ_SIZE)
+                if not chunk:
+                    if rest:
+                        self.matched.append(rest.decode())
+                    break
+                complete, newline, rest = (rest + chunk).rpartition(b'\n')
+                if newline:
+                    self.matched.extend(complete.decode().split('\n')[:self.count - len(self.matched)])
+            if len(self.matched) >= self.count:
+                # got everything that was asked for, don't wait for justgrep to notice
+                _kill(proc)
+            else:
+                stderr = (await stderr_task).decode().split('\n')
+                if len(stderr) and stderr[0]:
+                    raise JustgrepError(stderr)
+        except BaseException:
+            _kill(proc)
+            raise
+        finally:
+            self.finished = time.monotonic()
+            stderr_task.cancel()
+            asyncio.create_task(proc.wait())  # reap it without holding up the results
+        return self.matched
+
+
+def build_paste(header: typing.Iterable[str], matched: typing.Iterable[str]) -> str:
+    parts = []
+    for i in header:
+        parts.append(f'@msg-id=log_info :tmi.twitch.tv NOTICE * :{i}\n')
+    for msg in matched:
+        parts.append(msg)
+        parts.append('\r\n')
+    return ''.join(parts)
+
+
+class SearchJob:
+    def __init__(self, id_: int, owner: str, search: LogSearch):
+        self.id = id_
+        self.owner = owner
+        self.search = search
+        self.task: typing.Optional[asyncio.Task] = None
+        self.running = False
+        self._turn = asyncio.get_event_loop().create_future()
+
+
+class JobScheduler:
+    """
+    Runs log searches, at most `max_jobs` at a time and `max_jobs_per_user` at a time for any one user.
+
+    Jobs that can't start yet wait in a queue in the order they were submitted. A job whose owner is at their limit
+    doesn't hold up the jobs of other users queued behind it.
+    """
+
+    def __init__(self, max_jobs: int = MAX_JOBS, max_jobs_per_user: int = MAX_JOBS_PER_USER,
+                 max_queued_per_user: int = MAX_QUEUED_PER_USER):
+        self.max_jobs = max_jobs
+        self.max_jobs_per_user = max_jobs_per_user
+        self.max_queued_per_user = max_queued_per_user
+        self.jobs: typing.Dict[int, SearchJob] = {}
+        self._queue: typing.Deque[SearchJob] = collections.deque()
+        self._running_per_user: typing.Counter[str] = collections.Counter()
+        self._running = 0
+        self._ids = itertools.count(1)
+
+    def submit(self, owner: str, search: LogSearch) -> SearchJob:
+        if sum(1 for i in self.jobs.values() if i.owner == owner) >= self.max_queued_per_user:
+            raise JobLimitError(f'You already have {self.max_queued_per_user} log searches queued or running.')
+        job = SearchJob(next(self._ids), owner, search)
+        self.jobs[job.id] = job
+        self._queue.append(job)
+        job.task = asyncio.create_task(self._execute(job))
+        job.task.add_done_callback(lambda _: self._finished(job))
+        self._start_ready()
+        return job
+
+    def position(self, job: SearchJob) -> int:
+        """1-based position of `job` in the queue, 0 if it's running."""
+        if job.running:
+            return 0
+        return self._queue.index(job) + 1
+
+    def cancel(self, job_id: int) -> bool:
+        job = self.jobs.get(job_id)
+        if job is None:
+            return False
+        job.task.cancel()
+        return True
+
+    def _start_ready(self):
+        if self._running >= self.max_jobs:
+            return
+        for job in list(self._queue):
+            if self._running >= self.max_jobs:
+                break
+            if self._running_per_user[job.owner] >= self.max_jobs_per_user:
+                continue
+            self._queue.remove(job)
+            job.running = True
+            self._running += 1
+            self._running_per_user[job.owner] += 1
+            job._turn.set_result(None)
+
+    async def _execute(self, job: SearchJob) -> List[str]:
+        await job._turn
+        return await job.search.run()
+
+    def _finished(self, job: SearchJob):
+        # a done callback and not a `finally` because a task cancelled before it started never runs its coroutine
+        del self.jobs[job.id]
+        if job.running:
+            self._running -= 1
+            self._running_per_user[job.owner] -= 1
+            if not self._running_per_user[job.owner]:
+                del self._running_per_user[job.owner]
+        else:
+            self._queue.remove(job)
+        self._start_ready()
+
+
+class LoggerRoutes:
+    """
+    Which of the configured JustLog instances logs which channel.
+
+    All instances are asked for their channels at once and the answers are kept for `ttl` seconds. The first
+    instance in `loggers` that has a channel wins. Instances that fail to answer keep their previous channels.
+    """
+
+    def __init__(self, loggers: typing.Sequence, ttl: float = ROUTES_TTL, miss_ttl: float = ROUTES_MISS_TTL):
+        self.loggers = loggers
+        self.ttl = ttl
+        self.miss_ttl = miss_ttl
+        self.routes: typing.Dict[str, typing.Any] = {}
+        self.refreshed_at: typing.Optional[float] = None
+        self._refreshing: typing.Optional[asyncio.Future] = None
+
+    def invalidate(self):
+        self.refreshed_at = None
+
+    async def _refresh(self):
+        await asyncio.gather(*(i.query_channels() for i in self.loggers), return_exceptions=True)
+        routes = {}
+        for logger in reversed(self.loggers):
+            for channel in logger.channels:
+                routes[channel.name] = logger
+        self.routes = routes
+        self.refreshed_at = time.monotonic()
+
+    async def refresh(self):
+        if self._refreshing is None:
+            self._refreshing = asyncio.ensure_future(self._refresh())
+            self._refreshing.add_done_callback(self._refreshed)
+        await asyncio.shield(self._refreshing)
+
+    def _refreshed(self, _):
+        self._refreshing = None
+
+    async def get(self, channel: str):
+        age = None if self.refreshed_at is None else time.monotonic() - self.refreshed_at
+        if age is None or age > self.ttl or (channel not in self.routes and age > self.miss_ttl):
+            await self.refresh()
+        return self.routes.get(channel)
@@ -0,0 +1,67 @@
+#  This is a simple utility bot
+#  Copyright (C) 2021 Mm2PL
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import hashlib
+import os
+import shlex
+import subprocess
+import typing
+
+COMPILE_COMMAND = 'sudo -u nobody bash /usr/local/bin/compile_latex.sh'
+COMPILE_TIMEOUT = 30
+
+
+class LatexResult(typing.NamedTuple):
+    returncode: int
+    output: str
+    png: typing.Optional[bytes]
+    pid: int
+
+
+def document_hash(document: str) -> str:
+    return hashlib.sha256(document.encode()).hexdigest()
+
+
+def compile_document(document: str, timeout: float = COMPILE_TIMEOUT) -> LatexResult:
+    """
+    Render a LaTeX document to a PNG using compile_latex.sh. Blocks, meant to be run in a
+    :py:mod:`worker_pool` worker.
+    """
+    proc = subprocess.Popen(COMPILE_COMMAND, shell=True, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    prefix = proc.stdout.readline().decode().strip()
+    try:
+        output, _ = proc.communicate((document + '\n').encode(), timeout=timeout)
+    except subprocess.TimeoutExpired:
+        proc.terminate()  # sudo relays SIGTERM to lualatex, SIGKILL would leave it running
+        try:
+            output, _ = proc.communicate(timeout=2)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+            output, _ = proc.communicate()
+        output += f'\n! Rendering took longer than {timeout} seconds.\n'.encode()
+        if proc.returncode == 0:
+            proc.returncode = -1
+
+    png = None
+    try:
+        if proc.returncode == 0:
+            with open(os.path.join(prefix, 'output.png'), 'rb') as f:
+                png = f.read()
+    except FileNotFoundError:
+        pass
+    finally:
+        if prefix:
+            subprocess.run(f'sudo -u nobody /bin/rm -rf {shlex.quote(prefix)}', shell=True)
+    return LatexResult(proc.returncode, output.decode(errors='replace'), png, proc.pid)
@@ -0,0 +1,195 @@
+#  This is a simple utility bot
+#  Copyright (C) 2021 Mm2PL
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import collections
+import datetime
+import threading
+import time
+import typing
+
+MAX_QUEUE = 10_000
+BATCH_SIZE = 1_000
+FLUSH_INTERVAL = 10
+SOURCE_RATE = 50  # lines per second
+SOURCE_BURST = 500
+PROTECTED_LEVEL = 3  # errors are never dropped
+
+
+class _Bucket:
+    __slots__ = ('tokens', 'last_refill')
+
+    def __init__(self, tokens: float, now: float):
+        self.tokens = tokens
+        self.last_refill = now
+
+
+class LogSink:
+    """
+    Writes log lines to the database from a background thread.
+
+    Lines are written using bulk INSERTs, at most `batch_size` at a time, once `flush_interval` seconds have passed
+    since the oldest unwritten line was queued or once a full batch is waiting. Lines identical to the one queued
+    right before are coalesced into one row. Lines below :py:data:`PROTECTED_LEVEL` are dropped once their source
+    goes over `source_rate` lines per second (with bursts of up to `source_burst`) or once `max_queue` lines are
+    waiting.
+
+    :param write: Blocking function called with a list of rows to insert.
+    """
+
+    def __init__(self, write: typing.Callable[[typing.List[dict]], typing.Any], max_queue: int = MAX_QUEUE,
+                 batch_size: int = BATCH_SIZE, flush_interval: float = FLUSH_INTERVAL,
+                 source_rate: float = SOURCE_RATE, source_burst: float = SOURCE_BURST,
+                 on_error: typing.Optional[typing.Callable[[BaseException], typing.Any]] = None):
+        self.write = write
+        self.max_queue = max_queue
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.source_rate = source_rate
+        self.source_burst = source_burst
+        self.on_error = on_error
+
+        self._queue: typing.Deque[dict] = collections.deque()
+        self._last: typing.Optional[dict] = None
+        self._oldest: typing.Optional[float] = None
+        self._buckets: typing.Dict[str, _Bucket] = {}
+        self._condition = threading.Condition()
+        self._stopping = False
+        self._thread: typing.Optional[threading.Thread] = None
+
+        self.dropped = 0
+        self.rate_limited = 0
+        self.coalesced = 0
+        self.flushes = 0
+        self.flushed_lines = 0
+        self.failed_flushes = 0
+        self.last_flush_latency = 0.0
+
+    @property
+    def queue_depth(self) -> int:
+        return len(self._queue)
+
+    def _allow(self, source: str, now: float) -> bool:
+        bucket = self._buckets.get(source)
+        if bucket is None:
+            bucket = self._buckets[source] = _Bucket(self.source_burst, now)
+        bucket.tokens = min(self.source_burst, bucket.tokens + (now - bucket.last_refill) * self.source_rate)
+        bucket.last_refill = now
+        if bucket.tokens < 1:
+            return False
+        bucket.tokens -= 1
+        return True
+
+    def put(self, source: str, level: int, message: str, cause: int):
+        now = time.monotonic()
+        with self._condition:
+            last = self._last
+            if (last is not None and last['message'] == message and last['source'] == source
+                    and last['level'] == level and last['cause'] == cause):
+                last['repeats'] += 1
+                self.coalesced += 1
+                return
+            if level < PROTECTED_LEVEL:
+                if not self._allow(source, now):
+                    self.rate_limited += 1
+                    return
+                if len(self._queue) >= self.max_queue:
+                    self.dropped += 1
+                    return
+            entry = {
+                'time': datetime.datetime.now(),
+                'source': source,
+                'level': level,
+                'message': message,
+                'cause': cause,
+                'repeats': 0
+            }
+            self._queue.append(entry)
+            self._last = entry
+            if self._oldest is None:
+                self._oldest = now
+                self._condition.notify()  # start the flush timer
+            elif len(self._queue) >= self.batch_size:
+                self._condition.notify()
+
+    def _take(self) -> typing.List[dict]:
+        batch = []
+        while self._queue and len(batch) < self.batch_size:
+            batch.append(self._queue.popleft())
+        if not self._queue:
+            self._last = None
+            self._oldest = None
+        else:
+            self._oldest = time.monotonic()
+        return batch
+
+    @staticmethod
+    def _to_row(entry: dict) -> dict:
+        message = entry['message']
+        if entry['repeats']:
+            message += f' (repeated {entry["repeats"] + 1} times)'
+        return {
+            'time': entry['time'],
+            'source': entry['source'],
+            'level': entry['level'],
+            'message': message,
+            'cause': entry['cause']
+        }
+
+    def _flush(self, batch: typing.List[dict]):
+        start = time.monotonic()
+        try:
+            self.write([self._to_row(i) for i in batch])
+        except Exception as e:
+            self.failed_flushes += 1
+            self.dropped += len(batch)
+            if self.on_error is not None:
+                self.on_error(e)
+            return
+        finally:
+            self.last_flush_latency = time.monotonic() - start
+        self.flushes += 1
+        self.flushed_lines += len(batch)
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._stopping:
+                    if len(self._queue) >= self.batch_size:
+                        break
+                    if self._oldest is not None:
+                        timeout = self._oldest + self.flush_interval - time.monotonic()
+                        if timeout <= 0:
+                            break
+                    else:
+                        timeout = None
+                    self._condition.wait(timeout)
+                batch = self._take()
+                stopping = self._stopping
+            if batch:
+                self._flush(batch)
+            if stopping and not self._queue:
+                return
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='log sink', daemon=False)
+        self._thread.start()
+
+    def stop(self, timeout: typing.Optional[float] = None):
+        """Write everything that's queued and stop the thread."""
+        with self._condition:
+            self._stopping = True
+            self._condition.notify()
+        if self._thread is not None:
+            self._thread.join(timeout)
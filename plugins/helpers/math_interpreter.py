@@ -0,0 +1,812 @@
+#  This is a simple utility bot
+#  Copyright (C) 2020 Mm2PL
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import ast
+import io
+import math
+import operator
+import typing
+
+import matplotlib
+
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+import numpy
+
+RESULT_TOO_BIG = 'result might be too big.'
+
+
+class Context:
+    user: str
+    source: str
+
+
+class Plot:
+    image: io.BytesIO
+    steps_taken: int
+
+    def __init__(self, image, steps_taken):
+        self.image = image
+        self.steps_taken = steps_taken
+
+
+class FunctionWithCtx:
+    def __init__(self, func):
+        self.func = func
+        self.__doc__ = func.__doc__
+
+    def __call__(self, *args, ctx, **kwargs):
+        return self.func(*args, ctx=ctx, **kwargs)
+
+
+def _raise_from_eval(exc: Exception) -> typing.NoReturn:
+    exc.from_eval = True
+    raise exc
+
+
+def _call(f: typing.Union[typing.Callable, ast.Lambda], *args, ctx, **kwargs) -> typing.Any:
+    if isinstance(f, ast.Lambda):
+        # return Math.eval_(f.body, locals_=kwargs)
+        call = ast.Call(
+            func=f,
+            args=[
+                ast.Constant(i) for i in args
+            ],
+            keywords=[
+                ast.keyword(arg=k, value=ast.Constant(v))
+                for k, v in kwargs
+            ])
+        return Math.call_lambda(call, {}, ctx)
+    else:
+        return f(*args, **kwargs)
+
+
+def _function_name(f: typing.Union[ast.Lambda, typing.Callable], ctx_, start, end, step) -> typing.Optional[str]:
+    if isinstance(f, typing.Callable):
+        return f'{f.__name__} from {start} to {end} (in {step} increments)'
+    elif isinstance(f, ast.Lambda):
+        return None
+    else:
+        raise RuntimeError(f'Tried to check function name of object type: {type(f)!r}')
+
+
+PLOT_FORMATS = [
+    '-b',
+    '-g',
+    '-r',
+    '-c',
+    '-m',
+    '-y',
+    '-k',
+
+    '--b',
+    '--g',
+    '--r',
+    '--c',
+    '--m',
+    '--y',
+    '--k'
+]
+
+
+@FunctionWithCtx
+def _plot(function: typing.Union[ast.Lambda, typing.Callable], start: float, end: float, step: float, ctx: Context):
+    return _plots([function], start, end, step, ctx=ctx)
+
+
+def _set_plot_spines(axis, start, end, y_min, y_max):
+    axis.spines['left'].set_position('zero')
+    axis.spines['right'].set_color('none')
+    axis.spines['bottom'].set_position('zero')
+    axis.spines['top'].set_color('none')
+    # axis.spines['left'].set_smart_bounds(True)
+    # axis.spines['bottom'].set_smart_bounds(True)
+    axis.spines['left'].set_bounds(y_min, y_max)
+    axis.spines['bottom'].set_bounds(start, end)
+    axis.xaxis.set_ticks_position('bottom')
+    axis.yaxis.set_ticks_position('left')
+
+
+def _export_fig(figure, steps_taken) -> Plot:
+    bio = io.BytesIO()
+    figure.savefig(bio, format='png')
+    plt.close(figure)
+    bio.seek(0)
+    return Plot(bio, steps_taken)
+
+
+# Evaluating this many steps takes well under a second and a few hundred MiB in a worker since plots are downsampled
+MAX_STEPS = 2_000_000
+# Limit for functions that can't be evaluated using VectorizedLambda
+MAX_INTERPRETED_STEPS = 400_000
+# Points drawn per function, the figure is only 640 pixels wide
+MAX_PLOT_POINTS = 4_000
+
+
+def _downsample(x: numpy.ndarray, y: numpy.ndarray, points: int) -> typing.Tuple[numpy.ndarray, numpy.ndarray]:
+    """
+    Pick at most `points` points of `y` to draw.
+
+    `y` is split into buckets, the lowest and highest point of every bucket are kept so that spikes still show up.
+    Buckets containing only NaN keep one NaN, which leaves a gap in the line like before.
+    """
+    if len(y) <= points:
+        return x, y
+    bucket = -(-len(y) // (points // 2))
+    buckets = numpy.full(-(-len(y) // bucket) * bucket, numpy.nan)
+    buckets[:len(y)] = y
+    buckets = buckets.reshape(-1, bucket)
+    nan = numpy.isnan(buckets)
+    starts = numpy.arange(0, len(buckets) * bucket, bucket)
+    lowest = starts + numpy.argmin(numpy.where(nan, numpy.inf, buckets), axis=1)
+    highest = starts + numpy.argmax(numpy.where(nan, -numpy.inf, buckets), axis=1)
+    indices = numpy.unique(numpy.concatenate((lowest, highest)))
+    return x[indices], y[indices]
+
+
+@FunctionWithCtx
+def _plots(functions: typing.List[typing.Union[ast.Lambda, typing.Callable]], start: float, end: float, step: float,
+           ctx: Context):
+    for num, f in enumerate(functions):
+        if not isinstance(f, (ast.Lambda, typing.Callable)):
+            _raise_from_eval(RuntimeError(f'(functions[{num}]) '
+                                          f'Cannot use {f!r} as a function for plotting. '
+                                          f'Did you want "lambda x: {f!r}"?'))
+    steps_needed_to_render = int(len(functions) * (
+            (end - start) / step
+    ))
+    if steps_needed_to_render >= MAX_STEPS:
+        _raise_from_eval(
+            ValueError(f'Cannot use more than {MAX_STEPS} steps, your figure would need {steps_needed_to_render}. '
+                       f'Lower the accuracy or render less functions at the same time.')
+        )
+    figure, axis = plt.subplots(1, 1)
+    fns = []
+    for f in functions:
+        fns.append(_function_name(f, ctx, start, end, step))
+
+    if all(fns):
+        axis.set_title('\n'.join(fns))
+    else:
+        title = ctx.source
+        if '\n' in title:
+            title = title.replace('\n', ' ')
+
+        while '  ' in title:
+            title = title.replace('  ', ' ')
+
+        if len(title) > 200:
+            title = f'{ctx.user}\'s plot'
+        axis.set_title(title)
+
+    x = numpy.arange(start, end, step)
+    y_min = y_max = None
+    interpreted_steps = 0
+    for num, f in enumerate(functions):
+        y, steps = _evaluate_on_range(f, x, ctx, MAX_INTERPRETED_STEPS - interpreted_steps)
+        interpreted_steps += steps
+        y = numpy.asarray(y, dtype=float)
+        if not numpy.isnan(y).all():
+            low, high = numpy.nanmin(y), numpy.nanmax(y)
+            y_min = low if y_min is None else min(y_min, low)
+            y_max = high if y_max is None else max(y_max, high)
+        axis.plot(
+            *_downsample(x, y, MAX_PLOT_POINTS),
+            PLOT_FORMATS[num]
+        )
+
+    if y_min is None:
+        y_min = y_max = 0.0
+    _set_plot_spines(axis, start, end, y_min, y_max)
+
+    return _export_fig(figure, steps_needed_to_render)
+
+
+class Helper(FunctionWithCtx):
+    """
+    Returns help for the object specified
+
+    help(obj: object) -> str
+    How this works:
+        1. Try to lookup __doc__ for the object provided (obj.__doc__), if something was found, return it
+        2. Try to lookup __doc__ for the type of that object (type(obj).__doc__), if something was found, return it,
+        3. Give up.
+    """
+
+    def __repr__(self):
+        return 'See help(help).'
+
+    # noinspection PyMethodOverriding
+    def __call__(self, obj: object, ctx: Context):
+        if hasattr(obj, '__doc__') and obj.__doc__ is not None:
+            return obj.__doc__
+        elif hasattr(type(obj), '__doc__') and type(obj).__doc__ is not None:
+            return type(obj).__doc__
+        else:
+            return 'Don\'t know how to help'
+
+    def __init__(self):
+        super().__init__(None)
+
+
+class UnsafeError(Exception):
+    def __repr__(self):
+        return f'Possibly unsafe operation. {self.message}'
+
+    def __init__(self, message: str):
+        self.message = message
+
+
+class Math:
+    """
+    Taken from https://github.com/pajbot/pajbot/blob/master/pajbot/modules/math.py#L134
+    modified to support lambdas and other things
+
+    Original from: http://stackoverflow.com/a/9558001
+    """
+
+    MAX_MULT = 1_000_000_000
+    MAX_SHIFT = 1_000_000
+    MAX_POW = 1_000
+    # supported operators
+    operators = {
+        ast.Add: operator.add,
+        ast.Sub: operator.sub,
+        ast.Mult: operator.mul,
+        ast.Div: operator.truediv,
+        ast.Pow: operator.pow,
+        ast.BitXor: operator.xor,
+        ast.USub: operator.neg,
+        ast.RShift: operator.rshift,
+        ast.LShift: operator.lshift,
+        ast.BitAnd: operator.and_,
+        ast.BitOr: operator.or_,
+        ast.MatMult: operator.matmul,
+        ast.Mod: operator.mod
+    }
+    functions = {
+        'plot': _plot,
+        'plots': _plots,
+        'help': Helper(),
+
+        'ceil': math.ceil,
+        'comb': math.copysign,
+        'fabs': math.fabs,
+        'floor': math.floor,
+        'fsum': math.fsum,
+        'gcd': math.gcd,
+        'isclose': math.isclose,
+        'isfinite': math.isfinite,
+        'isinf': math.isinf,
+        'isnan': math.isnan,
+        'ldexp': math.ldexp,
+        'frexp': math.frexp,
+        'modf': math.modf,
+        'remainder': math.remainder,
+        'trunc': math.trunc,
+        'exp': math.exp,
+        'expm1': math.expm1,
+        'log': math.log,
+        'log1p': math.log1p,
+        'log2': math.log2,
+        'log10': math.log10,
+        'pow': math.pow,
+        'sqrt': math.sqrt,
+        'acos': math.acos,
+        'asin': math.asin,
+        'atan': math.atan,
+        'atan2': math.atan2,
+        'cos': math.cos,
+        'hypot': math.hypot,
+        'sin': math.sin,
+        'degrees': math.degrees,
+        'radians': math.radians,
+        'acosh': math.acosh,
+        'asinh': math.asinh,
+        'atanh': math.atanh,
+        'cosh': math.cosh,
+        'sinh': math.sinh,
+        'tanh': math.tanh,
+        'erf': math.erf,
+        'erfc': math.erfc,
+        'gamma': math.gamma,
+        'lgamma': math.lgamma,
+
+        'int': int,
+        'float': float,
+        'str': str,
+        'abs': abs,
+        'min': min,
+        'max': max,
+        'len': len
+    }
+    default_locals = {
+        'pi': math.pi,
+        'π': math.pi,
+        'e': math.e,
+        'tau': math.tau,
+        'τ': math.tau,
+        'inf': math.inf,
+        'nan': math.nan
+    }
+
+    @staticmethod
+    def eval_expr(expr, ctx):
+        """
+        >>> Math.eval_expr('2^6')
+        4
+        >>> Math.eval_expr('2**6')
+        64
+        >>> Math.eval_expr('1 + 2*3**(4^5) / (6 + -7)')
+        -5.0
+        """
+        try:
+            return Math.nice_result(Math.eval_(ast.parse(expr, mode="eval").body, {}, ctx))
+        except SyntaxError as e:
+            _raise_from_eval(e)
+
+    @staticmethod
+    def nice_result(node):
+        if isinstance(node, ast.Lambda):
+            return '<Anonymous function>'
+        elif isinstance(node, Plot):
+            return node
+        else:
+            return str(node)
+
+    @staticmethod
+    def check_safe(node, opargs) -> typing.Tuple[bool, str]:
+        not_all_numbers = any((not isinstance(i, (int, float)) for i in opargs))
+        if not_all_numbers:
+            return True, 'ok'
+
+        if isinstance(node, ast.BinOp):
+            if isinstance(node.op, ast.Mult):
+                bigger = max(opargs)
+                if bigger > Math.MAX_MULT:
+                    return False, RESULT_TOO_BIG
+            elif isinstance(node.op, ast.Pow):
+                _, right = opargs
+                if right > Math.MAX_POW:
+                    return False, RESULT_TOO_BIG
+            elif isinstance(node.op, ast.LShift):
+                left, right = opargs
+
+                if right >= Math.MAX_SHIFT or left >= Math.MAX_MULT:
+                    return False, RESULT_TOO_BIG
+            elif isinstance(node.op, ast.Div):
+                smaller = max(opargs)
+                if smaller < 1:
+                    if (1 / smaller) >= Math.MAX_MULT:
+                        return False, RESULT_TOO_BIG
+
+        return True, 'ok'
+
+    @staticmethod
+    def eval_(node, locals_, ctx):
+        if locals_ is None:
+            locals_ = {}
+
+        if isinstance(node, ast.Num):  # <number>
+            return node.n
+        elif isinstance(node, ast.Constant):
+            return node.value
+        elif isinstance(node, ast.Tuple):
+            return tuple(
+                (Math.eval_(i, locals_, ctx) for i in node.elts)
+            )
+        elif isinstance(node, ast.List):
+            return list(
+                (Math.eval_(i, locals_, ctx) for i in node.elts)
+            )
+        elif isinstance(node, ast.Set):
+            return set(
+                (Math.eval_(i, locals_, ctx) for i in node.elts)
+            )
+        elif isinstance(node, ast.Name):
+            if node.id in Math.default_locals:
+                return Math.default_locals[node.id]
+            elif node.id in locals_:
+                return locals_[node.id]
+            elif node.id in Math.functions:
+                return Math.functions[node.id]
+            else:
+                _raise_from_eval(UnboundLocalError(f'Unknown variable: {node.id!r}'))
+        elif isinstance(node, ast.BinOp):  # <left> <operator> <right>
+            opargs = (
+                Math.eval_(node.left, locals_, ctx),
+                Math.eval_(node.right, locals_, ctx)
+            )
+            safe, info = Math.check_safe(node, opargs)
+            if safe:
+                try:
+                    return Math.operators[type(node.op)](*opargs)
+                except ArithmeticError as e:
+                    _raise_from_eval(e)
+            else:
+                _raise_from_eval(UnsafeError(info))
+        elif isinstance(node, ast.UnaryOp):  # <operator> <operand> e.g., -1
+            return Math.operators[type(node.op)](Math.eval_(node.operand, locals_, ctx))
+        elif isinstance(node, ast.Lambda):  # lambda <args>: <body>
+            return node
+        elif isinstance(node, ast.Call):  # <func>(<values>)
+            return Math.call(node, locals_, ctx)
+        elif isinstance(node, ast.Subscript):  # <val>[<val>]
+            return Math.eval_(node.value, locals_, ctx)[Math.eval_(node.slice, locals_, ctx)]
+        elif isinstance(node, ast.NamedExpr):
+
+            if isinstance(node.target, ast.Name):
+                name = node.target.id
+            else:
+                _raise_from_eval(RuntimeError(':= target is not a Name. This is currently not supported.'))
+
+            val = Math.eval_(node.value, locals_, ctx)
+            locals_[name] = val
+            return val
+        elif isinstance(node, ast.JoinedStr):  # f''
+            new_str = ''
+            for i in node.values:
+                if isinstance(i, ast.Constant):
+                    new_str += i.value
+                elif isinstance(i, ast.FormattedValue):
+                    new_str += Math.eval_(i, locals_, ctx)
+            return new_str
+        elif isinstance(node, ast.FormattedValue):
+            value = Math.eval_(node.value, locals_, ctx)
+            fspec = Math.eval_(node.format_spec, locals_, ctx) if node.format_spec else ''
+
+            return format(value, fspec)
+        else:
+            _raise_from_eval(NotImplementedError(f'Interpreting node type: {type(node)!r} is not implemented'))
+
+    @staticmethod
+    def call(node, locals_, ctx):
+        if isinstance(node.func, ast.Name):
+            return Math.call_function_by_name(node, locals_, ctx)
+        elif isinstance(node.func, ast.Lambda):
+            return Math.call_lambda(node, locals_, ctx)
+        else:
+            _raise_from_eval(KeyError(f'Cannot use {type(node.func)!r} as function, this interpreter might be '
+                                      f'incomplete.'))
+
+    @staticmethod
+    def call_function_by_name(node: ast.Call, locals_, ctx):
+        target = node.func.id
+        target_func = None
+        if target in Math.functions:
+            target_func = Math.functions[target]
+        elif target in locals_:
+            target_func = locals_[target]
+        else:
+            _raise_from_eval(NameError(f'Unknown function {target!r}'))
+
+        if target_func:
+            kwargs = {
+                keyword.arg: Math.eval_(keyword.value, locals_, ctx)
+                for keyword in node.keywords
+            }
+            args = [Math.eval_(i, locals_, ctx) for i in node.args]
+            try:
+                if isinstance(target_func, FunctionWithCtx):
+                    return target_func(
+                        *args,
+                        ctx=ctx,
+                        **kwargs
+                    )
+                elif isinstance(target_func, ast.Lambda):
+                    call = ast.Call()
+                    call.func = target_func
+
+                    call.keywords = {}
+                    for k, v in kwargs.items():
+                        call.keywords[k] = ast.Constant(v)
+
+                    call.args = []
+                    for i in args:
+                        call.args.append(ast.Constant(i))
+                    return Math.call_lambda(call, locals_, ctx)
+                else:
+                    return target_func(
+                        *args,
+                        **kwargs
+                    )
+            except Exception as exc:
+                _raise_from_eval(exc)  # re-raise exception from inside the "sandbox".
+        else:
+            _raise_from_eval(KeyError(f'Unknown or unsafe function: {target!r}'))
+
+    @staticmethod
+    def call_lambda(node: ast.Call, locals_, ctx):
+        func = node.func
+        args = {}
+        for elem in node.keywords:
+            args[elem.arg] = Math.eval_(elem.value, locals_, ctx)
+
+        for i, elem in enumerate(node.args):
+            if i >= len(func.args.args):
+                _raise_from_eval(TypeError(f'<lambda>() takes {len(func.args.args)} positional arguments but '
+                                           f'{len(node.args) + len(args)} were given'))
+            func_arg = func.args.args[i]
+            if func_arg.arg in args:
+                _raise_from_eval(TypeError(f'<lambda>() got multiple values for argument {func_arg.arg!r}'))
+            args[func_arg.arg] = Math.eval_(elem, locals_, ctx)
+
+        old_arg_values = {}
+        for k, v in locals_.items():
+            if k in args:
+                old_arg_values[k] = v
+        locals_.update(args)
+        ret_val = Math.eval_(node.func.body, locals_=locals_, ctx=ctx)
+        locals_.update(old_arg_values)
+        return ret_val
+
+
+class _NotVectorizable(Exception):
+    """The scalar interpreter has to be used instead of :py:class:`VectorizedLambda`."""
+
+
+class _Column:
+    """
+    Values of an expression for every x. `python` is True for values that would be Python floats in the scalar
+    interpreter (returned by math functions), False for values that would be numpy.float64. The difference matters
+    only for division by zero and overflows, which raise for Python floats.
+    """
+    __slots__ = ('values', 'python')
+
+    def __init__(self, values: numpy.ndarray, python: bool):
+        self.values = values
+        self.python = python
+
+    def elements(self) -> list:
+        return self.values.tolist() if self.python else list(self.values)
+
+
+class VectorizedLambda:
+    """
+    Evaluates a one argument lambda for a whole array of x values at once using NumPy.
+
+    Produces the same values and the same types of errors as calling the lambda using :py:class:`Math` once per
+    element, including the :py:meth:`Math.check_safe` limits. Because every node is evaluated for all elements
+    before moving on, an error can be reported for a different element than the interpreter would report it for.
+    Subexpressions that don't depend on the argument are evaluated once using :py:meth:`Math.eval_`, unsupported
+    subexpressions are interpreted for every element. If the results can't be represented as a float array
+    :py:class:`_NotVectorizable` is raised and the caller has to use the scalar interpreter.
+    """
+
+    operators = {
+        ast.Add: numpy.add,
+        ast.Sub: numpy.subtract,
+        ast.Mult: numpy.multiply,
+        ast.Div: numpy.true_divide,
+        ast.Pow: numpy.power,
+        ast.Mod: numpy.remainder,
+    }
+    # math function -> NumPy equivalent, number of arguments
+    functions = {
+        math.fabs: (numpy.fabs, 1),
+        math.exp: (numpy.exp, 1),
+        math.expm1: (numpy.expm1, 1),
+        math.log: (numpy.log, 1),
+        math.log1p: (numpy.log1p, 1),
+        math.log2: (numpy.log2, 1),
+        math.log10: (numpy.log10, 1),
+        math.pow: (numpy.power, 2),
+        math.sqrt: (numpy.sqrt, 1),
+        math.acos: (numpy.arccos, 1),
+        math.asin: (numpy.arcsin, 1),
+        math.atan: (numpy.arctan, 1),
+        math.atan2: (numpy.arctan2, 2),
+        math.cos: (numpy.cos, 1),
+        math.hypot: (numpy.hypot, 2),
+        math.sin: (numpy.sin, 1),
+        math.degrees: (numpy.degrees, 1),
+        math.radians: (numpy.radians, 1),
+        math.acosh: (numpy.arccosh, 1),
+        math.asinh: (numpy.arcsinh, 1),
+        math.atanh: (numpy.arctanh, 1),
+        math.cosh: (numpy.cosh, 1),
+        math.sinh: (numpy.sinh, 1),
+        math.tanh: (numpy.tanh, 1),
+        abs: (numpy.abs, 1),
+    }
+
+    def __init__(self, func: typing.Union[ast.Lambda, typing.Callable],
+                 max_interpreted_steps: typing.Optional[int] = None):
+        if not isinstance(func, ast.Lambda):
+            # plot(sin, ...)
+            name = next((k for k, v in Math.functions.items() if v is func), None)
+            if name is None:
+                raise _NotVectorizable()
+            func = ast.Lambda(args=ast.arguments(posonlyargs=[], args=[ast.arg('x')], kwonlyargs=[],
+                                                 kw_defaults=[], defaults=[]),
+                              body=ast.Call(func=ast.Name(name), args=[ast.Name('x')], keywords=[]))
+        args = func.args
+        if len(args.args) != 1 or args.posonlyargs or args.vararg or args.kwonlyargs or args.kwarg or args.defaults:
+            raise _NotVectorizable()
+        self.func = func
+        self.argument = args.args[0].arg
+
+        # Names that can have a different value for every x: the argument and everything assigned with :=
+        variables = {self.argument}
+        for node in ast.walk(func.body):
+            if isinstance(node, ast.NamedExpr) and isinstance(node.target, ast.Name):
+                variables.add(node.target.id)
+        variables -= Math.default_locals.keys()
+        self._variables = variables
+        self._constant: typing.Dict[ast.AST, bool] = {}
+        self.max_interpreted_steps = MAX_INTERPRETED_STEPS if max_interpreted_steps is None else max_interpreted_steps
+        self.interpreted_steps = 0
+
+    def _is_constant(self, node: ast.AST) -> bool:
+        constant = self._constant.get(node)
+        if constant is None:
+            constant = self._constant[node] = not any(
+                isinstance(i, ast.NamedExpr) or (isinstance(i, ast.Name) and i.id in self._variables)
+                for i in ast.walk(node)
+            )
+        return constant
+
+    def __call__(self, x: numpy.ndarray, ctx) -> list:
+        if x.dtype != numpy.float64 or not len(x):
+            raise _NotVectorizable()
+        with numpy.errstate(all='ignore'):
+            env = {self.argument: _Column(x, False)}
+            result = self._eval(self.func.body, env, len(x), ctx)
+        if isinstance(result, _Column):
+            return result.values.tolist()
+        return [result] * len(x)
+
+    @staticmethod
+    def _check_number(value):
+        if not isinstance(value, (int, float)):
+            raise _NotVectorizable()
+        try:
+            float(value)
+        except OverflowError:
+            raise _NotVectorizable()
+        return value
+
+    def _vectorized_function(self, node) -> typing.Optional[typing.Tuple[typing.Callable, typing.Callable]]:
+        if not isinstance(node, ast.Call) or not isinstance(node.func, ast.Name) or node.keywords:
+            return None
+        function = Math.functions.get(node.func.id)
+        if not isinstance(function, typing.Hashable) or function not in self.functions:
+            return None
+        ufunc, arity = self.functions[function]
+        if len(node.args) != arity:
+            return None
+        return function, ufunc
+
+    def _eval(self, node, env: dict, n: int, ctx) -> typing.Union[_Column, int, float]:
+        if self._is_constant(node):
+            return self._check_number(Math.eval_(node, {}, ctx))
+        if isinstance(node, ast.Name):
+            if node.id not in env:
+                raise _NotVectorizable()  # used before assignment
+            return env[node.id]
+        elif isinstance(node, ast.NamedExpr):
+            value = env[node.target.id] = self._eval(node.value, env, n, ctx)
+            return value
+        elif isinstance(node, ast.BinOp) and type(node.op) in self.operators:
+            return self._binop(node, self._eval(node.left, env, n, ctx), self._eval(node.right, env, n, ctx))
+        elif isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.USub):
+            operand = self._eval(node.operand, env, n, ctx)
+            return _Column(-operand.values, operand.python)
+        functions = self._vectorized_function(node)
+        if functions is not None:
+            return self._call(*functions, [self._eval(i, env, n, ctx) for i in node.args], n)
+        return self._interpret(node, env, n, ctx)
+
+    def _binop(self, node: ast.BinOp, left, right) -> _Column:
+        lv = left.values if isinstance(left, _Column) else left
+        rv = right.values if isinstance(right, _Column) else right
+        # Same checks as Math.check_safe, max() is spelled out to keep its handling of NaN
+        op = type(node.op)
+        if op is ast.Mult:
+            if numpy.any(numpy.where(rv > lv, rv, lv) > Math.MAX_MULT):
+                _raise_from_eval(UnsafeError(RESULT_TOO_BIG))
+        elif op is ast.Pow:
+            if numpy.any(rv > Math.MAX_POW):
+                _raise_from_eval(UnsafeError(RESULT_TOO_BIG))
+        elif op is ast.Div:
+            smaller = numpy.where(rv > lv, rv, lv)
+            if numpy.any(smaller == 0):
+                raise _NotVectorizable()  # check_safe divides by it
+            if numpy.any((smaller < 1) & (1 / smaller >= Math.MAX_MULT)):
+                _raise_from_eval(UnsafeError(RESULT_TOO_BIG))
+
+        try:
+            values = self.operators[op](lv, rv)
+        except ArithmeticError as e:
+            _raise_from_eval(e)
+        python = all(not isinstance(i, _Column) or i.python for i in (left, right))
+        if python and not numpy.isfinite(values).all():
+            # Python floats raise instead of returning inf or nan, find out what the interpreter would do.
+            function = Math.operators[op]
+            lefts = left.elements() if isinstance(left, _Column) else [left] * len(values)
+            rights = right.elements() if isinstance(right, _Column) else [right] * len(values)
+            try:
+                values = self._to_column([function(a, b) for a, b in zip(lefts, rights)]).values
+            except ArithmeticError as e:
+                _raise_from_eval(e)
+        return _Column(values, python)
+
+    def _call(self, function: typing.Callable, ufunc: typing.Callable, args: list, n: int) -> _Column:
+        arrays = [i.values if isinstance(i, _Column) else i for i in args]
+        if function is abs:
+            # abs() keeps the type of its argument and never raises for floats
+            return _Column(ufunc(*arrays), args[0].python)
+        values = ufunc(*arrays)
+        if not numpy.isfinite(values).all() or not all(numpy.isfinite(i).all() for i in arrays):
+            # math functions raise for arguments outside of their domain, find out which error the interpreter gets
+            columns = [i.elements() if isinstance(i, _Column) else [i] * n for i in args]
+            try:
+                return self._to_column([function(*i) for i in zip(*columns)])
+            except _NotVectorizable:
+                raise
+            except Exception as exc:
+                _raise_from_eval(exc)
+        return _Column(values, True)
+
+    def _interpret(self, node, env: dict, n: int, ctx) -> _Column:
+        if (self.interpreted_steps + n >= self.max_interpreted_steps
+                or any(isinstance(i, ast.NamedExpr) for i in ast.walk(node))):
+            raise _NotVectorizable()
+        self.interpreted_steps += n
+        columns = {k: v.elements() if isinstance(v, _Column) else [v] * n for k, v in env.items()}
+        output = []
+        for i in range(n):
+            output.append(Math.eval_(node, {k: v[i] for k, v in columns.items()}, ctx))
+        return self._to_column(output)
+
+    @staticmethod
+    def _to_column(values: list) -> _Column:
+        if all(type(i) is float for i in values):
+            return _Column(numpy.array(values, dtype=numpy.float64), True)
+        elif all(type(i) is numpy.float64 for i in values):
+            return _Column(numpy.array(values, dtype=numpy.float64), False)
+        raise _NotVectorizable()
+
+
+def _evaluate_on_range(f: typing.Union[ast.Lambda, typing.Callable], x: numpy.ndarray, ctx: Context,
+                       max_interpreted_steps: int) -> typing.Tuple[list, int]:
+    """
+    Evaluate `f` for every element of `x`.
+
+    Returns the values and the number of steps that had to be interpreted one by one, which has to stay below
+    `max_interpreted_steps`.
+    """
+    try:
+        vectorized = VectorizedLambda(f, max_interpreted_steps)
+        return vectorized(x, ctx), vectorized.interpreted_steps
+    except _NotVectorizable:
+        if len(x) >= max_interpreted_steps:
+            _raise_from_eval(ValueError(
+                f'Cannot use more than {MAX_INTERPRETED_STEPS} steps with functions that can\'t be vectorized, '
+                f'your figure would need at least {MAX_INTERPRETED_STEPS - max_interpreted_steps + len(x)}. '
+                f'Lower the accuracy or render less functions at the same time.'
+            ))
+        return [
+            _call(f, x_coord, ctx=ctx)
+            for x_coord in x
+        ], len(x)
+
+
+def evaluate(source: str, user: str) -> typing.Union[str, Plot]:
+    """Evaluate `source` for `user`. Entry point for running the interpreter in a :py:mod:`worker_pool` worker."""
+    ctx = Context()
+    ctx.user = user
+    ctx.source = source
+    return Math.eval_expr(source, ctx)
@@ -0,0 +1,294 @@
+#  This is a simple utility bot
+#  Copyright (C) 2020 Mm2PL
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import asyncio
+import collections
+import time
+import typing
+
+import twitchirc
+
+from util_bot.clients.twitch_connection import AsyncConnection
+
+CONNECT_ATTEMPTS = 6
+MAX_BACKOFF = 30
+CONNECT_TIMEOUT = 15  # connecting and logging in
+STABLE_SESSION = 30  # connections that drop sooner than this after logging in count as failed attempts
+LOGIN_FAILED_NOTICES = ('Login authentication failed', 'Login unsuccessful', 'Improperly formatted auth')
+
+
+class LoginFailed(ConnectionError):
+    """Twitch refused the credentials, trying again with the same ones won't help."""
+
+
+class TokenBucket:
+    """Allows `rate` operations per second on average, with bursts of up to `burst` operations."""
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.last_refill = time.monotonic()
+
+    async def acquire(self):
+        while True:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.last_refill) * self.rate)
+            self.last_refill = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class NukeProgress:
+    """Live counters for a batch of moderation messages sent through a :py:class:`ModerationPool`."""
+
+    def __init__(self, channel: str, total: int):
+        self.channel = channel
+        self.total = total
+        self.sent = 0
+        self.confirmed: typing.Set[str] = set()
+        self.first_sent_at: typing.Optional[float] = None
+        self.started_at = time.monotonic()
+        self.finished_at: typing.Optional[float] = None
+
+    @property
+    def time_to_first(self) -> typing.Optional[float]:
+        if self.first_sent_at is None:
+            return None
+        return self.first_sent_at - self.started_at
+
+    def __str__(self):
+        return f'{len(self.confirmed)} confirmed / {self.sent} sent / {self.total} total'
+
+
+class PooledConnection:
+    def __init__(self, pool: 'ModerationPool', number: int):
+        self.pool = pool
+        self.number = number
+        self.connection: typing.Optional[AsyncConnection] = None
+        self.bucket = TokenBucket(pool.rate, pool.burst)
+        self.ready = asyncio.Event()  # set once Twitch confirmed the login
+        self.task: typing.Optional[asyncio.Task] = None
+        self.failures = 0  # consecutive failed attempts to connect
+
+    async def _login(self) -> AsyncConnection:
+        connection = AsyncConnection(self.pool.address, self.pool.port, message_cooldown=0,
+                                     secure=self.pool.secure)
+        connection.name = str(self.number)
+        try:
+            username, password = self.pool.auth()
+            await connection.aconnect(username, password)
+            connection.cap_reqs(False)
+            while True:
+                if await connection.areceive() == twitchirc.connection.RECONNECT:
+                    raise ConnectionError('Connection closed before logging in')
+                for msg in connection.process_messages(1000):
+                    if isinstance(msg, twitchirc.PingMessage):
+                        connection.force_send(msg.reply())
+                    elif msg.action == 'NOTICE' and msg.new_args and msg.new_args[-1] in LOGIN_FAILED_NOTICES:
+                        raise LoginFailed(f'Moderation connection {self.number}: {msg.new_args[-1]}')
+                    elif msg.action in ('001', 'GLOBALUSERSTATE'):
+                        for channel in self.pool.channels:
+                            connection.join(channel)
+                        return connection
+        except BaseException:
+            await connection.adisconnect()
+            raise
+
+    async def _connect(self):
+        """Log in, backing off between consecutive failed attempts. Raises ConnectionError after giving up."""
+        while True:
+            if self.failures:
+                delay = min(2 ** (self.failures - 1), MAX_BACKOFF)
+                twitchirc.log('warn', f'Moderation connection {self.number} retrying in {delay}s')
+                await asyncio.sleep(delay)
+            try:
+                self.connection = await asyncio.wait_for(self._login(), CONNECT_TIMEOUT)
+            except LoginFailed:
+                raise
+            except (ConnectionError, OSError, asyncio.TimeoutError) as e:
+                self.failures += 1
+                twitchirc.log('warn', f'Moderation connection {self.number} failed to connect: {e!r}')
+                if self.failures >= CONNECT_ATTEMPTS:
+                    raise ConnectionError(f'Unable to open moderation connection after {self.failures} attempts')
+                continue
+            self.ready.set()
+            return
+
+    async def run(self):
+        while True:
+            await self._connect()
+            logged_in_at = time.monotonic()
+            reconnect = False
+            while not reconnect:
+                if await self.connection.areceive() == twitchirc.connection.RECONNECT:
+                    break
+                for msg in self.connection.process_messages(1000):
+                    if isinstance(msg, twitchirc.PingMessage):
+                        self.connection.force_send(msg.reply())
+                    elif isinstance(msg, twitchirc.ReconnectMessage):
+                        reconnect = True
+                    elif msg.action == 'CLEARCHAT' and len(msg.new_args) == 2:
+                        self.pool.on_clearchat(msg.new_args[0].lstrip('#'), msg.new_args[1])
+            self.ready.clear()
+            connection = self.connection
+            self.connection = None
+            await connection.adisconnect()
+            if reconnect or time.monotonic() - logged_in_at >= STABLE_SESSION:
+                self.failures = 0
+            else:
+                self.failures += 1  # dropped right after logging in, don't hammer the server
+
+    async def send(self, message):
+        """Send `message`, waiting for the connection to come back if needed. Raises ConnectionError if it won't."""
+        await self.bucket.acquire()
+        while True:
+            if not self.ready.is_set():
+                ready = asyncio.ensure_future(self.ready.wait())
+                await asyncio.wait((ready, self.task), return_when=asyncio.FIRST_COMPLETED)
+                if not ready.done():
+                    # run() gave up reconnecting
+                    ready.cancel()
+                    raise ConnectionError(f'Moderation connection {self.number} is gone')
+            connection = self.connection
+            try:
+                await connection.wait_writable()
+            except ConnectionError:
+                self.ready.clear()  # run() reconnects as soon as reading from the connection fails
+                continue
+            connection.force_send(message)
+            return
+
+
+class ModerationPool:
+    """
+    Warm pool of authenticated connections used to send moderation commands in bulk.
+
+    Connections stay joined to :py:attr:`channels` and every one of them watches for CLEARCHAT, so sent timeouts
+    and bans can be counted as confirmed without a separate receiving connection. Every connection has its own token
+    bucket, writes are pipelined by :py:class:`AsyncConnection`.
+    """
+
+    def __init__(self, address: str, port: int, secure: bool, auth: typing.Callable[[], typing.Tuple[str, str]],
+                 rate: float, burst: float = 5):
+        self.address = address
+        self.port = port
+        self.secure = secure
+        self.auth = auth
+        self.rate = rate
+        self.burst = burst
+        self.connections: typing.List[PooledConnection] = []
+        self.channels: typing.Set[str] = set()
+        self.progress: typing.Dict[str, NukeProgress] = {}
+
+    async def resize(self, size: int):
+        """
+        Open new connections until there are at least `size` of them and wait until they are ready.
+
+        Connections that can't be opened are dropped, the batch goes out over the rest.
+
+        :raises ConnectionError: if no connection could be opened.
+        """
+        self.connections = [i for i in self.connections if not i.task.done()]  # drop the ones that gave up
+        while len(self.connections) < size:
+            conn = PooledConnection(self, len(self.connections))
+            conn.task = asyncio.create_task(conn.run())
+            conn.task.add_done_callback(self._connection_done)
+            self.connections.append(conn)
+        error = None
+        for conn in self.connections[:size]:
+            if conn.ready.is_set():
+                continue
+            ready = asyncio.ensure_future(conn.ready.wait())
+            await asyncio.wait((ready, conn.task), return_when=asyncio.FIRST_COMPLETED)
+            if not ready.done():
+                ready.cancel()
+                error = conn.task.exception()  # the reason why the connection couldn't be opened
+        self.connections = [i for i in self.connections if not i.task.done()]
+        if not self.connections and error is not None:
+            raise error
+
+    @staticmethod
+    def _connection_done(task: asyncio.Task):
+        if not task.cancelled() and task.exception() is not None:
+            twitchirc.log('warn', f'Moderation connection gave up: {task.exception()!r}')
+
+    def join(self, channel: str):
+        if channel in self.channels:
+            return
+        self.channels.add(channel)
+        for i in self.connections:
+            if i.connection is not None:
+                i.connection.join(channel)
+
+    def part(self, channel: str):
+        if channel not in self.channels:
+            return
+        self.channels.discard(channel)
+        for i in self.connections:
+            if i.connection is not None:
+                i.connection.part(channel)
+
+    def on_clearchat(self, channel: str, user: str):
+        progress = self.progress.get(channel)
+        if progress is not None:
+            progress.confirmed.add(user)
+
+    async def send_batch(self, channel: str, messages: list, connections: int,
+                         kill_switch: typing.Optional[asyncio.Event] = None) -> NukeProgress:
+        """
+        Send `messages` to `channel` using `connections` connections from the pool.
+
+        :return: Progress of the batch, it is updated live while the batch is being sent and stays available in
+        :py:attr:`progress` until the next batch is sent to the same channel.
+        """
+        self.join(channel)
+        await self.resize(connections)
+        progress = NukeProgress(channel, len(messages))
+        self.progress[channel] = progress
+        queue = collections.deque(messages)
+
+        async def _sender(conn: PooledConnection):
+            while queue:
+                if kill_switch is not None and kill_switch.is_set():
+                    return
+                msg = queue.popleft()
+                try:
+                    await conn.send(msg)
+                except ConnectionError:
+                    queue.appendleft(msg)  # let a connection that still works send it
+                    return
+                if progress.first_sent_at is None:
+                    progress.first_sent_at = time.monotonic()
+                progress.sent += 1
+
+        while queue and not (kill_switch is not None and kill_switch.is_set()):
+            alive = [i for i in self.connections[:connections] if not i.task.done()]
+            if not alive:
+                twitchirc.log('warn', f'All moderation connections died, {len(queue)} messages to {channel} '
+                                      f'were not sent')
+                break
+            await asyncio.gather(*(_sender(conn) for conn in alive))
+        progress.finished_at = time.monotonic()
+        return progress
+
+    async def close(self):
+        for i in self.connections:
+            i.task.cancel()
+            if i.connection is not None:
+                await i.connection.adisconnect()
+        self.connections.clear()
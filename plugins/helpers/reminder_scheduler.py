@@ -0,0 +1,265 @@
+#  This is a simple utility bot
+#  Copyright (C) 2021 Mm2PL
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import asyncio
+import heapq
+import itertools
+import time
+import typing
+
+import sqlalchemy
+import twitchirc
+
+FLUSH_INTERVAL = 5
+WRITE_BATCH_SIZE = 1000
+MIN_COMPACT_SIZE = 64
+# A reminder that fails to save this many times in a row is no longer retried
+MAX_WRITE_ATTEMPTS = 20
+
+
+class ScheduledReminder:
+    __slots__ = ('id', 'channel', 'user', 'text', 'seconds', 'due', 'recurring', 'cancelled', 'persisted')
+
+    def __init__(self, id_: int, channel: str, user: str, text: str, seconds: int, due: float, recurring: bool):
+        self.id = id_
+        self.channel = channel
+        self.user = user
+        self.text = text
+        self.seconds = seconds
+        self.due = due
+        self.recurring = recurring
+        self.cancelled = False
+        self.persisted = False
+
+    def __repr__(self):
+        return f'<ScheduledReminder {self.id} for {self.user} in {self.channel} due {self.due}>'
+
+    def to_row(self) -> dict:
+        return {
+            'b_id': self.id,
+            'channel': self.channel,
+            'user': self.user,
+            'text': self.text,
+            'seconds': self.seconds,
+            'due': self.due,
+            'recurring': self.recurring
+        }
+
+
+class ReminderScheduler:
+    """
+    Keeps pending reminders in a heap ordered by due time.
+
+    One task (:py:meth:`run`) sleeps until the earliest reminder is due, adding an earlier reminder wakes it up.
+    Cancelled reminders stay in the heap until they reach the top or the heap gets compacted, so both adding and
+    cancelling are O(log n). Recurring reminders are rescheduled in place.
+
+    If `table` is given, changes are written to it in batches by :py:meth:`run_writer`, changes made to the same
+    reminder in between are coalesced. When a batch fails its reminders are saved one by one, the ones that still
+    fail are retried with the next batch and given up on after `MAX_WRITE_ATTEMPTS`.
+
+    :param callback: Called with every reminder that is due.
+    """
+
+    def __init__(self, callback: typing.Callable[[ScheduledReminder], typing.Any], table=None, session_scope=None,
+                 flush_interval: float = FLUSH_INTERVAL):
+        self.callback = callback
+        self.table = table
+        self.session_scope = session_scope
+        self.flush_interval = flush_interval
+
+        self.by_channel: typing.Dict[str, typing.Dict[int, ScheduledReminder]] = {}
+        self._heap: typing.List[typing.Tuple[float, int, ScheduledReminder]] = []
+        self._sequence = itertools.count()
+        self._cancelled_in_heap = 0
+        self._next_id = 1
+        self._wake = asyncio.Event()
+
+        self._dirty: typing.Dict[int, ScheduledReminder] = {}
+        self._dirty_event = asyncio.Event()
+        self._write_attempts: typing.Dict[int, int] = {}
+
+        self.fired = 0
+        self.writes = 0
+        self.failed_writes = 0
+
+    def __len__(self):
+        return len(self._heap) - self._cancelled_in_heap
+
+    def _mark_dirty(self, reminder: ScheduledReminder):
+        if self.table is None:
+            return
+        self._dirty[reminder.id] = reminder
+        self._dirty_event.set()
+
+    def _push(self, reminder: ScheduledReminder):
+        if not self._heap or reminder.due < self._heap[0][0]:
+            self._wake.set()
+        heapq.heappush(self._heap, (reminder.due, next(self._sequence), reminder))
+        self.by_channel.setdefault(reminder.channel, {})[reminder.id] = reminder
+
+    def add(self, channel: str, user: str, text: str, seconds: int, recurring: bool = False,
+            due: typing.Optional[float] = None) -> ScheduledReminder:
+        reminder = ScheduledReminder(self._next_id, channel, user, text, seconds,
+                                     due if due is not None else time.time() + seconds, recurring)
+        self._next_id += 1
+        self._push(reminder)
+        self._mark_dirty(reminder)
+        return reminder
+
+    def _forget(self, reminder: ScheduledReminder):
+        reminder.cancelled = True
+        channel = self.by_channel.get(reminder.channel)
+        if channel is not None:
+            channel.pop(reminder.id, None)
+            if not channel:
+                del self.by_channel[reminder.channel]
+        self._mark_dirty(reminder)
+
+    def cancel(self, reminder: ScheduledReminder):
+        if reminder.cancelled:
+            return
+        self._forget(reminder)
+        self._cancelled_in_heap += 1
+        if self._cancelled_in_heap > MIN_COMPACT_SIZE and self._cancelled_in_heap > len(self._heap) // 2:
+            self._heap = [entry for entry in self._heap if not entry[2].cancelled]
+            heapq.heapify(self._heap)
+            self._cancelled_in_heap = 0
+
+    def in_channel(self, channel: str) -> typing.List[ScheduledReminder]:
+        return sorted(self.by_channel.get(channel, {}).values(), key=lambda r: r.due)
+
+    def next_due(self) -> typing.Optional[float]:
+        while self._heap and self._heap[0][2].cancelled:
+            heapq.heappop(self._heap)
+            self._cancelled_in_heap -= 1
+        return self._heap[0][0] if self._heap else None
+
+    def fire_due(self, now: typing.Optional[float] = None):
+        if now is None:
+            now = time.time()
+        while True:
+            due = self.next_due()
+            if due is None or due > now:
+                return
+            _, sequence, reminder = self._heap[0]
+            if reminder.recurring:
+                reminder.due = now + reminder.seconds
+                heapq.heapreplace(self._heap, (reminder.due, sequence, reminder))
+                self._mark_dirty(reminder)
+            else:
+                heapq.heappop(self._heap)
+                self._forget(reminder)
+            self.fired += 1
+            try:
+                self.callback(reminder)
+            except Exception as e:
+                twitchirc.log('err', f'Reminder callback failed for {reminder!r}: {e!r}')
+
+    async def run(self):
+        while True:
+            self._wake.clear()
+            due = self.next_due()
+            delay = None if due is None else max(due - time.time(), 0)
+            try:
+                await asyncio.wait_for(self._wake.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+            self.fire_due()
+
+    def _read(self):
+        with self.session_scope() as session:
+            return session.execute(sqlalchemy.select(self.table)).fetchall()
+
+    async def load(self):
+        """Schedule the reminders saved in `table`."""
+        rows = await asyncio.get_event_loop().run_in_executor(None, self._read)
+        for row in rows:
+            reminder = ScheduledReminder(row.id, row.channel, row.user, row.text, row.seconds, row.due,
+                                         row.recurring)
+            reminder.persisted = True
+            self._next_id = max(self._next_id, row.id + 1)
+            self._push(reminder)
+
+    def _write(self, batch: typing.List[ScheduledReminder]):
+        table = self.table
+        deleted = [r.id for r in batch if r.cancelled]
+        inserted = [r.to_row() for r in batch if not r.cancelled and not r.persisted]
+        updated = [r.to_row() for r in batch if not r.cancelled and r.persisted]
+        with self.session_scope() as session:
+            if deleted:
+                session.execute(table.delete().where(table.c.id.in_(deleted)))
+            if inserted:
+                session.execute(table.insert().values(id=sqlalchemy.bindparam('b_id')), inserted)
+            if updated:
+                session.execute(
+                    table.update()
+                    .where(table.c.id == sqlalchemy.bindparam('b_id'))
+                    .values(due=sqlalchemy.bindparam('due')),
+                    [{'b_id': row['b_id'], 'due': row['due']} for row in updated]
+                )
+
+    def _write_each(self, batch: typing.List[ScheduledReminder]) -> typing.List[ScheduledReminder]:
+        """Write reminders one at a time, returns the ones that failed."""
+        failed = []
+        for reminder in batch:
+            try:
+                self._write([reminder])
+            except Exception as e:
+                twitchirc.log('debug', f'Failed to save {reminder!r}: {e!r}')
+                failed.append(reminder)
+        return failed
+
+    def _take_dirty(self) -> typing.List[ScheduledReminder]:
+        ids = list(itertools.islice(self._dirty, WRITE_BATCH_SIZE))
+        return [self._dirty.pop(i) for i in ids]
+
+    async def flush(self):
+        loop = asyncio.get_event_loop()
+        while self._dirty:
+            batch = self._take_dirty()
+            try:
+                await loop.run_in_executor(None, self._write, batch)
+                self.writes += 1
+                failed = []
+            except Exception as e:
+                self.failed_writes += 1
+                twitchirc.log('err', f'Failed to save {len(batch)} reminders: {e!r}')
+                failed = await loop.run_in_executor(None, self._write_each, batch)
+            failed_ids = {r.id for r in failed}
+            for reminder in batch:
+                if reminder.id not in failed_ids:
+                    if not reminder.cancelled:
+                        reminder.persisted = True
+                    self._write_attempts.pop(reminder.id, None)
+                    continue
+                attempts = self._write_attempts.get(reminder.id, 0) + 1
+                if attempts >= MAX_WRITE_ATTEMPTS:
+                    twitchirc.log('err', f'Giving up on saving {reminder!r} after {attempts} attempts')
+                    self._write_attempts.pop(reminder.id, None)
+                    continue
+                self._write_attempts[reminder.id] = attempts
+                self._dirty.setdefault(reminder.id, reminder)
+            if failed:
+                return  # the rest is retried on the next flush
+
+    async def run_writer(self):
+        while True:
+            await self._dirty_event.wait()
+            await asyncio.sleep(self.flush_interval)  # collect changes made in the meantime into one write
+            self._dirty_event.clear()
+            await self.flush()
+            if self._dirty:
+                self._dirty_event.set()
@@ -0,0 +1,235 @@
+#  This is a simple utility bot
+#  Copyright (C) 2020 Mm2PL
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import asyncio
+import collections
+import math
+import multiprocessing
+import multiprocessing.connection
+import os
+import pickle
+import signal
+import typing
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+import twitchirc
+
+
+class QueueFull(Exception):
+    """Raised by :py:meth:`WorkerPool.submit` when the queue or the user's share of it is full."""
+
+
+class WorkerTimeout(Exception):
+    """The job took longer than the pool's time limit, the worker running it was killed."""
+
+
+class WorkerCrashed(Exception):
+    """The worker died while running the job, usually because it went over the CPU time or memory limit."""
+
+
+def _set_cpu_limit(seconds: int):
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    _, hard = resource.getrlimit(resource.RLIMIT_CPU)
+    soft = math.ceil(usage.ru_utime + usage.ru_stime) + seconds
+    if hard != resource.RLIM_INFINITY:
+        soft = min(soft, hard)
+    resource.setrlimit(resource.RLIMIT_CPU, (soft, hard))
+
+
+def _worker_main(conn: multiprocessing.connection.Connection, cpu_seconds: int, memory_bytes: int):
+    # Started from the fork server, don't inherit where it sends signal wakeups and leave Ctrl+C to the bot.
+    signal.set_wakeup_fd(-1)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    os.nice(10)
+    if resource is not None:
+        resource.setrlimit(resource.RLIMIT_AS, (memory_bytes, memory_bytes))
+    while True:
+        try:
+            func, args = conn.recv()
+        except EOFError:
+            return
+        if resource is not None:
+            # RLIMIT_CPU counts the lifetime of the process, every job gets `cpu_seconds` more than it used so far.
+            _set_cpu_limit(cpu_seconds)
+        try:
+            result = (True, func(*args))
+        except Exception as e:
+            result = (False, e)
+        try:
+            conn.send(result)
+        except (pickle.PicklingError, TypeError, AttributeError):
+            conn.send((False, RuntimeError(f'Unable to send back result: {result[1]!r}')))
+
+
+class _Job(typing.NamedTuple):
+    user: str
+    func: typing.Callable
+    args: tuple
+    timeout: float
+    future: asyncio.Future
+
+
+class _Worker:
+    def __init__(self, pool: 'WorkerPool'):
+        self.pool = pool
+        self.conn, child_conn = pool.context.Pipe()
+        self.process = pool.context.Process(target=_worker_main,
+                                            args=(child_conn, pool.cpu_seconds, pool.memory_bytes),
+                                            daemon=True)
+        self.process.start()
+        child_conn.close()
+
+    def kill(self):
+        self.process.kill()
+        self.process.join()
+        self.conn.close()
+
+    async def run(self, job: _Job):
+        loop = asyncio.get_event_loop()
+        readable = loop.create_future()
+        self.conn.send((job.func, job.args))
+        loop.add_reader(self.conn.fileno(), lambda: readable.done() or readable.set_result(None))
+        try:
+            await asyncio.wait_for(readable, job.timeout)
+        finally:
+            loop.remove_reader(self.conn.fileno())
+        try:
+            return self.conn.recv()
+        except EOFError:
+            self.process.join()
+            raise WorkerCrashed(f'Worker exited with code {self.process.exitcode}')
+
+
+class WorkerPool:
+    """
+    Pool of pre-forked processes running jobs with CPU time, memory and wall clock limits.
+
+    Jobs wait in a bounded queue. Users take turns, a user who submits a lot of jobs only gets one of them
+    started for every job of each other waiting user. Workers that go over a limit are killed and replaced.
+    Jobs are module level functions, their arguments and results have to be picklable.
+
+    Workers are forked from a multiprocessing fork server instead of the bot itself: a fork of the multithreaded bot
+    could inherit locks held by its other threads. The server imports `preload` once, so workers start with the
+    modules their jobs need already loaded.
+    """
+
+    def __init__(self, size: int, queue_size: int = 20, per_user: int = 3, timeout: float = 15,
+                 cpu_seconds: int = 10, memory_bytes: int = 1024 ** 3, preload: typing.Sequence[str] = ()):
+        self.size = size
+        self.queue_size = queue_size
+        self.per_user = per_user
+        self.timeout = timeout
+        self.cpu_seconds = cpu_seconds
+        self.memory_bytes = memory_bytes
+        self.context = multiprocessing.get_context('forkserver')
+        self.context.set_forkserver_preload([__name__, *preload])
+
+        self._idle: typing.List[_Worker] = []
+        self._busy: typing.Set[_Worker] = set()
+        self._waiting: typing.OrderedDict[str, typing.Deque[_Job]] = collections.OrderedDict()
+        self._queued = 0
+
+    def start(self):
+        while len(self._idle) + len(self._busy) < self.size:
+            self._idle.append(_Worker(self))
+
+    def close(self):
+        for worker in self._idle + list(self._busy):
+            worker.kill()
+        self._idle.clear()
+        self._busy.clear()
+        for jobs in self._waiting.values():
+            for job in jobs:
+                job.future.cancel()
+        self._waiting.clear()
+        self._queued = 0
+
+    @property
+    def queued(self) -> int:
+        return self._queued
+
+    def submit(self, user: str, func: typing.Callable, *args,
+               timeout: typing.Optional[float] = None) -> asyncio.Future:
+        """
+        Queue `func(*args)` to be run in a worker.
+
+        :param timeout: Wall clock limit for this job, defaults to the pool's :py:attr:`timeout`.
+        :return: Future resolving to the return value of `func` or raising the exception it raised.
+        :raises QueueFull: if the queue is full or `user` already has `per_user` jobs waiting.
+        """
+        jobs = self._waiting.get(user)
+        if self._queued >= self.queue_size or (jobs is not None and len(jobs) >= self.per_user):
+            raise QueueFull()
+        if jobs is None:
+            jobs = self._waiting[user] = collections.deque()
+        future = asyncio.get_event_loop().create_future()
+        jobs.append(_Job(user, func, args, timeout if timeout is not None else self.timeout, future))
+        self._queued += 1
+        self._dispatch()
+        return future
+
+    def _next_job(self) -> typing.Optional[_Job]:
+        while self._waiting:
+            user, jobs = next(iter(self._waiting.items()))
+            job = jobs.popleft()
+            if jobs:
+                self._waiting.move_to_end(user)
+            else:
+                del self._waiting[user]
+            self._queued -= 1
+            if not job.future.cancelled():
+                return job
+        return None
+
+    def _dispatch(self):
+        while self._idle:
+            job = self._next_job()
+            if job is None:
+                return
+            worker = self._idle.pop()
+            self._busy.add(worker)
+            asyncio.create_task(self._run(worker, job))
+
+    async def _run(self, worker: _Worker, job: _Job):
+        error = None
+        try:
+            ok, result = await worker.run(job)
+        except asyncio.TimeoutError:
+            error = WorkerTimeout(f'Job took longer than {job.timeout} seconds')
+        except (WorkerCrashed, OSError) as e:
+            twitchirc.log('warn', f'Worker process died: {e!r}')
+            error = e if isinstance(e, WorkerCrashed) else WorkerCrashed(repr(e))
+        except Exception as e:
+            # usually the job or its result couldn't be pickled, restart the worker in case it's out of sync
+            twitchirc.log('warn', f'Unable to run job in worker: {e!r}')
+            error = e
+        self._busy.discard(worker)
+        if error is not None:
+            worker.kill()
+            worker = _Worker(self)
+        self._idle.append(worker)
+
+        if not job.future.done():
+            if error is not None:
+                job.future.set_exception(error)
+            elif ok:
+                job.future.set_result(result)
+            else:
+                job.future.set_exception(result)
+        self._dispatch()
@@ -0,0 +1,30 @@
+#  This is a simple utility bot
+#  Copyright (C) 2021 Mm2PL
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import sqlalchemy
+
+
+def get(Base):
+    class Reminder(Base):
+        __tablename__ = 'reminders'
+        id = sqlalchemy.Column(sqlalchemy.Integer, primary_key=True, autoincrement=False)
+        channel = sqlalchemy.Column(sqlalchemy.Text, nullable=False)
+        user = sqlalchemy.Column(sqlalchemy.Text, nullable=False)
+        text = sqlalchemy.Column(sqlalchemy.UnicodeText, nullable=False)
+        seconds = sqlalchemy.Column(sqlalchemy.Integer, nullable=False)
+        due = sqlalchemy.Column(sqlalchemy.Float, nullable=False)  # unix timestamp
+        recurring = sqlalchemy.Column(sqlalchemy.Boolean, nullable=False, default=False)
+
+    return Reminder
@@ -13,7 +13,10 @@
 #
 #  You should have received a copy of the GNU General Public License
 #  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import asyncio
+import collections
 import datetime
+import heapq
 import json
 import threading
 import time
@@ -22,12 +25,17 @@ import typing
 import sqlalchemy
 import twitchirc
 from sqlalchemy.orm import reconstructor
+from sqlalchemy.orm.attributes import set_committed_value
 from twitchirc import ChannelMessage
 
 from util_bot.utils import deprecated
 import util_bot
 
 CACHE_EXPIRE_TIME = 15 * 60
+CACHE_MAX_SIZE = 20_000
+FLUSH_BATCH_SIZE = 500
+FLUSH_INTERVAL = 1
+UNKNOWN_USERNAME = '<UNKNOWN_USERNAME>'
 
 
 def _is_pleb(msg: twitchirc.ChannelMessage) -> bool:
@@ -39,11 +47,135 @@ def _is_pleb(msg: twitchirc.ChannelMessage) -> bool:
     return True
 
 
+class UserCache:
+    """
+    Cache of User objects keyed by their local id.
+
+    Secondary indexes allow looking users up by Twitch id and by lowercased username without scanning the cache.
+    Entries expire `expire_time` seconds after being added, expiry is driven by a heap of deadlines so that each
+    call to :py:meth:`expire` only touches entries that actually expired. The cache holds at most `max_size`
+    entries, least recently used ones are evicted first.
+    """
+
+    def __init__(self, max_size: int = CACHE_MAX_SIZE, expire_time: float = CACHE_EXPIRE_TIME):
+        self.max_size = max_size
+        self.expire_time = expire_time
+
+        # local id -> (expires, obj), most recently used last
+        self._entries: typing.OrderedDict[int, typing.Tuple[float, typing.Any]] = collections.OrderedDict()
+        self._by_twitch_id: typing.Dict[int, int] = {}
+        self._by_name: typing.Dict[str, typing.Set[int]] = {}
+        self._deadlines: typing.List[typing.Tuple[float, int]] = []
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, local_id):
+        return local_id in self._entries
+
+    def add(self, obj) -> bool:
+        """Add `obj` to the cache. Returns False if an object with the same id is already cached."""
+        if obj.id in self._entries:
+            return False
+        expires = time.time() + self.expire_time
+        self._entries[obj.id] = (expires, obj)
+        if obj.twitch_id is not None:
+            self._by_twitch_id[int(obj.twitch_id)] = obj.id
+        if obj.last_known_username:
+            self._by_name.setdefault(obj.last_known_username.lower(), set()).add(obj.id)
+        heapq.heappush(self._deadlines, (expires, obj.id))
+
+        while len(self._entries) > self.max_size:
+            self.remove(next(iter(self._entries)))
+            self.evictions += 1
+        return True
+
+    def remove(self, local_id: int):
+        _, obj = self._entries.pop(local_id)
+        if obj.twitch_id is not None and self._by_twitch_id.get(int(obj.twitch_id)) == local_id:
+            del self._by_twitch_id[int(obj.twitch_id)]
+        if obj.last_known_username:
+            ids = self._by_name.get(obj.last_known_username.lower())
+            if ids is not None:
+                ids.discard(local_id)
+                if not ids:
+                    del self._by_name[obj.last_known_username.lower()]
+
+    def expire(self, now: typing.Optional[float] = None):
+        if now is None:
+            now = time.time()
+        while self._deadlines and self._deadlines[0][0] < now:
+            expires, local_id = heapq.heappop(self._deadlines)
+            entry = self._entries.get(local_id)
+            # deadlines of evicted or re-added entries are left in the heap, ignore them
+            if entry is not None and entry[0] == expires:
+                self.remove(local_id)
+                self.expirations += 1
+
+    def clear(self):
+        self._entries.clear()
+        self._by_twitch_id.clear()
+        self._by_name.clear()
+        self._deadlines.clear()
+
+    def _hit(self, local_id: int):
+        self._entries.move_to_end(local_id)
+        self.hits += 1
+        return self._entries[local_id][1]
+
+    def get(self, local_id: int):
+        self.expire()
+        if local_id in self._entries:
+            return self._hit(local_id)
+        self.misses += 1
+        return None
+
+    def get_by_twitch_id(self, twitch_id: int):
+        self.expire()
+        local_id = self._by_twitch_id.get(twitch_id)
+        if local_id is not None:
+            obj = self._entries[local_id][1]
+            if obj.twitch_id is not None and int(obj.twitch_id) == twitch_id:
+                return self._hit(local_id)
+        self.misses += 1
+        return None
+
+    def find_by_name(self, name: str) -> list:
+        """Return cached users whose last known username is `name`, case-insensitive."""
+        self.expire()
+        name = name.lower()
+        output = []
+        for local_id in self._by_name.get(name, ()):
+            obj = self._entries[local_id][1]
+            if obj.last_known_username and obj.last_known_username.lower() == name:
+                output.append(obj)
+        return output
+
+    def rename(self, obj, old_name: typing.Optional[str]):
+        """Update the username index after `obj.last_known_username` was changed from `old_name`."""
+        if obj.id not in self._entries:
+            return
+        if old_name:
+            ids = self._by_name.get(old_name.lower())
+            if ids is not None:
+                ids.discard(obj.id)
+                if not ids:
+                    del self._by_name[old_name.lower()]
+        if obj.last_known_username:
+            self._by_name.setdefault(obj.last_known_username.lower(), set()).add(obj.id)
+
+
 modified_users: typing.Dict[int, typing.Dict[str, typing.Union[datetime.datetime, int, ChannelMessage]]] = {
     # base_id
     # 123: {
     #     'last_active': datetime.datetime.now(),
     #     'msg': twitchirc.ChannelMessage(),
+    #     'user': User,
     #     'expire_time': time.time() + CACHE_EXPIRE_TIME
     # }
 }
@@ -52,36 +184,18 @@ modified_users: typing.Dict[int, typing.Dict[str, typing.Union[datetime.datetime
 # noinspection PyPep8Naming
 def get(Base, session_scope, log):
     class UserMeta(Base.__class__):
-        cache: typing.Dict[int, typing.Dict[str, typing.Union[float, typing.Any]]] = {
-            # 123: {
-            #     'expires': time.time() +CACHE_EXPIRE_TIME,
-            #     'obj': User
-            # }
-        }
+        cache = UserCache()
 
         def expire_caches(self):
-            # print('expire caches')
-            current_time = time.time()
-            for obj_id, obj_data in self.cache.copy().items():
-                if obj_data['expires'] < current_time:
-                    # print(obj_id, 'expired', obj_data)
-                    del self.cache[obj_id]
+            self.cache.expire()
 
         def add_to_cache(self, obj):
-            if obj.id in self.cache:
+            if not self.cache.add(obj):
                 print(f'[failed] Add to cache {obj}')
-                return
-            # print(f'Add to cache {obj}')
-            # print(self.cache)
-            self.cache[obj.id] = {
-                'expires': time.time() + CACHE_EXPIRE_TIME,
-                'obj': obj
-            }
 
         def empty_cache(self):
             self.cache.clear()
 
-
     class User(Base, metaclass=UserMeta):
         __tablename__ = 'users'
         id = sqlalchemy.Column(sqlalchemy.Integer, primary_key=True)
@@ -118,15 +232,13 @@ def get(Base, session_scope, log):
 
         @staticmethod
         def _get_by_message(msg, no_create, session):
-            User.expire_caches()
             # print(f'get by message {msg}')
             # if (hasattr(msg, 'platform') and msg.platform.name == 'TWITCH') or not hasattr(msg, 'platform'):
             if isinstance(msg, (util_bot.StandardizedMessage,
                                 util_bot.StandardizedWhisperMessage)) and msg.platform == util_bot.Platform.TWITCH:
-                for obj_id, obj_data in User.cache.items():
-                    if obj_data['obj'].twitch_id == int(msg.flags['user-id']):
-                        # print(f'load from cache {obj_data}')
-                        return obj_data['obj']
+                cached = User.cache.get_by_twitch_id(int(msg.flags['user-id']))
+                if cached is not None:
+                    return cached
 
                 user: User = (session.query(User)
                               .filter(User.twitch_id == msg.flags['user-id'])
@@ -165,10 +277,9 @@ def get(Base, session_scope, log):
 
         @staticmethod
         def get_by_twitch_id(id_: int, session=None):
-            User.expire_caches()
-            for obj_id, obj_data in User.cache.items():
-                if obj_data['obj'].twitch_id == id_:
-                    return obj_data['obj']
+            cached = User.cache.get_by_twitch_id(id_)
+            if cached is not None:
+                return cached
 
             if session:
                 return User._get_by_twitch_id(id_, session)
@@ -185,9 +296,9 @@ def get(Base, session_scope, log):
 
         @staticmethod
         def get_by_local_id(id_: int, s=None):
-            User.expire_caches()
-            if id_ in User.cache:
-                return User.cache[id_]['obj']
+            cached = User.cache.get(id_)
+            if cached is not None:
+                return cached
 
             if s is None:
                 with session_scope() as session:
@@ -220,7 +331,7 @@ def get(Base, session_scope, log):
                 other_users = User.get_by_name(msg.user)
                 for user in other_users:
                     user: User
-                    user.last_known_username = '<UNKNOWN_USERNAME>'
+                    user.last_known_username = UNKNOWN_USERNAME
                     session.add(user)
 
         def update(self, update, s=None):
@@ -247,6 +358,7 @@ def get(Base, session_scope, log):
                 modified_users[self.id] = {
                     'last_active': datetime.datetime.now(),
                     'msg': msg,
+                    'user': self,
                     'expire_time': (time.time() + 10) if has_state_change else (time.time() + CACHE_EXPIRE_TIME)
                 }
 
@@ -264,46 +376,155 @@ def get(Base, session_scope, log):
             return f'<User {self.last_known_username}, alias {self.id}>'
 
 
-    def _update_users(to_update):
-        try:
-            with session_scope() as session:
-                for db_id, update in to_update.copy().items():
-                    log('debug', db_id, 'updating dankCircle')
-                    if db_id is None:
-                        log('debug', 'create new')
-                        user = User.get_by_message(update['msg'])
-                        user.update(update, session)
-                        continue
-
-                    user = User.get_by_local_id(db_id)
-                    user.update(update, session)
-            log('debug', 'Deleting to_updates.')
-            for db_id in to_update:
-                del modified_users[db_id]
-        finally:
-            log('debug', 'release lock.')
-            users_lock.release()
+    return User, UserWriter(User, session_scope, log)
+
+
+users_lock = threading.Lock()
 
-    def flush_users():
-        if users_lock.locked():
-            return
-        users_lock.acquire()
-        current_time = int(time.time())
-        to_update = {}
-        for db_id, user in modified_users.copy().items():
-            if user['expire_time'] <= current_time:
-                log('debug', f'flush user {db_id}')
-                to_update[db_id] = user
-        if to_update:
-            log('debug', f'users cache is of length {len(modified_users)}, {len(to_update)} are going to be '
-                         f'removed from the cache.')
 
-            t = threading.Thread(target=_update_users, args=(to_update,), kwargs={})
-            t.start()
-        else:
-            users_lock.release()
+class UserWriter:
+    """
+    Writes users modified by `User.schedule_update` to the database.
+
+    A single long-lived task (:py:meth:`run`) wakes up every `flush_interval` seconds and takes users whose
+    updates are due from `modified_users`, at most `batch_size` at a time. Each batch is written in one transaction
+    using a couple of bulk UPDATE statements executed in the default executor, so the event loop is not blocked.
+    Updates to the same user are coalesced, only the newest one is kept.
+
+    Calling the object flushes due users synchronously, this is used when the event loop isn't running anymore.
+    """
+
+    def __init__(self, user_class, session_scope, log, batch_size: int = FLUSH_BATCH_SIZE,
+                 flush_interval: float = FLUSH_INTERVAL):
+        self.User = user_class
+        self.session_scope = session_scope
+        self.log = log
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+
+        self.flushes = 0
+        self.flushed_users = 0
+        self.failed_flushes = 0
+        self.last_flush_latency = 0.0
+
+    @property
+    def queue_depth(self) -> int:
+        return len(modified_users)
+
+    def _take_due(self, force=False) -> typing.List[typing.Dict[str, typing.Any]]:
+        """Remove up to `batch_size` due updates from `modified_users` and snapshot what should be written."""
+        current_time = time.time()
+        batch = []
+        with users_lock:
+            for db_id, update in list(modified_users.items()):
+                if len(batch) >= self.batch_size:
+                    break
+                if not force and update['expire_time'] > current_time:
+                    continue
+                del modified_users[db_id]
+                msg = update['msg']
+                user = update['user']
+                is_twitch = not hasattr(msg, 'platform') or msg.platform.name == 'TWITCH'
+                batch.append({
+                    'update': update,
+                    'user': user,
+                    'b_id': db_id,
+                    'b_permissions_raw': user.permissions_raw,
+                    # don't update names outside of Twitch.
+                    'b_last_known_username': msg.user if is_twitch else user.last_known_username,
+                    'renamed': is_twitch and msg.user != user.last_known_username
+                })
+        return batch
+
+    def _write(self, batch):
+        users = self.User.__table__
+        new_names = {row['b_last_known_username'] for row in batch if row['renamed']}
+        with self.session_scope() as session:
+            if new_names:
+                session.execute(
+                    users.update()
+                    .where(users.c.last_known_username.in_(new_names))
+                    .where(~users.c.id.in_([row['b_id'] for row in batch]))
+                    .values(last_known_username=UNKNOWN_USERNAME)
+                )
+            session.execute(
+                users.update()
+                .where(users.c.id == sqlalchemy.bindparam('b_id'))
+                .values(permissions_raw=sqlalchemy.bindparam('b_permissions_raw'),
+                        last_known_username=sqlalchemy.bindparam('b_last_known_username')),
+                [
+                    {k: row[k] for k in ('b_id', 'b_permissions_raw', 'b_last_known_username')}
+                    for row in batch
+                ]
+            )
+
+    def _apply(self, batch):
+        """Bring cached objects in line with what was written."""
+        cache = self.User.cache
+        batch_ids = {row['b_id'] for row in batch}
+        for row in batch:
+            if not row['renamed']:
+                continue
+            for other in cache.find_by_name(row['b_last_known_username']):
+                if other.id not in batch_ids:
+                    old_name = other.last_known_username
+                    set_committed_value(other, 'last_known_username', UNKNOWN_USERNAME)
+                    cache.rename(other, old_name)
+            user = row['user']
+            old_name = user.last_known_username
+            set_committed_value(user, 'last_known_username', row['b_last_known_username'])
+            cache.rename(user, old_name)
+
+    def _requeue(self, batch):
+        with users_lock:
+            for row in batch:
+                # don't overwrite newer updates
+                modified_users.setdefault(row['b_id'], row['update'])
+
+    def _finish(self, batch, start_time, error: typing.Optional[BaseException]):
+        self.last_flush_latency = time.monotonic() - start_time
+        if error is not None:
+            self.failed_flushes += 1
+            self.log('err', f'Failed to flush {len(batch)} users: {error!r}')
+            self._requeue(batch)
+            return
+        self._apply(batch)
+        self.flushes += 1
+        self.flushed_users += len(batch)
+        self.log('debug', f'Flushed {len(batch)} users in {self.last_flush_latency:.3f}s, '
+                          f'{self.queue_depth} left in queue.')
+
+    async def flush_async(self, force=False):
+        loop = asyncio.get_event_loop()
+        while 1:
+            batch = self._take_due(force)
+            if not batch:
+                return
+            start_time = time.monotonic()
+            try:
+                await loop.run_in_executor(None, self._write, batch)
+            except Exception as e:
+                self._finish(batch, start_time, e)
+                return
+            self._finish(batch, start_time, None)
 
-    return User, flush_users
+    def flush(self, force=False):
+        while 1:
+            batch = self._take_due(force)
+            if not batch:
+                return
+            start_time = time.monotonic()
+            try:
+                self._write(batch)
+            except Exception as e:
+                self._finish(batch, start_time, e)
+                return
+            self._finish(batch, start_time, None)
 
+    def __call__(self):
+        return self.flush()
 
-users_lock = threading.Lock()
+    async def run(self):
+        while 1:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush_async()
@@ -32,6 +32,7 @@ except ImportError:
 
     exit(1)
 import plugins.models.banphrase as banphrase_model
+from plugins.helpers import ban_phrase_engine
 
 NAME = 'ban_phrase'
 __meta_data__ = {
@@ -42,42 +43,53 @@ log = main.make_log_function(NAME)
 BanPhraseType = banphrase_model.BanPhraseType
 BanPhrase = banphrase_model.get(main.Base, log, main.session_scope, main.User)
 ban_phrases: typing.List[BanPhrase] = []
+engine = ban_phrase_engine.BanPhraseEngine()
 
 
 class BanPhraseMiddleware(twitchirc.AbstractMiddleware):
     def send(self, event: Event) -> None:
         msg: twitchirc.ChannelMessage = event.data.get('message')
         if isinstance(msg, twitchirc.ChannelMessage):
+            phrases = engine.get(msg.channel, ban_phrase_engine.OUTPUT)
+            if not phrases:
+                return
             text = msg.text
-
-            for phrase in ban_phrases:
-                if phrase.channel_alias is None or phrase.channel.last_known_username == msg.channel:
-                    if not phrase.output:
-                        continue
-                    text = phrase.check_and_replace(text)
-                    if text is None:
-                        event.cancel()
-                        return
+            hits = phrases.hits(text)
+            for num, phrase in enumerate(phrases.phrases):
+                if num not in hits:
+                    continue
+                new_text = phrase.check_and_replace(text)
+                if new_text is None:
+                    event.cancel()
+                    return
+                if new_text != text:
+                    text = new_text
+                    hits = phrases.hits(text)
             msg.text = text
 
     def receive(self, event: Event) -> None:
         msg: twitchirc.ChannelMessage = event.data.get('message')
         if isinstance(msg, twitchirc.ChannelMessage):
+            phrases = engine.get(msg.channel, ban_phrase_engine.INPUT)
+            if not phrases:
+                return
             text = msg.text
-
-            for phrase in ban_phrases:
-                if phrase.channel_alias is None or phrase.channel.last_known_username == msg.channel:
-                    if not phrase.input:
-                        continue
-
-                    text = phrase.check_and_replace(text)
-                    if phrase.type == BanPhraseType.deny and phrase.check(text):
-                        event.cancel()
-                        event.source.send(msg.reply(phrase.warning))
-                        return
-                    if text is None:
-                        event.cancel()
-                        return
+            hits = phrases.hits(text)
+            for num, phrase in enumerate(phrases.phrases):
+                if num not in hits:
+                    continue
+
+                new_text = phrase.check_and_replace(text)
+                if phrase.type == BanPhraseType.deny and phrase.check(new_text):
+                    event.cancel()
+                    event.source.send(msg.reply(phrase.warning))
+                    return
+                if new_text is None:
+                    event.cancel()
+                    return
+                if new_text != text:
+                    text = new_text
+                    hits = phrases.hits(text)
             msg.text = text
 
     def command(self, event: Event) -> None:
@@ -110,6 +122,9 @@ def _init():
     with main.session_scope() as s:
         for i in BanPhrase.load_all(s):
             ban_phrases.append(i)
+        engine.update([
+            (None if i.channel_alias is None else i.channel.last_known_username, i) for i in ban_phrases
+        ])
     log('debug', f'Done. Loaded {len(ban_phrases)} ban phrases.')
 
 
@@ -43,6 +43,11 @@ except ImportError:
 import twitchirc
 import plugins.models.blacklistentry as blacklistentry_model
 
+try:
+    from helpers.blacklist_index import BlacklistIndex
+except ImportError:
+    from plugins.helpers.blacklist_index import BlacklistIndex
+
 NAME = 'blacklist'
 __meta_data__ = {
     'name': f'plugin_{NAME}',
@@ -53,6 +58,7 @@ log = main.make_log_function(NAME)
 expire_queue = queue.Queue()
 blacklists: List['BlacklistEntry'] = []
 BlacklistEntry = blacklistentry_model.get(main.Base, main.session_scope, blacklists, expire_queue)
+blacklist_index = BlacklistIndex(blacklists, expire_queue)
 TIMEDELTA_REGEX = regex.compile(r'(\d+d(?:ays)?)?([0-5]?\dh(?:ours?)?)?([0-5]?\dm(?:inutes?)?)?'
                                 r'([0-5]?\ds(?:econds?)?)?')
 
@@ -82,6 +88,7 @@ class Plugin(main.Plugin):
             blacklists.clear()
             with main.session_scope() as dank_circle:
                 blacklists.extend(BlacklistEntry.load_all(dank_circle))
+            blacklist_index.rebuild(blacklists)
 
     def _post_init(self):
         global blacklists
@@ -89,6 +96,7 @@ class Plugin(main.Plugin):
         with main.session_scope() as dank_circle:
             blacklists.clear()
             blacklists.extend(BlacklistEntry.load_all(dank_circle))
+        blacklist_index.rebuild(blacklists)
 
         # initialize middleware
         main.bot.middleware.append(
@@ -180,6 +188,7 @@ class Plugin(main.Plugin):
                                          channel=None, expires_on=kw['expires'],
                                          is_active=True)
                     blacklists.append(obj)
+                    blacklist_index.add(obj)
                     session.add(obj)
                 elif len(targets) == 0:
                     return f'@{msg.user} Failed to find user: {kw["user"]}'
@@ -197,6 +206,7 @@ class Plugin(main.Plugin):
                                                  expires_on=kw['expires'],
                                                  is_active=True)
                             blacklists.append(obj)
+                            blacklist_index.add(obj)
                             session.add(obj)
                         elif len(targets) == 0:
                             return f'@{msg.user} Failed to find user: {kw["user"]}'
@@ -231,9 +241,8 @@ class BlacklistMiddleware(twitchirc.AbstractMiddleware):
             return
         message: twitchirc.ChannelMessage = event.data['message']
         command: twitchirc.Command = event.data['command']
-        for bl in blacklists:
-            r = bl.check(message, command)
-            if r is True:
-                log('info', f'Ignored {message.user}\'s command ({command.chat_command!r}) '
-                            f'because of blacklist {bl.id}, message: {message.text}')
-                event.cancel()
+        bl = blacklist_index.find(message, command)
+        if bl is not None:
+            log('info', f'Ignored {message.user}\'s command ({command.chat_command!r}) '
+                        f'because of blacklist {bl.id}, message: {message.text}')
+            event.cancel()
@@ -14,7 +14,9 @@
 #  You should have received a copy of the GNU General Public License
 #  along with this program.  If not, see <https://www.gnu.org/licenses/>.
 import asyncio
+import collections
 import datetime
+import sys
 import time
 import unicodedata
 import warnings
@@ -22,7 +24,7 @@ import typing
 
 import aiohttp
 import regex
-from PIL import Image, ImageFilter
+from PIL import Image
 
 try:
     from utils import arg_parser
@@ -35,6 +37,11 @@ try:
     from helpers import braille
 except ImportError:
     from plugins.helpers import braille
+try:
+    # noinspection PyUnresolvedReferences,PyPackageRequirements
+    from helpers import worker_pool
+except ImportError:
+    from plugins.helpers import worker_pool
 
 try:
     import plugin_plugin_help as plugin_help
@@ -125,6 +132,15 @@ COOKIE_PATTERN = regex.compile(
     r'(?!you have already claimed)'
 )
 
+# Rendered braille keyed by (url, sensitivity, size, reverse, sobel)
+BRAILLE_CACHE_BYTES = 16 * 1024 * 1024
+braille_cache = braille.RenderCache(BRAILLE_CACHE_BYTES)
+BRAILLE_WORKERS = 2
+BRAILLE_FRAME_TIMEOUT = 15
+# Frames of one GIF that are queued or being rendered at once, other users' jobs get a turn in between
+GIF_FRAMES_IN_FLIGHT = 2
+
+
 #ALERT_MESSAGE = f'\x01ACTION pajaS {unicodedata.lookup("POLICE CARS REVOLVING LIGHT")} ALERT\x01'
 
 
@@ -163,6 +179,8 @@ class Plugin(main.Plugin):
 
         self._sneeze_cooldown = time.time()
         self.storage = main.PluginStorage(self, main.bot.storage)
+        self.braille_pool = worker_pool.WorkerPool(BRAILLE_WORKERS, per_user=GIF_FRAMES_IN_FLIGHT,
+                                                   timeout=BRAILLE_FRAME_TIMEOUT, preload=[braille.__name__])
 
         # region Settings
         self.timeout_setting = plugin_manager.Setting(
@@ -374,6 +392,7 @@ class Plugin(main.Plugin):
 
     async def async_init(self):
         self._add_fake_commands()  # async init should be called later than __init__s of other plugins
+        self.braille_pool.start()
 
     async def _ps_sneeze(self, msg: main.StandardizedMessage):
         # don't respond if the playsound didn't play
@@ -600,70 +619,44 @@ class Plugin(main.Plugin):
                 return (main.CommandResult.OTHER_FAILED,
                         f'@{msg.user}, Invalid url, couldn\'t find an emote matching this.')
         # endregion
-        img = await braille.download_image(url)
-        img: Image.Image
-        if img.format.lower() != 'gif':
-            o = await self._single_image_to_braille(
-                args,
-                img,
-                max_x,
-                max_y,
-                (
-                    args['sensitivity_r'],
-                    args['sensitivity_g'],
-                    args['sensitivity_b'],
-                    args['sensitivity_a'],
-                ),
-                size_percent
-            )
-        else:
-            # region gifs
-            missing_permissions = await main.bot.acheck_permissions(msg, ['cancer.braille.gif'],
-                                                                    enable_local_bypass=False)
-            if missing_permissions:
+        sensitivity = (
+            args['sensitivity_r'],
+            args['sensitivity_g'],
+            args['sensitivity_b'],
+            args['sensitivity_a'],
+        )
+        cache_key = (url, sensitivity, (max_x, max_y, size_percent, args['resize']), args['reverse'], args['sobel'])
+        cached = braille_cache.get(cache_key)
+        if cached is not None:
+            is_gif, o = cached
+            if is_gif and await main.bot.acheck_permissions(msg, ['cancer.braille.gif'], enable_local_bypass=False):
                 o = 'Note: missing permissions to convert a gif. \n'
-            else:
-                o = ''
-                frame = -1
-                start_time = time.time()
-                while 1:
-                    try:
-                        img.seek(frame + 1)
-                    except EOFError:
-                        break
-                    frame += 1
-                    o += f'\nFrame {frame}\n'
-                    frame_start = time.time()
-                    o += await self._single_image_to_braille(
-                        args,
-                        img,
-                        max_x,
-                        max_y,
-                        (
-                            args['sensitivity_r'],
-                            args['sensitivity_g'],
-                            args['sensitivity_b'],
-                            args['sensitivity_a'],
-                        ),
-                        size_percent
-                    )
-                    time_taken = round(time.time() - start_time)
-                    frame_time = time.time() - frame_start
-                    if frame_time > 1:
-                        frame_time = round(frame_time)  # avoid division by zero
-
-                    if frame % self.status_every_frames == 0 and time_taken > self.time_before_status:
-                        speed = round(1 / frame_time, 1)
-                        speed_msg = (f'@{msg.user}, Converted {frame} frames in '
-                                     f'{time_taken} seconds, speed: {speed} fps, '
-                                     f'eta: {(img.n_frames - frame) * speed} seconds.')
-                        if main.check_spamming_allowed(msg.channel):
-                            await main.bot.send(msg.reply(speed_msg))
-                        else:
-                            if frame % (self.status_every_frames * 2) == 0:
-                                await main.bot.send(msg.reply_directly(speed_msg))
-                        await asyncio.sleep(0)
-            # endregion
+        else:
+            img = await braille.download_image(url, cache=args['emote'] is not ...)
+            img: Image.Image
+            render_args = (args['reverse'], max_x, max_y, sensitivity, size_percent, args['resize'], args['sobel'])
+            is_gif = img.format.lower() == 'gif'
+            try:
+                if not is_gif:
+                    o = await self.braille_pool.submit(msg.user, braille.render_frame, img, *render_args)
+                    braille_cache.put(cache_key, (False, o), sys.getsizeof(o))
+                else:
+                    # region gifs
+                    missing_permissions = await main.bot.acheck_permissions(msg, ['cancer.braille.gif'],
+                                                                            enable_local_bypass=False)
+                    if missing_permissions:
+                        o = 'Note: missing permissions to convert a gif. \n'
+                    else:
+                        o = await self._gif_to_braille(msg, img, render_args)
+                        braille_cache.put(cache_key, (True, o), sys.getsizeof(o))
+                    # endregion
+            except worker_pool.QueueFull:
+                return (main.CommandResult.OTHER_FAILED,
+                        f'@{msg.user}, Too many images are being converted right now, try again later.')
+            except worker_pool.WorkerTimeout:
+                return main.CommandResult.OTHER_FAILED, f'@{msg.user}, Took too long to convert, gave up.'
+            except worker_pool.WorkerCrashed:
+                return main.CommandResult.OTHER_FAILED, f'@{msg.user}, Used up too much resources, gave up.'
 
         sendable = ' '.join(o.split('\n')[1:])
         if args['hastebin'] or len(sendable) > 500:
@@ -674,30 +667,39 @@ class Plugin(main.Plugin):
         else:
             return sendable
 
-    async def _single_image_to_braille(self, args, img, max_x, max_y, sens, size_percent):
-        if args['resize']:
-            img, o = await braille.crop_and_pad_image(
-                False,
-                img,
-                max_x,
-                max_y,
-                '',
-                (60, 60),
-                size_percent
-            )
-        else:
-            o = ''
-        if args['sobel']:
-            img = img.filter(ImageFilter.FIND_EDGES)
-        o += await braille.to_braille_from_image(
-            img,
-            reverse=args['reverse'],
-            size_percent=size_percent,
-            max_x=max_x,
-            max_y=max_y,
-            sensitivity=sens,
-            enable_padding=False,
-            pad_size=(60, 60),
-            enable_processing=False
-        )
+    async def _gif_to_braille(self, msg, img: Image.Image, render_args: tuple) -> str:
+        frames = []
+        while 1:
+            try:
+                img.seek(len(frames))
+            except EOFError:
+                break
+            frames.append(img.copy())
+
+        pending = collections.deque()
+        submitted = 0
+        o = ''
+        start_time = time.time()
+        try:
+            for frame in range(len(frames)):
+                while submitted < len(frames) and len(pending) < GIF_FRAMES_IN_FLIGHT:
+                    pending.append(self.braille_pool.submit(msg.user, braille.render_frame, frames[submitted],
+                                                            *render_args))
+                    submitted += 1
+                o += f'\nFrame {frame}\n'
+                o += await pending.popleft()
+                time_taken = round(time.time() - start_time)
+                if frame % self.status_every_frames == 0 and time_taken > self.time_before_status:
+                    speed = (frame + 1) / (time.time() - start_time)
+                    speed_msg = (f'@{msg.user}, Converted {frame} frames in '
+                                 f'{time_taken} seconds, speed: {speed:.1f} fps, '
+                                 f'eta: {round((len(frames) - frame - 1) / speed)} seconds.')
+                    if main.check_spamming_allowed(msg.channel):
+                        await main.bot.send(msg.reply(speed_msg))
+                    else:
+                        if frame % (self.status_every_frames * 2) == 0:
+                            await main.bot.send(msg.reply_directly(speed_msg))
+        finally:
+            for future in pending:
+                future.cancel()
         return o
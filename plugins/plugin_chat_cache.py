@@ -34,6 +34,11 @@ except ImportError:
 import twitchirc
 import traceback
 
+try:
+    from helpers.chat_cache import ChannelCache
+except ImportError:
+    from plugins.helpers.chat_cache import ChannelCache
+
 NAME = 'chat_cache'
 __meta_data__ = {
     'name': f'plugin_{NAME}',
@@ -44,7 +49,7 @@ log = main.make_log_function(NAME)
 
 
 class Plugin(main.Plugin):
-    cache: Dict[str, typing.List[typing.Tuple[twitchirc.ChannelMessage, float]]]
+    cache: Dict[str, ChannelCache]
 
     def __init__(self, module, source):
         super().__init__(module, source)
@@ -53,9 +58,7 @@ class Plugin(main.Plugin):
         # }
         self.max_cache_length = defaultdict(lambda: 10_000)
         self.cache = {
-            # 'channel': [
-            #     # [message, time.time()]  # message, timestamp
-            # ]
+            # 'channel': ChannelCache(max_cache_length)
         }
         main.bot.handlers['chat_msg'].append(self.on_message)
         main.bot.schedule_event(0.1, 10, self._load_recents_from_connected, (), {})
@@ -103,9 +106,10 @@ class Plugin(main.Plugin):
         pass
 
     def find_messages(self, channel, user=None, min_timestamp=None,
-                      max_timestamp=None, expr=None) -> typing.List[twitchirc.ChannelMessage]:
+                      max_timestamp=None, expr=None) -> typing.List['main.StandardizedMessage']:
         """
-        Find all messages matching given criteria.
+        Find all messages matching given criteria. Returned messages are rebuilt from the compact cache entries,
+        only a few flags (badges, ids, display-name, tmi-sent-ts) are available.
 
         :param channel: Channel you want to search. Required
         :param user: User you want to search for. Optional
@@ -119,31 +123,44 @@ class Plugin(main.Plugin):
         else:
             pattern = regex.compile(expr)
         if channel in self.cache:
-            ret_list = []
-            for msg, t in self.cache[channel]:
-                if ((user is None or msg.user == user)
-                        and (pattern is None or pattern.findall(msg.text))
-                        and (min_timestamp is None or min_timestamp < t)
-                        and (max_timestamp is None or max_timestamp > t)):
-                    ret_list.append(msg)
-            return ret_list
+            return self.cache[channel].find(user, min_timestamp, max_timestamp, pattern)
+        else:
+            raise KeyError(f'Channel not found: {channel}')
+
+    def find_message_by_id(self, channel, msg_id: str) -> typing.Optional['main.StandardizedMessage']:
+        """
+        Find a message by its id.
+
+        :param channel: Channel you want to search. Required
+        :param msg_id: Value of the `id` tag of the message. Required
+        :return: The message or None if it isn't cached.
+        """
+        if channel in self.cache:
+            return self.cache[channel].get(msg_id)
         else:
             raise KeyError(f'Channel not found: {channel}')
 
     def on_message(self, event, message: twitchirc.ChannelMessage):
-        self._clear_cache()
         if message.channel not in self.cache:
-            self.cache[message.channel] = []
+            self.cache[message.channel] = ChannelCache(self.max_cache_length[message.channel], main.bot)
         t = None
         if 'tmi-sent-ts' in message.flags:
             t = int(message.flags['tmi-sent-ts']) / 1000
         else:
             t = time.time()
-        self.cache[message.channel].append(
-            (message, t)
-        )
-
-    def _clear_cache(self):
-        for channel in self.cache:
-            while len(self.cache[channel]) > self.max_cache_length[channel]:
-                self.cache[channel].pop(0)  # delete the oldest entry.
+        self.cache[message.channel].append(message, t)
+
+    def memory_report(self) -> typing.Dict[str, typing.Tuple[int, int]]:
+        """
+        Estimate memory used by the cache.
+
+        :return: Dict of channel name to (number of cached messages, estimated bytes used).
+        """
+        report = {}
+        for channel, channel_cache in self.cache.items():
+            report[channel] = (len(channel_cache), channel_cache.estimate_size())
+        total_messages = sum(i[0] for i in report.values())
+        total_bytes = sum(i[1] for i in report.values())
+        log('info', f'Cached {total_messages} messages using ~{total_bytes} bytes, '
+                    f'{total_bytes / (total_messages or 1):.0f} bytes per message.')
+        return report
@@ -13,7 +13,7 @@
 #
 #  You should have received a copy of the GNU General Public License
 #  along with this program.  If not, see <https://www.gnu.org/licenses/>.
-import abc
+import os
 import typing
 
 import aiohttp
@@ -29,6 +29,11 @@ except ImportError:
 # noinspection PyUnresolvedReferences
 import twitchirc
 
+try:
+    from .helpers.emote_index import Emote, EmoteIndex, EmoteProvider
+except ImportError:
+    from plugins.helpers.emote_index import Emote, EmoteIndex, EmoteProvider
+
 NAME = 'emotes'
 __meta_data__ = {
     'name': f'plugin_{NAME}',
@@ -37,13 +42,17 @@ __meta_data__ = {
 }
 log = main.make_log_function(NAME)
 
+CACHE_FILE = os.path.join('cache', 'emotes.json')
+
 
 class Plugin(main.Plugin):
     def __init__(self, module, source):
         super().__init__(module, source)
-        self.bttv = BttvEmoteCache()
-        self.ffz = FFZEmoteCache()
-        self.twitch = TwitchEmoteCache()
+        self.bttv = BttvEmoteProvider()
+        self.ffz = FFZEmoteProvider()
+        self.twitch = TwitchEmoteProvider()
+        self.index = EmoteIndex([self.bttv, self.ffz, self.twitch], CACHE_FILE)
+        self.index.load()
 
     @property
     def no_reload(self):
@@ -62,77 +71,27 @@ class Plugin(main.Plugin):
         return super().on_reload
 
     async def find_emote(self, name, channel_id: str = None) -> typing.Optional['Emote']:
-        if channel_id is not None:
-            try:
-                return await self.bttv.find_channel_emote(name, channel_id)
-            except KeyError:
-                pass
-            try:
-                return await self.ffz.find_channel_emote(name, channel_id)
-            except KeyError:
-                pass
-        try:
-            return await self.bttv.find_global_emote(name)
-        except KeyError:
-            pass
-        try:
-            return await self.ffz.find_global_emote(name)
-        except KeyError:
-            pass
-        try:
-            return await self.twitch.find_global_emote(name)
-        except KeyError:
-            pass
-
-
-class Emote:
-    def __init__(self, name: str, url: str, id_: str, urls=None, **kwargs):
-        if urls is None:
-            urls = {}
-        self.urls = urls
-        self.name = name
-        self.url = url
-        self.id_ = id_
-        self.other_data = kwargs
-
-    def get_url(self, size: str):
-        if size in self.urls:
-            return self.urls[size]
-        return self.url.format(size)
-
-    def __repr__(self):
-        return f'<Emote: {self.name}>'
-
-
-class EmoteCache(abc.ABC):
-    def __init__(self):
-        self.channels = {}
-        self.globals = {}
+        """
+        Find an emote usable in the channel. Channel emotes win over global ones, BTTV wins over FFZ which wins
+        over Twitch.
+        """
+        return await self.index.find(name, channel_id)
 
-    async def find_global_emote(self, name: str) -> Emote:
-        if not self.globals:
-            await self.load_globals()
 
-        return self.globals[name]
+async def _get_json(url: str, provider: str, what: str, empty_statuses=()) -> typing.Optional[dict]:
+    async with aiohttp.request('get', url, timeout=aiohttp.ClientTimeout(total=15)) as r:
+        log('info', f'Loaded {provider} {what}, status {r.status}')
+        if r.status in empty_statuses:
+            return None
+        if r.status != 200:
+            raise ValueError(f'Bad status: {r.status}')
+        return await r.json()
 
-    async def find_channel_emote(self, name: str, channel_id: str) -> Emote:
-        if channel_id not in self.channels:
-            await self.load_channel(channel_id)
 
-        return self.channels[channel_id][name]
+class BttvEmoteProvider(EmoteProvider):
+    name = 'bttv'
 
-    @abc.abstractmethod
-    async def load_globals(self):
-        pass
-
-    @abc.abstractmethod
-    async def load_channel(self, channel_id: str):
-        pass
-
-
-class BttvEmoteCache(EmoteCache):
     def __init__(self):
-        super().__init__()
         self.global_url = 'https://api.betterttv.net/3/cached/emotes/global'
         self.channel_url = 'https://api.betterttv.net/3/cached/users/twitch/{}'
         self.emote_url = 'https://cdn.betterttv.net/emote/{id}/{size}'
@@ -163,28 +122,21 @@ class BttvEmoteCache(EmoteCache):
             emotes[e.name] = e
         return emotes
 
-    async def load_globals(self):
-        async with aiohttp.request('get', self.global_url) as r:
-            log('info', f'Loaded BTTV global emotes, status {r.status}')
-            if r.status == 200:
-                self.globals = self._parse_globals(await r.json())
-            else:
-                log('error', f'Bad status: {r.status}\n'
-                             f'{r.content}')
-
-    async def load_channel(self, channel_id: str):
-        async with aiohttp.request('get', self.channel_url.format(channel_id)) as r:
-            log('info', f'Loaded BTTV channel emotes for channel id {channel_id!r}, status {r.status}')
-            if r.status == 200:
-                self.channels[channel_id] = self._parse_channel_emotes(await r.json())
-            else:
-                log('error', f'Bad status: {r.status}\n'
-                             f'{r.content}')
-
-
-class FFZEmoteCache(EmoteCache):
+    async def fetch_globals(self) -> typing.Dict[str, Emote]:
+        return self._parse_globals(await _get_json(self.global_url, 'BTTV', 'global emotes'))
+
+    async def fetch_channel(self, channel_id: str) -> typing.Dict[str, Emote]:
+        data = await _get_json(self.channel_url.format(channel_id), 'BTTV',
+                               f'channel emotes for channel id {channel_id!r}', empty_statuses=(404,))
+        if data is None:
+            return {}
+        return self._parse_channel_emotes(data)
+
+
+class FFZEmoteProvider(EmoteProvider):
+    name = 'ffz'
+
     def __init__(self):
-        super().__init__()
         self.global_url = 'https://api.frankerfacez.com/v1/set/global'
         self.channel_url = 'https://api.frankerfacez.com/v1/room/id/{}'
 
@@ -193,7 +145,6 @@ class FFZEmoteCache(EmoteCache):
         emotes = {}
         for emote_set in source['sets'].values():
             for emote in emote_set['emoticons']:
-                print(emote)
                 emote['urls'] = {int(k): v for k, v in emote['urls'].items()}
                 e = Emote(emote['name'], 'https:' + (emote['urls'][max(emote['urls'].keys())]), emote['id'],
                           modifier=emote['modifier'], hidden=emote['hidden'],
@@ -201,64 +152,45 @@ class FFZEmoteCache(EmoteCache):
                 emotes[e.name] = e
         return emotes
 
-    async def load_globals(self):
-        async with aiohttp.request('get', self.global_url) as r:
-            log('info', f'Loaded FFZ global emotes, status {r.status}')
-            if r.status == 200:
-                self.globals = self._parse_emotes(await r.json())
-            else:
-                log('error', f'Bad status: {r.status}\n'
-                             f'{r.content}')
-
-    async def load_channel(self, channel_id: str):
-        async with aiohttp.request('get', self.channel_url.format(channel_id)) as r:
-            log('info', f'Loaded FFZ channel emotes for channel id {channel_id!r}, status {r.status}')
-            if r.status == 200:
-                self.channels[channel_id] = self._parse_emotes(await r.json())
-            elif r.status == 203:
-                self.channels[channel_id] = []
-            else:
-                log('error', f'Bad status: {r.status}\n'
-                             f'{r.content}')
-
-
-class TwitchEmoteCache(EmoteCache):
-    async def load_globals(self):
-        async with aiohttp.request('get', self.global_url) as r:
-            log('info', f'Loaded Twitch global emotes (emote set 0) with status {r.status}')
-            data = await r.json()
-            for e in data['emotes']:
-                e['channel'] = data['channel']
-                e['channelid'] = data['channelid']
-                e['channellogin'] = data['channellogin']
-                e['tier'] = data['tier']
-                self.globals[e] = self._parse_emote(e)
-
-    async def load_channel(self, channel_id: str):
-        # twitch has no channel emotes
-        pass
+    async def fetch_globals(self) -> typing.Dict[str, Emote]:
+        return self._parse_emotes(await _get_json(self.global_url, 'FFZ', 'global emotes'))
+
+    async def fetch_channel(self, channel_id: str) -> typing.Dict[str, Emote]:
+        data = await _get_json(self.channel_url.format(channel_id), 'FFZ',
+                               f'channel emotes for channel id {channel_id!r}', empty_statuses=(203, 404))
+        if data is None:
+            return {}
+        return self._parse_emotes(data)
+
+
+class TwitchEmoteProvider(EmoteProvider):
+    name = 'twitch'
 
     def __init__(self):
-        super().__init__()
         self.channel_url = 'https://api.ivr.fi/twitch/emotes/{}'
         self.global_url = 'https://api.ivr.fi/twitch/emoteset/0'
 
-    async def find_global_emote(self, name: str) -> typing.Optional[Emote]:
-        if name in self.globals:
-            log('info', f'Using cached Twitch global emote {name!r}')
-            return self.globals[name]
-
-        async with aiohttp.request('get', self.channel_url.format(name)) as r:
-            log('info', f'Tried loading Twitch global emote {name!r} with status {r.status}')
-            if r.status == 404:
-                self.globals[name] = None
-                return
+    async def fetch_globals(self) -> typing.Dict[str, Emote]:
+        data = await _get_json(self.global_url, 'Twitch', 'global emotes (emote set 0)')
+        emotes = {}
+        for e in data['emotes']:
+            e['channel'] = data['channel']
+            e['channelid'] = data['channelid']
+            e['channellogin'] = data['channellogin']
+            e['tier'] = data['tier']
+            emote = self._parse_emote(e)
+            emotes[emote.name] = emote
+        return emotes
 
-            self.globals[name] = self._parse_emote(await r.json())
-            return self.globals[name]
+    async def fetch_channel(self, channel_id: str) -> typing.Dict[str, Emote]:
+        # twitch has no channel emotes
+        return {}
 
-    async def find_channel_emote(self, name: str, channel_id: str):
-        return
+    async def fetch_emote(self, name: str) -> typing.Optional[Emote]:
+        data = await _get_json(self.channel_url.format(name), 'Twitch', f'emote {name!r}', empty_statuses=(404,))
+        if data is None:
+            return None
+        return self._parse_emote(data)
 
     def _parse_emote(self, data: dict):
         return Emote(data['emotecode'], data.get('emoteurl_3x') or data.get('url'), data['emoteid'], {
@@ -16,9 +16,6 @@
 import asyncio
 import dataclasses
 import datetime
-import re
-import signal
-import subprocess
 import typing
 from typing import List
 
@@ -29,6 +26,11 @@ import util_bot
 import plugins.utils.arg_parser as arg_parser
 from util_bot import StandardizedMessage
 
+try:
+    from .helpers.justgrep import JobLimitError, JobScheduler, JustgrepError, LoggerRoutes, LogSearch, build_paste
+except ImportError:
+    from plugins.helpers.justgrep import (JobLimitError, JobScheduler, JustgrepError, LoggerRoutes, LogSearch,
+                                          build_paste)
 try:
     import plugin_plugin_manager as plugin_manager
 except ImportError:
@@ -64,17 +66,10 @@ class Stats:
     messages_processed = 0
 
 
-class JustgrepError(Exception):
-    def __init__(self, errors: List[str]):
-        self.errors = errors
-
-    def __repr__(self):
-        return f'<Justgrep error: {", ".join(self.errors)}>'
-
-
 class Plugin(util_bot.Plugin):
-    _current_log_fetch: typing.Optional[asyncio.Task]
     loggers: List['JustLogApi']
+    routes: LoggerRoutes
+    jobs: JobScheduler
 
     def __init__(self, module, source):
         super().__init__(module, source)
@@ -192,7 +187,8 @@ class Plugin(util_bot.Plugin):
         )
         plugin_help.create_topic(
             'logs cancel',
-            'Cancel a running log fetch. You cannot cancel another person\'s log fetch unless you have the '
+            'Cancel a log fetch, usage: `_logs --cancel [ID]`. The ID can be omitted if you only have one log fetch '
+            'queued or running. You cannot cancel another person\'s log fetch unless you have the '
             '`util.logs.cancel_other` permission.',
             plugin_help.SECTION_ARGS,
             links=[
@@ -200,14 +196,15 @@ class Plugin(util_bot.Plugin):
             ]
         )
         self.loggers = []
-        self._current_log_fetch = None
-        self._current_log_owner = None
+        self.routes = LoggerRoutes(self.loggers)
+        self.jobs = JobScheduler()
 
     def _load_loggers(self, settings: plugin_manager.ChannelSettings):
         val: list = settings.get(self.logger_setting)
         self.loggers.clear()
         for i in val:
             self.loggers.append(JustLogApi(i))
+        self.routes.invalidate()
 
     @property
     def no_reload(self):
@@ -225,11 +222,8 @@ class Plugin(util_bot.Plugin):
     def on_reload(self):
         return super().on_reload
 
-    async def _justlog_for_channel(self, channel: str):
-        for i in self.loggers:
-            if await i.has_channel(channel):
-                return i
-        return None
+    async def _justlog_for_channel(self, channel: str) -> typing.Optional['JustLogApi']:
+        return await self.routes.get(channel)
 
     async def command_logs(self, msg: util_bot.StandardizedMessage):
         missing_perms = await util_bot.bot.acheck_permissions(msg, ['util.logs', 'util.logs.channel.*'])
@@ -263,7 +257,9 @@ class Plugin(util_bot.Plugin):
 
                     'before': int,
                     'after': int,
-                    'context': int
+                    'context': int,
+
+                    1: int  # job id for --cancel
                 },
                 defaults={
                     'user': None,
@@ -283,7 +279,9 @@ class Plugin(util_bot.Plugin):
 
                     'before': 0,
                     'after': 0,
-                    'context': 0
+                    'context': 0,
+
+                    1: None
                 },
                 strict_escapes=False
             )
@@ -291,19 +289,7 @@ class Plugin(util_bot.Plugin):
             return (util_bot.CommandResult.OTHER_FAILED,
                     f'@{msg.user} {e.message}')
         if args['cancel']:
-            if self._current_log_fetch:
-                missing_permissions = await util_bot.bot.acheck_permissions(msg, ['util.logs.cancel_other'])
-                if self._current_log_owner == msg.user or not missing_permissions:
-                    print('Cancelling log fetch!')
-                    self._current_log_fetch.cancel()
-                    return None
-                else:
-                    await util_bot.bot.send(
-                        msg.reply_directly(f'You don\'t have permissions to cancel this log fetch.'))
-                    await util_bot.bot.flush_queue()
-                    return None
-            else:
-                return f"@{msg.user}, There's nothing to cancel!"
+            return await self._cancel(msg, args[1])
         if args['channel'] == 'whispers' and msg.channel == 'whispers':
             return (util_bot.CommandResult.OTHER_FAILED,
                     f'@{msg.user}, To use this command in whispers you need to provide a channel, like '
@@ -344,8 +330,8 @@ class Plugin(util_bot.Plugin):
                 else:
                     users.append(i)
 
-        filter_task = asyncio.create_task(self._filter_messages(
-            logger,
+        search = LogSearch(
+            logger.address,
             channel=args['channel'],
             users=users,
             not_users=not_users,
@@ -353,30 +339,39 @@ class Plugin(util_bot.Plugin):
             start=args['from'],
             end=args['to'],
             count=args['max']
-        ))
-        self._current_log_fetch = asyncio.current_task()
-        self._current_log_owner = msg.user
+        )
+        try:
+            job = self.jobs.submit(msg.user, search)
+        except JobLimitError as e:
+            return (util_bot.CommandResult.OTHER_FAILED,
+                    f'@{msg.user}, {e}')
+        position = self.jobs.position(job)
+        if position:
+            await util_bot.bot.send(msg.reply(f'@{msg.user}, Your log fetch is queued as job {job.id}, '
+                                              f'position {position} in the queue. '
+                                              f'Do `_logs --cancel {job.id}` to abort.'))
         try:
             try:
-                matched = await asyncio.wait_for(asyncio.shield(filter_task), timeout=5)
+                matched = await asyncio.wait_for(asyncio.shield(job.task), timeout=5)
             except asyncio.TimeoutError:
                 additional_message = ('Using local user filtering, because you used advanced user searching.'
                                       if len(users) > 1 or not_users else '')
+                position = self.jobs.position(job)
+                if position:
+                    progress = f'Still queued at position {position}.'
+                else:
+                    progress = f'So far {search.progress}.'
                 await util_bot.bot.send(msg.reply(f'@{msg.user}, Looks like this log fetch will take a while, '
-                                                  f'do `_logs --cancel` to abort. '
-                                                  f'Progress data unavailable. '
+                                                  f'do `_logs --cancel {job.id}` to abort. '
+                                                  f'{progress} '
                                                   f'{additional_message}'))
                 matched = None
-            if not filter_task.done():
-                matched = await filter_task
+            if not job.task.done():
+                matched = await job.task
         except asyncio.CancelledError:
-            self._current_log_fetch = None
-            self._current_log_owner = None
-            filter_task.cancel()
-            return f'@{msg.user} The log fetch was cancelled.'
+            job.task.cancel()
+            return f'@{msg.user} The log fetch was cancelled, {search.progress}.'
 
-        self._current_log_fetch = None
-        self._current_log_owner = None
         hastebin_link = await self._hastebin_result(matched, args, datetime.datetime.utcnow() + args['expire'])
         if args['logviewer']:
             channel_id = list(filter(lambda o: o.name == args['channel'], logger.channels))[0].id
@@ -384,73 +379,48 @@ class Plugin(util_bot.Plugin):
         else:
             link = f'{plugin_hastebin.hastebin_addr}raw/{hastebin_link}'
         return (util_bot.CommandResult.OK,
-                f'@{msg.user}, Uploaded {len(matched)-1} filtered messages to hastebin: '
-                f'{link}')
-
-    async def _filter_messages(self, logger: 'JustLogApi', channel,
-                               users: List[str], not_users: List[str],
-                               regular_expr: typing.Pattern, start: datetime.datetime, end: datetime.datetime, count):
-        DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
-        if len(users) > 1 or not_users:
-            not_user_arg = ()
-            if not_users:
-                not_user_arg = (
-                    '-notuser', '|'.join(map(re.escape, not_users)),
-                )
-            user_arguments = (
-                '-uregex',
-                '-user', '|'.join(map(re.escape, users)),
-                *not_user_arg
-            )
-        elif len(users) == 1:
-            user_arguments = (
-                '-user', users[0]
-            )
-        else:  # no users
-            user_arguments = ()
-
-        proc = await asyncio.create_subprocess_exec(
-            'justgrep',
-            '-channel', channel,
-            '-start', start.strftime(DATE_FORMAT),
-            '-end', end.strftime(DATE_FORMAT),
-            '-url', logger.address,
-            *user_arguments,
-            '-regex', regular_expr.pattern,
-            '-max', str(count),
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE
-        )
-        try:
-            lines, stderr = (await proc.communicate())
-            lines = lines.decode().split('\n')
-            stderr = stderr.decode().split('\n')
-            if len(stderr) and stderr[0]:
-                raise JustgrepError(stderr)
-        except asyncio.CancelledError:
-            proc.send_signal(signal.SIGKILL)
-            await proc.communicate()  # wait until it's ded
-            raise
-        return lines
+                f'@{msg.user}, Uploaded {len(matched)} filtered messages to hastebin '
+                f'({search.elapsed:.1f}s): {link}')
+
+    async def _cancel(self, msg: util_bot.StandardizedMessage, job_id: typing.Optional[int]):
+        if job_id is None:
+            own = [i for i in self.jobs.jobs.values() if i.owner == msg.user]
+            if not own:
+                return f"@{msg.user}, There's nothing to cancel!"
+            if len(own) > 1:
+                return (f'@{msg.user}, You have multiple log fetches, pick one to cancel: '
+                        f'{", ".join(str(i.id) for i in own)}')
+            job = own[0]
+        else:
+            job = self.jobs.jobs.get(job_id)
+            if job is None:
+                return f"@{msg.user}, There's no log fetch with id {job_id}."
+        if job.owner != msg.user:
+            missing_permissions = await util_bot.bot.acheck_permissions(msg, ['util.logs.cancel_other'])
+            if missing_permissions:
+                await util_bot.bot.send(
+                    msg.reply_directly(f'You don\'t have permissions to cancel this log fetch.'))
+                await util_bot.bot.flush_queue()
+                return None
+        print(f'Cancelling log fetch {job.id}!')
+        self.jobs.cancel(job.id)
+        return None
 
     async def _hastebin_result(self, matched: List[StandardizedMessage], args, expire_on):
         output = self._convert_to_raw_irc(args, expire_on, matched)
         return await plugin_hastebin.upload(output, expire_on)
 
     def _convert_to_raw_irc(self, args, expire_on, matched):
-        output = ''
-        for i in (f'Found {len(matched)} (out of maximum {args["max"]}) messages',
-                  f'Channel: #{args["channel"]}',
-                  f'User: {args["user"] or "[any]"}',
-                  f'Start date/time: {args["from"]}',
-                  f'End date/time: {args["to"]}',
-                  f'Search regex: {args["regex"].pattern}',
-                  f'This paste expires on: {expire_on} or in {args["expire"]}'):
-            output += f'@msg-id=log_info :tmi.twitch.tv NOTICE * :{i}\n'
-
-        for msg in matched:
-            output += msg + '\r\n'
-        return output
+        return build_paste(
+            (f'Found {len(matched)} (out of maximum {args["max"]}) messages',
+             f'Channel: #{args["channel"]}',
+             f'User: {args["user"] or "[any]"}',
+             f'Start date/time: {args["from"]}',
+             f'End date/time: {args["to"]}',
+             f'Search regex: {args["regex"].pattern}',
+             f'This paste expires on: {expire_on} or in {args["expire"]}'),
+            matched
+        )
 
 
 class JustLogApi:
@@ -462,20 +432,19 @@ class JustLogApi:
 
     async def has_channel(self, channel: str):
         if not self.channels:
-            await self._query_channels()
+            await self.query_channels()
         for i in self.channels:
             if i.name == channel:
                 return True
         return False
 
-    async def _query_channels(self):
+    async def query_channels(self):
         log('warn', f'JustLog at {self.address}: query channels')
         try:
             async with aiohttp.request('get', self.address + f'/channels') as r:
                 # r.raise_for_status()
                 self.channels = [JustlogChannel(i['name'], i['userID']) for i in (await r.json()).get('channels', [])]
         except aiohttp.client_exceptions.ContentTypeError:
-            self.channels = []
             log('warn', f'@{self.address}, You promised me JSON and sent XML.')
 
 
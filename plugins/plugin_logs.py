@@ -12,9 +12,6 @@
 #
 #  You should have received a copy of the GNU General Public License
 #  along with this program.  If not, see <https://www.gnu.org/licenses/>.
-import queue
-import threading
-import time
 import typing
 
 import regex
@@ -22,6 +19,11 @@ import regex
 import plugins.models.logentry as logentry_model
 from plugins.models.logentry import CAUSE_TASK, CAUSE_OTHER
 
+try:
+    from .helpers.log_sink import LogSink
+except ImportError:
+    from plugins.helpers.log_sink import LogSink
+
 try:
     # noinspection PyPackageRequirements
     import main
@@ -74,12 +76,10 @@ class Plugin(main.Plugin):
         }
         self.log_level = self.log_levels['debug']
         self.db_log_level = self.log_levels['info']
-        self._logger_queue = queue.Queue()
-        self._logger_thread = threading.Thread(target=self._logger_thread_func, args=(self._logger_queue,),
-                                               daemon=False)
-        main.bot.schedule_event(0.1, 100, self._logger_thread.start, (), {})
+        self.sink = LogSink(self._write_batch, on_error=self._write_failed)
+        self.sink.put('logs', -1, 'Started logging.', CAUSE_TASK)
+        main.bot.schedule_event(0.1, 100, self.sink.start, (), {})
         # start logging after everything is initialized
-        self._logger_thread_stop_lock = threading.Lock()
         self.oauth_pat = regex.compile(
             'oauth:[a-z0-9]{30}'
         )
@@ -105,27 +105,15 @@ class Plugin(main.Plugin):
 
     def on_reload(self):
         print('on reload/exit')
-        try:
-            self._logger_thread_stop_lock.acquire()
-            self._logger_queue.put(None)
-            self._print_log('logs',
-                            0,
-                            'Stopping logging...',
-                            cause=CAUSE_OTHER)
-            self._logger_thread.join()
-        except:
-            pass
+        self._print_log('logs',
+                        0,
+                        'Stopping logging...',
+                        cause=CAUSE_OTHER)
+        self.sink.stop()
 
     def _db_log(self, source: str, level: int, message: str, cause):
         if self.db_log_level <= level:
-            self._logger_queue.put(
-                {
-                    'source': source,
-                    'level': level,
-                    'message': message,
-                    'cause': cause
-                }
-            )
+            self.sink.put(source, level, message, cause)
 
     def _translate_level(self, level):
         if isinstance(level, int):
@@ -144,38 +132,13 @@ class Plugin(main.Plugin):
         return logger
 
     # noinspection PyMethodMayBeStatic
-    def _flush_batch(self, batch):
-        _print('Flushing batch...')
+    def _write_batch(self, rows):
         with main.session_scope_local_thread() as session:
-            for obj in batch:
-                session.add(LogEntry(**obj))
-        _print('Flushing done...')
-
-    def _logger_thread_func(self, q: queue.Queue):
-        _print('Started logging...')
-        batch = [
-            {
-                'source': 'logs',
-                'level': -1,
-                'message': 'Started logging.',
-
-                'cause': CAUSE_TASK
-            }
-        ]
-        batch_start = time.time()
-        while 1:
-            data = q.get()
-            if self._logger_thread_stop_lock.locked() or data is None:
-                print('t: stop!')
-                if batch:
-                    self._flush_batch(batch)
-                return
-            batch.append(data)
-            if len(batch) > 1_000 or time.time() > batch_start + 10:
-                if batch:
-                    self._flush_batch(batch)
-                batch = []
-                batch_start = time.time()
+            session.execute(LogEntry.__table__.insert(), rows)
+
+    # noinspection PyMethodMayBeStatic
+    def _write_failed(self, e: BaseException):
+        _print(f'Failed to write logs to the database: {e!r}')
 
     def _print_log(self, source, level, message, cause):
         if self.log_level <= level:
@@ -189,6 +152,6 @@ class Plugin(main.Plugin):
                      0,
                      'Disconnected!',
                      cause=CAUSE_TASK)
-            self._logger_queue.put(None, True)
+            self.sink.stop()
 
         main.bot.handlers['post_disconnect'].append(write_post_dis_conn)
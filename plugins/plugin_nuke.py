@@ -15,9 +15,6 @@
 import asyncio
 import datetime
 import math
-import select
-import sys
-import threading
 import time
 import typing
 from typing import List, Dict, Any
@@ -25,6 +22,7 @@ from typing import List, Dict, Any
 import aiohttp
 import regex
 
+from plugins.helpers import moderation_pool
 from plugins.utils import arg_parser
 
 try:
@@ -85,8 +83,27 @@ log = main.make_log_function(NAME)
 BAN_T = 0.05
 
 
+class ModerationPoolMiddleware(twitchirc.AbstractMiddleware):
+    """Keeps the moderation pool joined to channels where the bot is a moderator."""
+    handled_actions = {'userstate'}
+
+    def __init__(self, parent: 'Plugin'):
+        super().__init__()
+        self.parent = parent
+
+    def on_action(self, event: twitchirc.Event):
+        if self.parent.pool is None:
+            return
+        channel = event.data['message'].channel
+        if event.data['mode'] == 'mod':
+            self.parent.pool.join(channel)
+        else:
+            self.parent.pool.part(channel)
+
+
 class Plugin(main.Plugin):
-    kill_switches: Dict[Any, threading.Event]
+    kill_switches: Dict[Any, asyncio.Event]
+    pool: typing.Optional[moderation_pool.ModerationPool]
 
     @property
     def max_nuke(self):
@@ -184,63 +201,56 @@ class Plugin(main.Plugin):
             scope=plugin_manager.SettingScope.GLOBAL,
             write_defaults=True
         )
-        # region
-        self.connections = []
-        self.tasks = []
+        self.warm_connections_setting = plugin_manager.Setting(
+            self,
+            'nuke.warm_connections',
+            default_value=2,
+            scope=plugin_manager.SettingScope.GLOBAL,
+            write_defaults=True
+        )
+        # endregion
+        self.pool = None
+        self.middleware = ModerationPoolMiddleware(self)
+        main.bot.middleware.append(self.middleware)
+
+    @property
+    def warm_connections(self):
+        return plugin_manager.channel_settings[plugin_manager.SettingScope.GLOBAL.name] \
+            .get(self.warm_connections_setting)
+
+    def _ensure_pool(self) -> moderation_pool.ModerationPool:
+        """Create the pool if needed. Commands can arrive before async_init did it."""
+        if self.pool is None:
+            twitch_connection = main.bot.clients[main.Platform.TWITCH].connection
+            self.pool = moderation_pool.ModerationPool(
+                twitch_connection.address, twitch_connection.port, twitch_connection.secure,
+                auth=lambda: (main.bot.username, 'oauth:' + main.twitch_auth.new_api.auth.token),
+                rate=1 / BAN_T
+            )
+            for channel, state in main.bot_user_state.items():
+                if state['mode'] == 'mod':
+                    self.pool.join(channel)
+        return self.pool
+
+    async def async_init(self):
+        self._ensure_pool()
+        asyncio.create_task(self._warm_up())
+
+    async def _warm_up(self):
+        try:
+            await self.pool.resize(self.warm_connections)
+        except ConnectionError as e:
+            log('err', f'Failed to warm up moderation connections: {e}')
 
     async def c_stop_nuke(self, msg: twitchirc.ChannelMessage):
         if msg.channel in self.kill_switches:
             self.kill_switches[msg.channel].set()
-            return f'@{msg.user}, Kill switch event triggered, bans should stop any second now.'
+            progress = self.pool.progress.get(msg.channel) if self.pool is not None else None
+            return (f'@{msg.user}, Kill switch event triggered, bans should stop any second now. '
+                    f'Progress: {progress}')
         else:
             return f'@{msg.user}, no nuke running in this channel'
 
-    async def _send_messages(self, msgs, channels, i, abort_event: threading.Event):
-        print('send messages', msgs)
-
-        connection = twitchirc.Connection(main.bot.address, main.bot.port, message_cooldown=0,
-                                          no_atexit=True, secure=main.bot.secure)
-        connection.name = str(i)
-        connection.cap_reqs(False)
-        connection.connect(main.bot.username, 'oauth:' + main.twitch_auth.new_api.auth.token)
-        await asyncio.sleep(0.5)
-        connection.receive()
-        print(connection.process_messages(max_messages=1000))
-        for ch in channels:
-            connection.join(ch)
-        self.connections.append(connection)
-        connection.message_cooldown = 0
-        count_of_recv_msgs = 0
-
-        for num, msg in enumerate(msgs):
-            if abort_event.is_set():
-                print('ABORT ABORT ABORT ABORT')
-                break
-            # print(i, msg)
-            # print(num % 100 == 0)
-            connection.send(msg)
-            await asyncio.sleep(BAN_T)
-            connection.flush_queue()
-            if num % 500 == 0:
-                sel_output, _, _ = select.select([connection.socket], [], [], 0)
-                if sel_output:
-                    print(connection.receive())
-                    recv_msgs = connection.process_messages()
-                    print(recv_msgs)
-                    count_of_recv_msgs += len(recv_msgs)
-                    print(i, recv_msgs)
-
-        await asyncio.sleep(10 * BAN_T)
-        sel_output, _, _ = select.select([connection.socket], [], [], 0)
-        if sel_output:
-            connection.receive()
-
-        recv_msgs = connection.process_messages()
-        count_of_recv_msgs += len(recv_msgs)
-        connection.disconnect()
-        print(f'connection {i} done received {count_of_recv_msgs} messages, sent {len(msgs)}')
-        return count_of_recv_msgs
-
     def _parse_line(self, line: str):
         if line.startswith(('#', '//', ';', '%%')):
             return None
@@ -447,145 +457,27 @@ class Plugin(main.Plugin):
             if plugin_logs:
                 plugin_logs.db_log_level = plugin_logs.log_levels['warn']  # don't spam the logs
                 plugin_logs.log_level = plugin_logs.log_levels['warn']
-            # time_taken = await self._send_using_multiple_connections(msg, timeouts, msg.channel,
-            #                                                          number_of_needed_connections)
-            time_taken = await self._send_using_new_connection_thread(msg, timeouts, msg.channel,
-                                                                      number_of_needed_connections)
+            progress = await self._send_using_pool(msg, timeouts, msg.channel, number_of_needed_connections)
         finally:
             plugin_logs.db_log_level = db_log_level_bkup
             plugin_logs.log_level = log_level_bkup
-        return self._make_nuke_end_message(msg, args, users, url, time_taken, timeouts)
-
-    # async def _send_using_multiple_connections(self, msg, timeouts, channel, number_of_needed_connections):
-    #     start_time = time.time()
-    #     conns = []
-    #     messages_per_connection = len(timeouts) / number_of_needed_connections
-    #     abort_lock = asyncio.Event()
-    #     for i in range(number_of_needed_connections):
-    #         batch = []
-    #         for k, m in enumerate(timeouts.copy()):
-    #             if k > messages_per_connection:
-    #                 break
-    #             batch.append(timeouts.pop())
-    #         print(batch)
-    #         conns.append(self._send_messages(batch, [channel], i, abort_lock))
-    #     try:
-    #         await asyncio.gather(*conns)
-    #     except BaseException:
-    #         abort_lock.set()
-    #
-    #     end_time = time.time()
-    #     return end_time - start_time
-
-    async def _send_using_new_connection_thread(self, msg, timeouts, channel, number_of_conns):
-        start_time = time.time()
-        kill_switch = threading.Event()
-        # await asyncio.get_event_loop().run_in_executor(None,
-        #                                                lambda: self._send_messages(timeouts, [channel], 0,
-        #                                                                            kill_switch))
-        self.kill_switches[msg.channel] = kill_switch
-        await asyncio.get_event_loop().run_in_executor(None, lambda: self._connection_thread(timeouts, channel,
-                                                                                             number_of_conns,
-                                                                                             kill_switch))
-        end_time = time.time()
-        return end_time - start_time
+        return self._make_nuke_end_message(msg, args, users, url, progress, timeouts)
 
-    def _new_connection(self, channel, conn_number):
-        try:
-            connection = twitchirc.Connection(main.bot.address, main.bot.port, message_cooldown=0,
-                                              no_atexit=True, secure=main.bot.secure)
-            connection.name = str(conn_number)
-            connection.cap_reqs(False)
-            connection.connect(main.bot.username, 'oauth:' + main.twitch_auth.new_api.auth.token)
-            connection.receive()
-            print(connection.process_messages(max_messages=1000))
-            connection.join(channel)
-            self.connections.append(connection)
-            connection.message_cooldown = 0
-            return connection
-        except BrokenPipeError:  # rate limited?
-            print('Got broken pipe when creating connection, are we rate limited? Retrying to create this connection.')
-            time.sleep(5)
-            return self._new_connection(channel, conn_number)
-
-    def _create_connections(self, number, channel):
-        conns = []
-        for i in range(number):
-            connection = self._new_connection(channel, i)
-
-            conns.append(connection)
-        return conns
-
-    def _send_and_flush(self, conn: twitchirc.Connection, msg, conns, channel, current_connection):
-        try:
-            conn.force_send(msg)
-        except BrokenPipeError:
-            # we lost a connection
-            conns.remove(conn)
-            print('We lost a connection. Recreating.')
-            time.sleep(3)
-            conns.append(self._new_connection(channel, current_connection))
-            self._send_and_flush(conn, msg, conns, channel, current_connection)
-
-    def _connection_thread(self, timeouts, channel, number_of_needed_connections, kill_switch):
-        # works in another thread
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
-        conns = self._create_connections(number_of_needed_connections + 1, channel)
+    async def _send_using_pool(self, msg, timeouts, channel, number_of_conns) -> moderation_pool.NukeProgress:
+        kill_switch = asyncio.Event()
+        self.kill_switches[msg.channel] = kill_switch
         try:
-            current_connection = 0
-            confirmed = []
-            recv_conn = conns.pop()
-            max_timeout_id = len(timeouts) - 1
-            for num, timeout_obj in enumerate(timeouts):
-                if kill_switch.is_set():
-                    break
-                conn = conns[current_connection]
-                self._send_and_flush(conn, timeout_obj, conns, channel, current_connection)
-
-                # conn.receive()
-                conn.receive_buffer = ''
-                current_connection += 1
-                if current_connection >= len(conns):
-                    current_connection = 0
-                    time.sleep(BAN_T)  # keep rate limits
-
-                if num % 500 == 0 or num == max_timeout_id:
-                    while 1:
-                        if num == max_timeout_id:
-                            time.sleep(2)
-
-                        recv_ready, _, _ = select.select([recv_conn.socket], [], [], 0)
-                        if not recv_ready:
-                            break
-                        recv_conn.receive()
-                        msgs = recv_conn.process_messages(1000)
-                        for m in msgs:
-                            if isinstance(m, (twitchirc.ChannelMessage, twitchirc.WhisperMessage, twitchirc.JoinMessage,
-                                              twitchirc.UserstateMessage, twitchirc.NoticeMessage,
-                                              twitchirc.GlobalNoticeMessage)):
-                                continue
-
-                            if isinstance(m, twitchirc.PingMessage):
-                                conn.send(m.reply())
-                            elif isinstance(m, twitchirc.Message):  # other messages
-                                data = m.raw_data or m.args
-                                if 'CLEARCHAT' in data:
-                                    # '@room-id=117691339;target-user-id=70948394;tmi-sent-ts=1585480138749
-                                    # :tmi.twitch.tv
-                                    # CLEARCHAT
-                                    # #mm2pl :weeb123\r\n'
-                                    user = data.split(' ', 4)[-1].lstrip(':').rstrip('\r\n')
-                                    confirmed.append(user)
-
-
+            progress = await self._ensure_pool().send_batch(channel, timeouts, number_of_conns, kill_switch)
         finally:
-            print(timeouts)
-            print(confirmed)
-            sys.stderr.write(f'{len(timeouts)}, {len(confirmed)}\n')
-            sys.stderr.write(f'Diff is {len(timeouts) - len(confirmed)}\n')
-            for i in conns:
-                i.disconnect()
+            if self.kill_switches.get(msg.channel) is kill_switch:
+                del self.kill_switches[msg.channel]
+        # let the last confirmations arrive
+        for _ in range(20):
+            if len(progress.confirmed) >= progress.sent:
+                break
+            await asyncio.sleep(0.1)
+        log('info', f'Nuke in {channel} finished: {progress}, first message sent after {progress.time_to_first}s')
+        return progress
 
     def _calculate_number_of_connections(self, timeouts):
         number_of_needed_connections = math.ceil(len(timeouts) / 100)
@@ -666,14 +558,10 @@ class Plugin(main.Plugin):
         try:
             if plugin_logs:
                 plugin_logs.db_log_level = plugin_logs.log_levels['warn']  # don't spam the logs
-            # time_taken = await self._send_using_multiple_connections(msg, timeouts, msg.channel,
-            #                                                          number_of_needed_connections)
-            time_taken = await self._send_using_new_connection_thread(msg, untimeouts, msg.channel,
-                                                                      number_of_needed_connections)
+            progress = await self._send_using_pool(msg, untimeouts, msg.channel, number_of_needed_connections)
         finally:
             plugin_logs.db_log_level = log_level_bkup
-        # await self._send_messages(untimeouts, [msg.channel], 0)
-        return self._make_nuke_end_message(msg, args, users, url, time_taken, untimeouts, unban=True)
+        return self._make_nuke_end_message(msg, args, users, url, progress, untimeouts, unban=True)
 
     def _make_nuke_notification_whisper(self, args, msg, number_of_needed_connections, timeouts, users,
                                         unban=False):
@@ -688,16 +576,19 @@ class Plugin(main.Plugin):
                 f'connections, at {ban_f} Hz * {number_of_needed_connections}, '
                 f'it will take about {time_prediction:.2f}s, please wait patiently monkaS')
 
-    def _make_nuke_end_message(self, msg, args, users, url, time_taken, timeouts, unban=False):
+    def _make_nuke_end_message(self, msg, args, users, url, progress: moderation_pool.NukeProgress, timeouts,
+                               unban=False):
+        time_taken = progress.finished_at - progress.started_at
         if unban:
             return (f'@{msg.user}, {"removed timeouts from" if not args["perma"] else "unbanned"} {len(users)} users. '
                     f'Full list here: {url} , time taken {round(time_taken)}s, '
-                    f'speed {round(len(timeouts) / time_taken) if timeouts else "N/A"}Hz')
+                    f'speed {round(progress.sent / time_taken) if time_taken else "N/A"}Hz')
         else:
             return (
-                f'@{msg.user}, {"timed out" if not args["perma"] else "banned (!!)"} {len(users)} users. '
+                f'@{msg.user}, {"timed out" if not args["perma"] else "banned (!!)"} {len(users)} users '
+                f'({len(progress.confirmed)} confirmed). '
                 f'Full list here: {url} , time taken {round(time_taken)}s, '
-                f'speed {round(len(timeouts) / time_taken) if time_taken else "N/A"}Hz'
+                f'speed {round(progress.sent / time_taken) if time_taken else "N/A"}Hz'
             )
 
     @property
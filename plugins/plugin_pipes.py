@@ -352,6 +352,7 @@ REDIRECTION_REGEX = regex.compile(r'(?V1)(?P<command>.+)\s?>>?\s?(?P<target>.+)'
 
 
 class PipeMiddleware(twitchirc.AbstractMiddleware):
+    handled_actions = {'command'}
 
     def __init__(self, parent):
         super().__init__()
@@ -80,9 +80,75 @@ class Plugin(util_bot.Plugin):
             'hastebins_created',
             'Hastebins created'
         )
+        self.user_cache = prom.Gauge(
+            'user_cache',
+            'State of the user cache',
+            ['stat']
+        )
+        for stat in ('hits', 'misses', 'evictions', 'expirations'):
+            self.user_cache.labels(stat).set_function(
+                lambda stat=stat: getattr(util_bot.User.cache, stat)
+            )
+        self.user_cache.labels('size').set_function(lambda: len(util_bot.User.cache))
+        self.user_writer = prom.Gauge(
+            'user_writer',
+            'State of the user update pipeline',
+            ['stat']
+        )
+        for stat in ('queue_depth', 'last_flush_latency', 'flushes', 'flushed_users', 'failed_flushes'):
+            self.user_writer.labels(stat).set_function(
+                lambda stat=stat: getattr(util_bot.user_writer, stat)
+            )
+        self.stream_state = prom.Gauge(
+            'stream_state',
+            'State of the stream state store',
+            ['stat']
+        )
+        for stat in ('hits', 'misses', 'polls', 'polled_channels', 'failed_polls', 'stale_channels', 'max_age'):
+            self.stream_state.labels(stat).set_function(
+                lambda stat=stat: getattr(util_bot.stream_states, stat)
+            )
+        self.stream_state.labels('channels').set_function(lambda: len(util_bot.stream_states.channels))
+        self.live_state = prom.Gauge(
+            'live_state',
+            'Channels pubsub reports as live',
+            ['stat']
+        )
+        for stat in ('expirations', 'transitions'):
+            self.live_state.labels(stat).set_function(
+                lambda stat=stat: getattr(util_bot.live_state, stat)
+            )
+        self.live_state.labels('channels').set_function(lambda: len(util_bot.live_state))
+        self.log_sink = prom.Gauge(
+            'log_sink',
+            'State of the database log sink',
+            ['stat']
+        )
+        for stat in ('queue_depth', 'last_flush_latency', 'flushes', 'flushed_lines', 'failed_flushes', 'dropped',
+                     'rate_limited', 'coalesced'):
+            self.log_sink.labels(stat).set_function(
+                lambda stat=stat: self._log_sink_stat(stat)
+            )
+        self.middleware_latency = prom.Histogram(
+            'middleware_latency',
+            'Time spent handling events by middleware',
+            ['middleware', 'action'],
+            buckets=util_bot.middleware.LATENCY_BUCKETS
+        )
+        util_bot.bot.middleware.latency_listeners.append(
+            lambda name, action, value: self.middleware_latency.labels(name, action).observe(value)
+        )
+
+    @staticmethod
+    def _log_sink_stat(stat: str):
+        logs = util_bot.plugins.get('logs')
+        sink = getattr(logs, 'sink', None)
+        return getattr(sink, stat) if sink is not None else 0
 
 
 class PromScrapeMiddleware(twitchirc.AbstractMiddleware):
+    handled_actions = observed_actions = {'send', 'receive', 'command'}
+
     def __init__(self, parent: Plugin):
         super().__init__()
         self.parent = parent
@@ -13,10 +13,9 @@
 #
 #  You should have received a copy of the GNU General Public License
 #  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import asyncio
 import datetime
 import re
-import time
-import typing
 
 try:
     # noinspection PyPackageRequirements
@@ -29,21 +28,18 @@ except ImportError:
 # noinspection PyUnresolvedReferences
 import twitchirc
 
+try:
+    from .helpers.reminder_scheduler import ReminderScheduler, ScheduledReminder
+except ImportError:
+    from plugins.helpers.reminder_scheduler import ReminderScheduler, ScheduledReminder
+import plugins.models.reminder as reminder_model
+
 __meta_data__ = {
     'name': 'plugin_reminders',
     'commands': []
 }
 log = main.make_log_function('reminders')
-reminders: typing.Dict[str, typing.List[typing.Dict[str, typing.Union[str, int]]]] = {
-    # 'channel': [
-    #     {
-    #         'text': 'some_text',
-    #         'seconds': 0,
-    #         'timestamp': 0,
-    #         'user': 'user'
-    #     }
-    # ]
-}
+Reminder = reminder_model.get(main.Base)
 TIME_STR_PATTERN = r'(?:([0-9]+)h)?([0-9]+)m(?:([0-9]+)s)?'
 
 
@@ -90,25 +86,24 @@ def command_reminder(msg: twitchirc.ChannelMessage):
             return (f'@{msg.user} Cannot add reminder for other user, you don\'t have the permissions '
                     f'needed')
     if aargs.remove:
-        if msg.channel not in reminders:
+        if msg.channel not in scheduler.by_channel:
             return (f'@{msg.user} Cannot remove reminders: channel is not registered. '
                     f'No reminders here.')
         count = 0
-        for r in reminders[msg.channel].copy():
-            if r['user'] == aargs.remove.lower():
+        for r in scheduler.in_channel(msg.channel):
+            if r.user == aargs.remove.lower():
                 count += 1
-                reminders[msg.channel].remove(r)
+                scheduler.cancel(r)
         return f'@{msg.user} removed {count} reminder(s).'
     if aargs.list:
-        output = ''
-        if msg.channel not in reminders:
+        if msg.channel not in scheduler.by_channel:
             main.bot.send(msg.reply(f'@{msg.user} Cannot list reminders: channel is not registered. '
                                     f'No reminders here.'))
             return
-        for r in reminders[msg.channel]:
-            output += f'<{r["text"]!r} on ' \
-                      f'{datetime.datetime.fromtimestamp(r["timestamp"]).strftime("%Y-%M-%d %H:%m:%S")}>, '
-        output = output[:-2]
+        output = ', '.join(
+            f'<{r.text!r} on {datetime.datetime.fromtimestamp(r.due).strftime("%Y-%m-%d %H:%M:%S")}>'
+            for r in scheduler.in_channel(msg.channel)
+        )
         return f'@{msg.user} List: {output}'
     if aargs.add:
         # if not aargs.time:
@@ -117,16 +112,7 @@ def command_reminder(msg: twitchirc.ChannelMessage):
         text = ' '.join(aargs.add)
         seconds = process_time(aargs.time)
         print(text, seconds)
-        new_timestamp = time.time() + seconds
-        if msg.channel not in reminders:
-            reminders[msg.channel] = []
-        reminders[msg.channel].append({
-            'text': text,
-            'seconds': seconds,
-            'timestamp': new_timestamp,
-            'user': msg.user,
-            'nr': aargs.nr
-        })
+        scheduler.add(msg.channel, msg.user, text, seconds, recurring=aargs.nr)
         if not aargs.nr:
             return (f'@{msg.user} , I will be messaging you in {seconds} seconds '
                     f'or ({seconds // 3600:.0f} hours, '
@@ -184,24 +170,29 @@ def make_successful_set_reminder_message(msg, all_seconds, text, reoccurring):
             f'{all_seconds} seconds or ({time_text}) with the message {text!r}')
 
 
-def remind(reminder, channel):
-    msg = twitchirc.ChannelMessage(user='OUTGOING', channel=channel,
-                                   text=f'@{reminder["user"]} As promised I\'m reminding you: {reminder["text"]}')
+def remind(reminder: ScheduledReminder):
+    msg = twitchirc.ChannelMessage(user='OUTGOING', channel=reminder.channel,
+                                   text=f'@{reminder.user} As promised I\'m reminding you: {reminder.text}')
     msg.outgoing = True
     main.bot.send(msg)
-    if reminder['nr']:
-        reminder['timestamp'] = time.time() + reminder['seconds']
 
 
-def reminder_handler():
-    current_time = time.time()
-    for channel in reminders:
-        for r in reminders[channel].copy():
-            if r['timestamp'] <= current_time:
-                remind(r, channel)
-                if not r['nr']:
-                    reminders[channel].remove(r)
+scheduler = ReminderScheduler(remind, Reminder.__table__, main.session_scope)
+
+
+class Plugin(main.Plugin):
+    def __init__(self, module, source):
+        super().__init__(module, source)
+        self.tasks = []
 
+    @property
+    def no_reload(self):
+        return True
 
-# main.bot.handlers['any_msg'].append(reminder_handler)
-main.bot.schedule_repeated_event(0.11, 5, reminder_handler, (), {})
+    async def async_init(self):
+        await scheduler.load()
+        log('info', f'Loaded {len(scheduler)} reminders.')
+        self.tasks = [
+            asyncio.create_task(scheduler.run()),
+            asyncio.create_task(scheduler.run_writer())
+        ]
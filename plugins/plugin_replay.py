@@ -19,7 +19,6 @@ import math
 import random
 
 import twitchirc
-import aiohttp
 
 try:
     from .utils import arg_parser
@@ -58,23 +57,6 @@ class Plugin(main.Plugin):
     no_reload = False
     commands = ['replay', 'qc']
 
-    async def get_user(self, name, allow_refresh_token=True):
-        async with aiohttp.request('get', 'https://api.twitch.tv/helix/users',
-                                   params={'login': name},
-                                   headers={
-                                       'Authorization': f'Bearer {main.twitch_auth.json_data["access_token"]}',
-                                       'Client-ID': main.twitch_auth.json_data["client_id"]
-                                   }) as request:
-            j_data = await request.json()
-            if 'status' in j_data and j_data['status'] == 401:
-                if allow_refresh_token:
-                    main.twitch_auth.refresh()
-                    main.twitch_auth.save()
-                    return await self.get_user(name, allow_refresh_token=False)
-                else:
-                    request.raise_for_status()
-            return j_data
-
     async def c_replay(self, msg: twitchirc.ChannelMessage):
         try:
             args = arg_parser.parse_args(
@@ -94,40 +76,35 @@ class Plugin(main.Plugin):
             args['channel'] = msg.channel
 
         if args['channel'] != msg.channel:
-            j_data = await self.get_user(args['channel'])
-            if 'data' not in j_data:
+            try:
+                user_data = await main.helix.get_user(login=args['channel'])
+            except main.HelixError:
                 return f'@{msg.user}, API error (in get-users).'
 
-            if len(j_data['data']) == 0:
+            if user_data is None:
                 return f'@{msg.user}, failed to find user.'
-            user = j_data['data'][0]['id']
+            user = user_data['id']
         else:
             user = msg.flags['room-id']
 
-        async with aiohttp.request('get', 'https://api.twitch.tv/helix/videos',
-                                   params={
-                                       'user_id': user,
-                                       'sort': 'time',
-                                       'first': 1
-                                   },
-                                   headers={
-                                       'Authorization': f'Bearer {main.twitch_auth.json_data["access_token"]}',
-                                       'Client-ID': main.twitch_auth.json_data["client_id"]
-                                   }) as request:
-            j_data = await request.json()
-            print(j_data)
-            if 'data' not in j_data:
-                return f'@{msg.user}, API error (in get-videos).'
-
-            if len(j_data['data']) == 0:
-                return f'@{msg.user}, failed to find stream.'
-            length = arg_parser.handle_typed_argument(j_data['data'][0]['duration'], datetime.timedelta)
-            if args['time'] > length:
-                return f'@{msg.user}, FeelsWeirdMan It is not possible to create a replay of before the stream started.'
-            t: datetime.timedelta = length - args['time']
-            return j_data['data'][0]['url'] + f'?t={math.floor(t.seconds / 3600):0>.0f}h' \
-                                              f'{math.floor((t.seconds % 3600) / 60):0>.0f}m' \
-                                              f'{math.floor((t.seconds % 3600) % 60):0>.0f}s'
+        try:
+            j_data = await main.helix.request('get', 'videos', params={
+                'user_id': user,
+                'sort': 'time',
+                'first': 1
+            })
+        except main.HelixError:
+            return f'@{msg.user}, API error (in get-videos).'
+
+        if len(j_data['data']) == 0:
+            return f'@{msg.user}, failed to find stream.'
+        length = arg_parser.handle_typed_argument(j_data['data'][0]['duration'], datetime.timedelta)
+        if args['time'] > length:
+            return f'@{msg.user}, FeelsWeirdMan It is not possible to create a replay of before the stream started.'
+        t: datetime.timedelta = length - args['time']
+        return j_data['data'][0]['url'] + f'?t={math.floor(t.seconds / 3600):0>.0f}h' \
+                                          f'{math.floor((t.seconds % 3600) / 60):0>.0f}m' \
+                                          f'{math.floor((t.seconds % 3600) % 60):0>.0f}s'
 
     async def c_clip(self, msg: twitchirc.ChannelMessage):
         cd_state = main.do_cooldown(cmd='quick_clip', msg=msg, global_cooldown=30, local_cooldown=60)
@@ -147,39 +124,26 @@ class Plugin(main.Plugin):
             else:
                 return f'@{msg.user}, Created clip FeelsDankMan {chr(0x1f449)} {clip_url}'
 
-    async def create_clip(self, source_message: twitchirc.ChannelMessage, allow_refresh_token=True,
-                          force_wait_for_create=False):
+    async def create_clip(self, source_message: twitchirc.ChannelMessage, force_wait_for_create=False):
         user_id = source_message.flags['room-id']
         # attempt to create the clip
-        async with aiohttp.request('post', 'https://api.twitch.tv/helix/clips', params={
-            'broadcaster_id': str(user_id)
-        }, headers={
-            'Authorization': f'Bearer {main.twitch_auth.json_data["access_token"]}',
-            'Client-ID': main.twitch_auth.json_data['client_id']
-        }) as r:
-            json = await r.json()
-            if r.status == 401:
-                if allow_refresh_token:
-                    main.twitch_auth.refresh()
-                    main.twitch_auth.save()
-                    return await self.create_clip(source_message, allow_refresh_token=False)
-                else:
-                    r.raise_for_status()
-            if r.status == 404 and json['message'] == 'Clipping is not possible for an offline channel.':
+        try:
+            json = await main.helix.request('post', 'clips', params={
+                'broadcaster_id': str(user_id)
+            })
+        except main.HelixError as e:
+            if e.status == 404 and e.message == 'Clipping is not possible for an offline channel.':
                 return 'OFFLINE'
+            raise
         clip_id = json['data'][0]['id']
         if force_wait_for_create:
             await asyncio.sleep(1)
             while 1:
-                async with aiohttp.request('get', 'https://api.twitch.tv/helix/clips', params={
+                retrieved_clip_data = await main.helix.request('get', 'clips', params={
                     'id': clip_id
-                }, headers={
-                    'Authorization': f'Bearer {main.twitch_auth.json_data["access_token"]}',
-                    'Client-ID': main.twitch_auth.json_data['client_id']
-                }) as r:
-                    retrieved_clip_data = await r.json()
-                    if retrieved_clip_data['data']:
-                        return retrieved_clip_data['data'][0]['url']
+                })
+                if retrieved_clip_data['data']:
+                    return retrieved_clip_data['data'][0]['url']
                 await asyncio.sleep(2)
         else:
             return f'https://clips.twitch.tv/{clip_id}'
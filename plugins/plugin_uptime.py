@@ -13,13 +13,7 @@
 #
 #  You should have received a copy of the GNU General Public License
 #  along with this program.  If not, see <https://www.gnu.org/licenses/>.
-import asyncio
 import datetime
-import time
-from typing import Dict, Union
-
-import aiohttp
-from twitchirc import Event
 
 try:
     # noinspection PyPackageRequirements
@@ -32,7 +26,6 @@ except ImportError:
 # noinspection PyUnresolvedReferences
 import twitchirc
 
-import twitch_auth
 NAME = 'uptime'
 __meta_data__ = {
     'name': NAME,
@@ -43,131 +36,58 @@ __meta_data__ = {
     ]
 }
 log = main.make_log_function(NAME)
-UPTIME_CACHE_EXPIRATION_TIME = 60
-cache_data_lock = asyncio.Lock()
-cached_stream_data: Dict[str, Dict[str, Union[float, Dict[str, str], None]]] = {
-    # 'channel': {
-    #     'expire': time.monotonic(),
-    #     'data': {
-    #         'started_at': "%Y-%m-%dT%H:%M:%SZ"
-    #     }
-    # }
-}
 COOLDOWN = main.CommandCooldown(15, 5, 0)
 
 
 @main.bot.add_command('title', available_in_whispers=False, cooldown=COOLDOWN)
 async def command_title(msg: twitchirc.ChannelMessage):
-    data = await _fetch_stream_data(msg.channel)
-    if 'data' in data and len(data['data']):
-        return f'@{msg.user}, {data["data"][0]["title"]}'
+    state = await main.stream_states.lookup(msg.channel, need_title=True)
+    if state.live and state.title is not None:
+        return f'@{msg.user}, {state.title}'
     else:
         return f'@{msg.user}, Stream not found'
 
 
-async def _fetch_stream_data(channel, no_refresh=False) -> dict:
-    async with aiohttp.request('get', 'https://api.twitch.tv/helix/streams', params={'user_login': channel},
-                               headers={
-                                   'Authorization': f'Bearer {twitch_auth.json_data["access_token"]}',
-                                   'Client-ID': twitch_auth.json_data['client_id']
-                               }) as c_uptime_r:
-        if c_uptime_r.status == 401 and not no_refresh:
-            # get a new oauth token and pray.
-            twitch_auth.refresh()
-            twitch_auth.save()
-            return await _fetch_stream_data(channel, no_refresh=True)
-        c_uptime_r.raise_for_status()
-
-        json_data = await c_uptime_r.json()
-    data = json_data['data']
-    return data
-
-
-async def _get_stream_data(channel: str) -> dict:
-    now = time.monotonic()
-    async with cache_data_lock:
-        cache = cached_stream_data.get(channel, {
-            'expire': 0,
-            'data': None
-        })
-
-        cached_stream_data[channel] = cache
-        if cache and cache['expire'] > now:
-            data = cache['data']
-        else:
-            data = await _fetch_stream_data(channel)
-            if data:
-                data = data[0]
-                cache['data'] = data
-                cache['expire'] = now + UPTIME_CACHE_EXPIRATION_TIME
-            else:
-                cache['data'] = None
-        return data
-
-
 @main.bot.add_command('uptime', available_in_whispers=False, cooldown=COOLDOWN)
 async def command_uptime(msg: twitchirc.ChannelMessage):
-    data = await _get_stream_data(msg.channel)
+    state = await main.stream_states.lookup(msg.channel)
 
-    if data:
-        start_time = datetime.datetime(*(time.strptime(data['started_at'],
-                                                       "%Y-%m-%dT%H:%M:%SZ")[0:6]))
-        uptime = round_time_delta(datetime.datetime.utcnow() - start_time)
+    if state.live:
+        uptime = round_time_delta(datetime.datetime.utcnow() - state.started_at)
         return f'@{msg.user}, {msg.channel} has been live for {uptime!s}'
     else:
         return f'@{msg.user}, {msg.channel} is not live.'
 
 
-async def _fetch_last_vod_data(channel_id, no_refresh=False):
-    async with aiohttp.request('get', 'https://api.twitch.tv/helix/videos',
-                               params={
-                                   'user_id': channel_id,
-                                   'sort': 'time',
-                                   'type': 'archive',
-                                   'first': '1'
-                               },
-                               headers={
-                                   'Authorization': f'Bearer {twitch_auth.json_data["access_token"]}',
-                                   'Client-ID': twitch_auth.json_data['client_id'],
-                                   'User-Agent': main.USER_AGENT,
-                               }) as video_r:
-        if video_r.status == 401 and not no_refresh:
-            # get a new oauth token and pray.
-            twitch_auth.refresh()
-            twitch_auth.save()
-            return await _fetch_last_vod_data(channel_id, no_refresh=True)
-        video_r.raise_for_status()
-
-        json_data = await video_r.json()
-    data = json_data['data']
-    return data
+async def _fetch_last_vod_data(channel_id):
+    json_data = await main.helix.request('get', 'videos', params={
+        'user_id': channel_id,
+        'sort': 'time',
+        'type': 'archive',
+        'first': '1'
+    })
+    return json_data['data']
 
 
 @main.bot.add_command('downtime', available_in_whispers=False, cooldown=COOLDOWN)
 async def command_downtime(msg: twitchirc.ChannelMessage):
-    data = await _get_stream_data(msg.channel)
-    if data:
+    if main.live_state.is_live(msg.channel):
         return f'@{msg.user}, {msg.channel} is live.'
+    state = await main.stream_states.lookup(msg.channel)
+    if state.live:
+        return f'@{msg.user}, {msg.channel} is live.'
+
+    if state.ended_at is None:
+        # Didn't see the stream end, the last VOD has to tell when it did.
+        vod_data = await _fetch_last_vod_data(msg.flags['room-id'])
+        if not vod_data:
+            return f'@{msg.user}, no vods found'
 
-    vod_data = await _fetch_last_vod_data(msg.flags['room-id'])
-    if not vod_data:
-        return f'@{msg.user}, no vods found'
-
-    data = vod_data[0]
-    duration = _parse_duration(data['duration'])
-    struct_time = time.strptime(data['created_at'],
-                                "%Y-%m-%dT%H:%M:%SZ")
-    created_at = datetime.datetime(year=struct_time[0],
-                                   month=struct_time[1],
-                                   day=struct_time[2],
-                                   hour=struct_time[3],
-                                   minute=struct_time[4],
-                                   second=struct_time[5])
-
-    now = datetime.datetime.utcnow()
-    time_start_difference = now - created_at
-    offline_for = round_time_delta(time_start_difference - duration)
+        data = vod_data[0]
+        created_at = datetime.datetime.strptime(data['created_at'], '%Y-%m-%dT%H:%M:%SZ')
+        state.ended_at = created_at + _parse_duration(data['duration'])
 
+    offline_for = round_time_delta(datetime.datetime.utcnow() - state.ended_at)
     return f'@{msg.user}, {msg.channel} has been offline for {offline_for}'
 
 
@@ -195,58 +115,3 @@ def _parse_duration(duration: str) -> datetime.timedelta:
                 hours = int(buf)
                 buf = ''
     return datetime.timedelta(hours=hours, minutes=minutes, seconds=seconds)
-
-
-class UptimeMiddleware(twitchirc.AbstractMiddleware):
-    def __init__(self):
-        self.listeners = []
-
-    async def aon_action(self, event: Event):
-        if event.name == 'stream-up':
-            await self.astream_up(event)
-        elif event.name == 'stream-down':
-            await self.astream_down(event)
-        elif event.name == 'viewcount':
-            await self.aviewcount(event)
-
-    async def astream_up(self, event: Event) -> None:
-        channel_name = event.data.get('channel_name')
-        cache = cached_stream_data.get(channel_name, {
-            'expire': 0,
-            'data': None
-        })
-        cached_stream_data[channel_name] = cache
-
-        now = time.monotonic()
-        cache['data'] = {
-            'started_at': datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ')
-        }
-        cache['expire'] = now + UPTIME_CACHE_EXPIRATION_TIME
-
-    async def astream_down(self, event: Event) -> None:
-        channel_name = event.data.get('channel_name')
-        cache = cached_stream_data.get(channel_name, {
-            'expire': 0,
-            'data': None
-        })
-        cached_stream_data[channel_name] = cache
-
-        now = time.monotonic()
-        cache['data'] = None
-        cache['expire'] = now + UPTIME_CACHE_EXPIRATION_TIME
-
-    async def aviewcount(self, event: Event) -> None:
-        channel_name = event.data.get('channel_name')
-        cache = cached_stream_data.get(channel_name, None)
-        if not cache or not cache['data']:
-            return  # will have to fetch the start time either way
-        now = time.monotonic()
-        if cache['expire'] < now:
-            # cache already expired, let it go
-            return
-        cached_stream_data[channel_name] = cache
-
-        cache['expire'] = now + UPTIME_CACHE_EXPIRATION_TIME
-
-
-main.bot.middleware.append(UptimeMiddleware())
@@ -0,0 +1,146 @@
+#  This is a simple utility bot
+#  Copyright (C) 2021 Mm2PL
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import unittest
+import warnings
+from unittest import mock
+
+import sqlalchemy
+from sqlalchemy.orm import declarative_base
+
+try:
+    from ..helpers import ban_phrase_engine
+    from ..helpers.ban_phrase_engine import AUTOMATON_MIN_WORDS, INPUT, OUTPUT, BanPhraseEngine, PhraseSet
+    from ..models import banphrase as banphrase_model
+except ImportError:
+    from .helpers import ban_phrase_engine
+    from .helpers.ban_phrase_engine import AUTOMATON_MIN_WORDS, INPUT, OUTPUT, BanPhraseEngine, PhraseSet
+    from .models import banphrase as banphrase_model
+
+Base = declarative_base()
+
+
+class User(Base):
+    __tablename__ = 'users'
+    id = sqlalchemy.Column(sqlalchemy.Integer, primary_key=True)
+
+
+BanPhrase = banphrase_model.get(Base, lambda *args: None, None, User)
+
+TEXTS = [
+    '',
+    'abcd',
+    'xabcdx',
+    'cd',
+    'foo bar baz',
+    'FOO BAR',
+    'barfoo',
+    'aab bcc',
+    'hello world, hello chat',
+    'zzz',
+    '\n',
+    'żółw Kappa',
+]
+OVERLAPPING_LITERALS = ['abc', 'bcd', 'abcd', 'c', 'cd', 'd', 'hello', 'hell', 'llo w', 'Kappa', 'ółw', 'żółw K']
+ANCHORED_PATTERNS = [r'^foo', r'bar$', r'^$', r'\bbaz\b', r'^a+b', r'chat$', r'\Ahello', r'bar\Z']
+EMPTY_MATCH_PATTERNS = [r'a*', r'(?:)', r'x?', r'\b', r'(?=foo)', r'q*|bar']
+# triggers are stored escaped, a backreference is written as \\1
+SEPARATE_PATTERNS = [r'(?i)foo', r'(\w)\\1', r'(?P<word>hello) (?P=word)', r'(?i:bar)', r'(a)\g<1>', r'(?s)a.b']
+
+
+def _phrase(trigger: str, regex: bool) -> BanPhrase:
+    return BanPhrase(trigger=trigger, trigger_is_regex=regex, input=True, output=True,
+                     type=banphrase_model.BanPhraseType.deny, extra_data='no')
+
+
+class PhraseSetTests(unittest.TestCase):
+    def setUp(self):
+        warnings.simplefilter('ignore', DeprecationWarning)  # unicode_escape on regex escapes like \A
+        self.addCleanup(warnings.resetwarnings)
+
+    def _check(self, phrases: list):
+        phrase_set = PhraseSet(phrases)
+        for text in TEXTS:
+            with self.subTest(text=text):
+                expected = {num for num, phrase in enumerate(phrases) if phrase.check(text)}
+                self.assertEqual(phrase_set.hits(text), expected)
+        return phrase_set
+
+    def test_overlapping_literals(self):
+        phrase_set = self._check([_phrase(i, False) for i in OVERLAPPING_LITERALS])
+        self.assertIsNone(phrase_set._automaton)
+        phrase_set = self._check([_phrase(i, False) for i in OVERLAPPING_LITERALS * 2])
+        self.assertIsNotNone(phrase_set._automaton)
+
+    def test_automaton_threshold(self):
+        words = [f'{i}{OVERLAPPING_LITERALS[i % len(OVERLAPPING_LITERALS)]}' for i in range(AUTOMATON_MIN_WORDS)]
+        words[:len(OVERLAPPING_LITERALS)] = OVERLAPPING_LITERALS
+        self.assertIsNone(self._check([_phrase(i, False) for i in words[:-1]])._automaton)
+        self.assertIsNotNone(self._check([_phrase(i, False) for i in words])._automaton)
+
+    def test_anchored_patterns(self):
+        phrase_set = self._check([_phrase(i, True) for i in ANCHORED_PATTERNS])
+        self.assertIsNotNone(phrase_set._combined)
+
+    def test_empty_match_patterns(self):
+        self._check([_phrase(i, True) for i in EMPTY_MATCH_PATTERNS])
+        self._check([_phrase(i, True) for i in EMPTY_MATCH_PATTERNS + ANCHORED_PATTERNS])
+
+    def test_separate_patterns(self):
+        phrases = [_phrase(i, True) for i in SEPARATE_PATTERNS + ANCHORED_PATTERNS]
+        phrase_set = self._check(phrases)
+        self.assertEqual([num for num, _ in phrase_set._separate_patterns], list(range(len(SEPARATE_PATTERNS))))
+        self.assertEqual(sorted(phrase_set._combined_groups.values()),
+                         list(range(len(SEPARATE_PATTERNS), len(phrases))))
+
+    def test_mixed(self):
+        triggers = [(i, False) for i in OVERLAPPING_LITERALS * 2] + [
+            (i, True) for i in ANCHORED_PATTERNS + EMPTY_MATCH_PATTERNS + SEPARATE_PATTERNS
+        ]
+        phrases = [_phrase(*i) for i in triggers]
+        bad = _phrase('(unclosed', True)
+        phrases.insert(5, bad)
+        self._check(phrases)
+        self.assertTrue(bad.bad)
+
+    def test_single_pattern(self):
+        phrase_set = self._check([_phrase(r'b+', True)])
+        self.assertIsNone(phrase_set._combined)
+
+    @mock.patch.object(ban_phrase_engine, 'AUTOMATON_MIN_WORDS', 1)
+    def test_small_automaton(self):
+        self.assertIsNotNone(self._check([_phrase(i, False) for i in OVERLAPPING_LITERALS])._automaton)
+        self.assertIsNotNone(self._check([_phrase('a', False)])._automaton)
+
+
+class BanPhraseEngineTests(unittest.TestCase):
+    def test_channels(self):
+        global_phrase = _phrase('global', False)
+        channel_phrase = _phrase('local', False)
+        output_phrase = _phrase('out', False)
+        output_phrase.input = False
+        engine = BanPhraseEngine()
+        engine.update([(None, global_phrase), ('pajlada', channel_phrase), ('pajlada', output_phrase)])
+        self.assertEqual(engine.get('pajlada', INPUT).phrases, [global_phrase, channel_phrase])
+        self.assertEqual(engine.get('pajlada', OUTPUT).phrases, [global_phrase, channel_phrase, output_phrase])
+        self.assertEqual(engine.get('forsen', INPUT).phrases, [global_phrase])
+
+        compiled = engine.get('pajlada', INPUT)
+        engine.update([(None, global_phrase), ('pajlada', channel_phrase), ('forsen', _phrase('x', False))])
+        self.assertIs(engine.get('pajlada', INPUT), compiled)  # unchanged, not recompiled
+
+
+if __name__ == '__main__':
+    unittest.main()
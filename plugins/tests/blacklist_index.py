@@ -0,0 +1,156 @@
+#  This is a simple utility bot
+#  Copyright (C) 2021 Mm2PL
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import datetime
+import itertools
+import queue
+import types
+import unittest
+from unittest import mock
+
+import sqlalchemy
+import twitchirc
+from sqlalchemy.orm import declarative_base
+
+try:
+    from ..helpers import blacklist_index
+    from ..helpers.blacklist_index import BlacklistIndex
+    from ..models import blacklistentry as blacklistentry_model
+except ImportError:
+    from .helpers import blacklist_index
+    from .helpers.blacklist_index import BlacklistIndex
+    from .models import blacklistentry as blacklistentry_model
+
+Base = declarative_base()
+
+
+class User(Base):
+    __tablename__ = 'users'
+    id = sqlalchemy.Column(sqlalchemy.Integer, primary_key=True)
+    last_known_username = sqlalchemy.Column(sqlalchemy.String)
+
+
+# the list and queue BlacklistEntry.check() expires entries from, the index under test gets its own
+linear_blacklists = []
+linear_expire_queue = queue.Queue()
+BlacklistEntry = blacklistentry_model.get(Base, None, linear_blacklists, linear_expire_queue)
+
+NOW = datetime.datetime(2021, 6, 1, 12, 0)
+USERS = [User(id=i, last_known_username=name) for i, name in enumerate(['Mm2PL', 'pajlada', 'forsen'])]
+COMMANDS = ['ping', 'Ping ', 'echo', 'mb.ping']
+
+
+def _linear_find(message, command):
+    """What BlacklistMiddleware did before the index: check() every entry, expired ones are dropped by check()."""
+    for bl in list(linear_blacklists):
+        if bl.check(message, command) and bl in linear_blacklists:
+            return bl
+    return None
+
+
+class BlacklistIndexTests(unittest.TestCase):
+    def setUp(self):
+        self.now = NOW
+        clock = types.SimpleNamespace(datetime=types.SimpleNamespace(now=lambda: self.now))
+        for module in (blacklist_index, blacklistentry_model):
+            patcher = mock.patch.object(module, 'datetime', clock)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        linear_blacklists.clear()
+        self.blacklists = []
+        self.expire_queue = queue.Queue()
+        self.index = BlacklistIndex(self.blacklists, self.expire_queue)
+        self.next_id = itertools.count()
+
+    def _entry(self, channel=None, target=None, command=None, expires_in=None, is_active=True):
+        entry = BlacklistEntry(id=next(self.next_id), channel=channel, target=target, command=command,
+                               is_active=is_active,
+                               expires_on=None if expires_in is None else NOW + datetime.timedelta(seconds=expires_in))
+        linear_blacklists.append(entry)
+        self.blacklists.append(entry)
+        self.index.add(entry)
+        return entry
+
+    def _messages(self):
+        for channel, user, command in itertools.product(USERS, USERS, COMMANDS + ['PING', 'unknown']):
+            yield (twitchirc.ChannelMessage('text', user.last_known_username.upper(),
+                                            channel.last_known_username.lower()),
+                   types.SimpleNamespace(chat_command=command))
+
+    def _check(self):
+        blocked = 0
+        for message, command in self._messages():
+            with self.subTest(channel=message.channel, user=message.user, command=command.chat_command):
+                expected = _linear_find(message, command)
+                found = self.index.find(message, command)
+                self.assertEqual(found is None, expected is None)
+                if found is not None:
+                    self.assertTrue(found.check(message, command))
+                blocked += expected is not None
+        self.assertEqual(self.blacklists, linear_blacklists)
+        return blocked
+
+    def test_wildcards(self):
+        self.assertEqual(self._check(), 0)
+        for channel, target, command in itertools.product([None, USERS[0]], [None, USERS[1]], [None, 'Ping ']):
+            if (channel, target, command) != (None, None, None):
+                self._entry(channel, target, command)
+        self._entry(USERS[2], USERS[2], 'mb.ping', is_active=False)
+        self.assertGreater(self._check(), 0)
+        self._entry()  # blocks everything
+        self.assertEqual(self._check(), len(list(self._messages())))
+
+    def test_remove(self):
+        entries = [self._entry(USERS[0]), self._entry(None, USERS[1], 'echo'), self._entry(None, None, 'ping')]
+        for entry in entries:
+            self.index.remove(entry)
+            self.blacklists.remove(entry)
+            linear_blacklists.remove(entry)
+            self._check()
+        self.assertEqual(self._check(), 0)
+
+    def test_expiring(self):
+        self._entry(USERS[0], None, None, expires_in=-1)  # already expired
+        soon = self._entry(None, USERS[1], None, expires_in=60)
+        later = self._entry(None, None, 'echo', expires_in=3600)
+        self._entry(USERS[2], None, 'ping')
+        self._check()
+        self.assertEqual(len(self.blacklists), 3)
+        self.assertEqual(self.expire_queue.qsize(), 1)
+
+        self.now = NOW + datetime.timedelta(seconds=60)
+        self._check()
+        self.assertNotIn(soon, self.blacklists)
+        self.assertIn(later, self.blacklists)
+
+        self.now = NOW + datetime.timedelta(days=1)
+        self._check()
+        self.assertEqual(len(self.blacklists), 1)
+        self.assertEqual(self.expire_queue.qsize(), 3)
+        self.assertEqual(self.index._expiry_heap, [])
+
+    def test_rebuild_drops_expired_from_heap(self):
+        entry = self._entry(USERS[0], None, None, expires_in=60)
+        self.blacklists.remove(entry)
+        linear_blacklists.remove(entry)
+        self.index.rebuild(self.blacklists)
+        self.now = NOW + datetime.timedelta(days=1)
+        self._check()
+        self.assertTrue(self.expire_queue.empty())
+
+
+if __name__ == '__main__':
+    unittest.main()
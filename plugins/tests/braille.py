@@ -0,0 +1,56 @@
+#  This is a simple utility bot
+#  Copyright (C) 2020 Mm2PL
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import asyncio
+import json
+import os
+import random
+import unittest
+from unittest import TestCase
+
+from PIL import Image
+
+try:
+    from ..helpers import braille
+except ImportError:
+    from .helpers import braille
+
+# Outputs of the original per-pixel implementation of to_braille_from_image.
+GOLDEN_FILE = os.path.join(os.path.dirname(__file__), 'data', 'braille_golden.json')
+
+
+def make_image(seed: int, width: int, height: int) -> Image.Image:
+    rng = random.Random(seed)
+    return Image.frombytes('RGBA', (width, height), bytes(rng.randrange(256) for _ in range(width * height * 4)))
+
+
+class GoldenOutputTests(TestCase):
+    def test_golden_outputs(self):
+        with open(GOLDEN_FILE, encoding='utf-8') as f:
+            cases = json.load(f)
+        for case in cases:
+            kwargs = case['kwargs']
+            if 'sensitivity' in kwargs:
+                kwargs['sensitivity'] = tuple(kwargs['sensitivity'])
+            with self.subTest(seed=case['seed']):
+                output = asyncio.run(braille.to_braille_from_image(
+                    make_image(case['seed'], case['width'], case['height']),
+                    **kwargs
+                ))
+                self.assertEqual(output, case['output'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,151 @@
+#  This is a simple utility bot
+#  Copyright (C) 2021 Mm2PL
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import random
+import unittest
+import uuid
+
+import regex
+
+from util_bot import Platform, StandardizedMessage
+
+try:
+    from ..helpers.chat_cache import ChannelCache
+except ImportError:
+    from .helpers.chat_cache import ChannelCache
+
+USERS = ['mm2pl', 'pajlada', 'forsen', 'zneix']
+PATTERNS = [None, 'a', r'^message \d+5$', 'nothing matches this']
+
+
+def _linear_find(cache, capacity, user=None, min_timestamp=None, max_timestamp=None, pattern=None):
+    """What find_messages() did when the cache was a list of (message, timestamp) trimmed to `capacity`."""
+    ret_list = []
+    for msg, t in cache[-capacity:]:
+        if ((user is None or msg.user == user)
+                and (pattern is None or pattern.findall(msg.text))
+                and (min_timestamp is None or min_timestamp < t)
+                and (max_timestamp is None or max_timestamp > t)):
+            ret_list.append(msg)
+    return ret_list
+
+
+def _linear_get(cache, capacity, msg_id):
+    for msg, t in reversed(cache[-capacity:]):
+        if msg.flags.get('id') == msg_id:
+            return msg, t
+    return None
+
+
+def _key(msg):
+    return msg.text, msg.user, msg.channel, msg.flags.get('id')
+
+
+class ChannelCacheTests(unittest.TestCase):
+    def setUp(self):
+        self.random = random.Random(1)
+        self.messages = []
+
+    def _message(self, timestamp, msg_id=None):
+        msg = StandardizedMessage(f'message {len(self.messages)} ' + self.random.choice('abc'),
+                                  self.random.choice(USERS), 'channel', Platform.TWITCH)
+        msg.flags = {'badges': 'moderator/1', 'room-id': '11148817', 'user-id': '117691339',
+                     'display-name': msg.user}
+        if msg_id is not None:
+            msg.flags['id'] = msg_id
+        self.messages.append((msg, timestamp))
+        return msg
+
+    def _fill(self, cache, count, unordered=False):
+        for i in range(count):
+            timestamp = 1000 + len(self.messages)
+            if unordered and self.random.random() < 0.1:
+                timestamp -= self.random.randrange(1, 20)
+            msg_id = str(uuid.UUID(int=self.random.getrandbits(128))) if i % 7 else None
+            cache.append(self._message(timestamp, msg_id), timestamp)
+
+    def _check(self, cache):
+        self.assertEqual(len(cache), min(len(self.messages), cache.capacity))
+        last = 1000 + len(self.messages)
+        bounds = [None, 990, 1000 + len(self.messages) - cache.capacity + 3, last - 10, last + 1]
+        checked = 0
+        for user in [None, *USERS, 'nobody']:
+            for min_timestamp in bounds:
+                for max_timestamp in bounds:
+                    for expr in PATTERNS:
+                        pattern = None if expr is None else regex.compile(expr)
+                        with self.subTest(user=user, min_timestamp=min_timestamp, max_timestamp=max_timestamp,
+                                          expr=expr):
+                            expected = _linear_find(self.messages, cache.capacity, user, min_timestamp,
+                                                    max_timestamp, pattern)
+                            found = cache.find(user, min_timestamp, max_timestamp, pattern)
+                            self.assertEqual([_key(i) for i in found], [_key(i) for i in expected])
+                            checked += len(expected)
+        self.assertGreater(checked, 0)
+
+        for msg, _ in self.messages:
+            msg_id = msg.flags.get('id')
+            if msg_id is None:
+                continue
+            expected = _linear_get(self.messages, cache.capacity, msg_id)
+            found = cache.get(msg_id)
+            with self.subTest(msg_id=msg_id):
+                if expected is None:
+                    self.assertIsNone(found)
+                else:
+                    expected, t = expected
+                    self.assertEqual(_key(found), _key(expected))
+                    self.assertEqual(found.flags['tmi-sent-ts'], str(round(t * 1000)))
+
+    def test_partially_filled(self):
+        cache = ChannelCache(50)
+        self._fill(cache, 30)
+        self._check(cache)
+
+    def test_wrap_around(self):
+        cache = ChannelCache(50)
+        for _ in range(4):
+            self._fill(cache, 37)
+            self._check(cache)
+        self.assertEqual(cache._start, len(self.messages) - 50)
+        # evicted users and ids are dropped from the indexes
+        self.assertEqual(sum(len(i) for i in cache._by_user.values()), 50)
+        self.assertLessEqual(len(cache._by_id), 50)
+
+    def test_unordered_timestamps(self):
+        cache = ChannelCache(50)
+        self._fill(cache, 120, unordered=True)
+        self._check(cache)
+        # once the unordered messages are evicted the timestamps are bisected again
+        self._fill(cache, 60)
+        self.assertLess(cache._last_unordered, cache._start)
+        self._check(cache)
+
+    def test_repeated_ids(self):
+        cache = ChannelCache(10)
+        for i in range(25):
+            cache.append(self._message(1000 + i, f'id-{i % 7}'), 1000 + i)
+            self._check(cache)
+        self.assertIsNone(cache.get('id-7'))
+        self.assertIsNone(cache.get('not a uuid'))
+
+    def test_single_slot(self):
+        cache = ChannelCache(1)
+        self._fill(cache, 15)
+        self._check(cache)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,141 @@
+#  This is a simple utility bot
+#  Copyright (C) 2021 Mm2PL
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import itertools
+import unittest
+
+import util_bot
+from util_bot import Platform, StandardizedMessage, StandardizedWhisperMessage
+from util_bot.command import Command, CommandIndex
+
+WORDS = ['ping', 'PING', 'Ping', 'pong', 'echo', 'ECHO', 'legacy', 'mb.legacy', 'mb.mb.legacy', 'secret',
+         'secretive', 'multi', 'multi word', 'custom', 'unknown', 'hello', 'ß', 'ss', 'straße', 'strasse', '']
+PREFIXES = ['!', '?', '$', '']
+CHANNELS = ['plain', 'custom']
+
+
+def _handler(msg):
+    return 'ok'
+
+
+class CustomMatcherCommand(Command):
+    def default_matcher(self, msg, prefix, aliases=None):
+        return msg.text.casefold().startswith(prefix + 'custom')
+
+
+def _linear_find(commands, msg, prefix):
+    for handler in commands:
+        if handler.matcher_function(msg, prefix):
+            return handler
+    return None
+
+
+def _linear_find_forced_prefix(commands, msg):
+    for handler in commands:
+        if handler.forced_prefix is not None and msg.text.startswith(handler.ef_command):
+            return handler
+    return None
+
+
+class CommandIndexTests(unittest.TestCase):
+    def setUp(self):
+        self.bot = util_bot.bot
+        old_commands, old_prefixes = self.bot.commands, self.bot.prefixes
+        self.bot.commands = []
+        self.bot.prefixes = {('custom', Platform.TWITCH): '?', Platform.DISCORD: '?'}
+        self.addCleanup(setattr, self.bot, 'commands', old_commands)
+        self.addCleanup(setattr, self.bot, 'prefixes', old_prefixes)
+        self.bot.command_index.invalidate()
+
+    def _command(self, name: str, **kwargs) -> Command:
+        cls = kwargs.pop('cls', Command)
+        cmd = cls(name, _handler, self.bot, **kwargs)
+        self.bot.commands.append(cmd)
+        return cmd
+
+    def _populate(self):
+        self._command('ping', aliases=['pong'])
+        self._command('secret', matcher_function=lambda msg, prefix: 'secret' in msg.text)
+        self._command('Echo')
+        self._command('mb.legacy')
+        self._command('ping')  # shadowed by the first one
+        self._command('multi word')
+        self._command('custom', cls=CustomMatcherCommand)
+        self._command('straße', aliases=['ss'])
+        legacy = self._command('hello')
+        legacy.matcher_function = lambda msg, cmd: msg.text.endswith('hello ')  # old (msg, command) signature
+        self._command('secretive')
+        forced = self.bot.add_command('hello', forced_prefix='$')(_handler)
+        forced.aliases.append('hi')
+        self.bot.add_command('$$ping', forced_prefix='$$')(_handler)
+
+    def _messages(self):
+        for word, prefix, channel, arg in itertools.product(WORDS, PREFIXES, CHANNELS, ('', ' arg')):
+            text = prefix + word + arg
+            if ' ' not in text:
+                text += ' '
+            yield prefix, StandardizedMessage(text, 'user', channel, Platform.TWITCH)
+            yield prefix, StandardizedMessage(text, 'user', channel, Platform.DISCORD)
+        for word, prefix in itertools.product(WORDS, PREFIXES):
+            yield prefix, StandardizedWhisperMessage('user', 'bot', prefix + word + ' ', Platform.DISCORD)
+            yield prefix, StandardizedWhisperMessage('user', 'bot', prefix + word + ' ', Platform.TWITCH)
+
+    def _check(self, index: CommandIndex):
+        index.ensure_built(self.bot.commands)
+        checked = 0
+        for prefix, msg in self._messages():
+            with self.subTest(text=msg.text, prefix=prefix, channel=getattr(msg, 'channel', None)):
+                expected = _linear_find(self.bot.commands, msg, prefix)
+                self.assertIs(index.find(msg, prefix), expected)
+                self.assertIs(index.find_forced_prefix(msg), _linear_find_forced_prefix(self.bot.commands, msg))
+                checked += expected is not None
+        self.assertGreater(checked, 100)
+
+    def test_matches_linear_scan(self):
+        self._populate()
+        self._check(self.bot.command_index)
+
+    def test_add_command(self):
+        self._populate()
+        index = self.bot.command_index
+        self._check(index)
+        self.bot.add_command('unknown')(_handler)
+        self.assertTrue(index.dirty)
+        self._check(index)
+        self.assertIs(index.find(StandardizedMessage('!mb.unknown ', 'user', 'plain', Platform.TWITCH), '!'),
+                      self.bot.commands[-1])
+
+    def test_reload(self):
+        self._populate()
+        index = self.bot.command_index
+        self._check(index)
+        # what command_reload does: the plugin's commands are removed and the reloaded module adds new ones
+        old = self.bot.commands.pop(0)
+        self.bot.commands.insert(0, Command('pong', _handler, self.bot))
+        index.invalidate()
+        self._check(index)
+        self.assertIsNot(index.find(StandardizedMessage('!mb.ping ', 'user', 'plain', Platform.TWITCH), '!'), old)
+
+    def test_matcher_replaced(self):
+        self._populate()
+        index = self.bot.command_index
+        self._check(index)
+        self.bot.commands[2].matcher_function = lambda msg, cmd: True
+        self.assertTrue(index.dirty)
+        self._check(index)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,131 @@
+#  This is a simple utility bot
+#  Copyright (C) 2021 Mm2PL
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import asyncio
+import os
+import tempfile
+import time
+import unittest
+
+try:
+    from ..helpers import emote_index
+    from ..helpers.emote_index import Emote, EmoteIndex, EmoteProvider
+except ImportError:
+    from .helpers import emote_index
+    from .helpers.emote_index import Emote, EmoteIndex, EmoteProvider
+
+
+class FakeProvider(EmoteProvider):
+    def __init__(self, name, emotes):
+        self.name = name
+        self.emotes = emotes  # channel id ('' for globals) -> list of names
+        self.requests = 0
+        self.failing = set()  # keys that can't be fetched
+
+    async def _fetch(self, key):
+        self.requests += 1
+        await asyncio.sleep(0.01)
+        if key in self.failing:
+            raise ValueError('Bad status: 500')
+        return {i: Emote(i, f'https://example.com/{self.name}/{i}/{{}}', i) for i in self.emotes.get(key, [])}
+
+    async def fetch_globals(self):
+        return await self._fetch('')
+
+    async def fetch_channel(self, channel_id):
+        return await self._fetch(channel_id)
+
+
+class FakeTwitchProvider(FakeProvider):
+    async def fetch_emote(self, name):
+        self.requests += 1
+        return None
+
+
+class EmoteIndexTests(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.cache_file = os.path.join(directory.name, 'cache', 'emotes.json')
+        self.bttv = FakeProvider('bttv', {'': ['FeelsDankMan'], '1': ['pajaS', 'shared']})
+        self.ffz = FakeProvider('ffz', {'1': ['shared', 'ffzOnly']})
+        self.twitch = FakeTwitchProvider('twitch', {})
+        self.index = self._index()
+
+    def _index(self):
+        return EmoteIndex([self.bttv, self.ffz, self.twitch], self.cache_file)
+
+    async def test_single_flight(self):
+        found = await asyncio.gather(*(self.index.find(i, '1') for i in ('pajaS', 'ffzOnly', 'FeelsDankMan')))
+        self.assertEqual([i.name for i in found], ['pajaS', 'ffzOnly', 'FeelsDankMan'])
+        self.assertEqual((self.bttv.requests, self.ffz.requests), (2, 2))  # channel 1 and globals, once each
+        self.assertTrue((await self.index.find('shared', '1')).url.startswith('https://example.com/bttv/'))
+
+    async def test_stale_while_revalidate(self):
+        await self.index.find('pajaS', '1')
+        entry = self.index.entries['1']
+        entry.fetched_at -= emote_index.EMOTE_TTL + 1
+        self.bttv.emotes['1'].append('newEmote')
+
+        self.assertIsNone((await asyncio.gather(*(self.index.find('newEmote', '1') for _ in range(5))))[0])
+        self.assertFalse(self.index._loading['1'].done())  # the stale list answered without waiting
+        await self.index._loading['1']
+        self.assertEqual(self.bttv.requests, 3)  # one background refresh for five lookups
+        self.assertIsNotNone(await self.index.find('newEmote', '1'))
+
+    async def test_failed_provider(self):
+        self.ffz.failing = {'1'}
+        self.assertIsNone(await self.index.find('ffzOnly', '1'))
+        entry = self.index.entries['1']
+        self.assertEqual(entry.ttl, emote_index.FAILED_EMOTE_TTL)
+        self.index._save_soon()
+        await asyncio.sleep(0.1)
+        self.assertEqual(set(self._index_from_disk().entries), {''})
+
+        # retried once the short TTL runs out
+        self.ffz.failing = set()
+        entry.fetched_at -= emote_index.FAILED_EMOTE_TTL + 1
+        self.assertIsNone(await self.index.find('ffzOnly', '1'))  # answered from the stale list
+        await self.index._loading['1']
+        self.assertIsNotNone(await self.index.find('ffzOnly', '1'))
+        self.assertEqual(self.index.entries['1'].ttl, emote_index.EMOTE_TTL)
+
+        # failing again keeps the emotes it had
+        self.ffz.failing = {'1'}
+        self.index.entries['1'].fetched_at -= emote_index.EMOTE_TTL + 1
+        await self.index._refresh('1')
+        self.assertIn('ffzOnly', self.index.entries['1'].emotes)
+        self.assertLessEqual(self.index.entries['1'].fetched_at,
+                             time.time() - emote_index.EMOTE_TTL + emote_index.FAILED_EMOTE_TTL)
+
+    def _index_from_disk(self):
+        index = self._index()
+        index.load()
+        return index
+
+    async def test_persistence(self):
+        await self.index.find('pajaS', '1')
+        self.index._save_soon()
+        await asyncio.sleep(0.1)
+        self.bttv.failing = self.ffz.failing = {'1', ''}
+        loaded = self._index_from_disk()
+        self.assertEqual(set(loaded.entries), {'1', ''})
+        emote = await loaded.find('ffzOnly', '1')
+        self.assertEqual((emote.name, emote.url), ('ffzOnly', 'https://example.com/ffz/ffzOnly/{}'))
+        self.assertEqual(self.bttv.requests, 2)  # nothing was fetched again
+
+
+if __name__ == '__main__':
+    unittest.main()
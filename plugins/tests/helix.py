@@ -0,0 +1,115 @@
+#  This is a simple utility bot
+#  Copyright (C) 2021 Mm2PL
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import asyncio
+import threading
+import time
+import unittest
+
+from aiohttp import web
+
+from util_bot.helix import Helix, HelixError
+
+
+class HelixTests(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.requests = []
+        self.token = 'old'
+        self.refreshes = 0
+        self.remaining = 800
+        self.reset_in = 60
+        app = web.Application()
+        app.router.add_get('/users', self._users)
+        app.router.add_post('/clips', self._clips)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, '127.0.0.1', 0)
+        await site.start()
+        port = self.runner.addresses[0][1]
+        self.helix = Helix(lambda: ('client id', self.token), self._refresh, f'http://127.0.0.1:{port}/')
+
+    async def asyncTearDown(self):
+        await self.helix.close()
+        await self.runner.cleanup()
+
+    def _refresh(self):
+        self.assertIsNot(threading.current_thread(), threading.main_thread())
+        time.sleep(0.05)
+        self.refreshes += 1
+        self.token = f'new{self.refreshes}'
+
+    def _headers(self):
+        self.remaining = max(self.remaining - 1, 0)
+        return {
+            'Ratelimit-Remaining': str(self.remaining),
+            'Ratelimit-Reset': str(time.time() + self.reset_in)
+        }
+
+    async def _users(self, request: web.Request):
+        self.requests.append((request.headers['Authorization'], request.query_string))
+        if request.headers['Authorization'] == 'Bearer old':
+            return web.json_response({'status': 401, 'message': 'Invalid OAuth token'}, status=401)
+        data = [{'id': str(len(i)), 'login': i} for i in request.query.getall('login', []) if i != 'missing']
+        data += [{'id': i, 'login': f'user{i}'} for i in request.query.getall('id', [])]
+        return web.json_response({'data': data}, headers=self._headers())
+
+    async def _clips(self, request: web.Request):
+        return web.json_response({'status': 404, 'message': 'Clipping is not possible for an offline channel.'},
+                                 status=404)
+
+    async def test_refresh_coalescing(self):
+        users = await asyncio.gather(*(self.helix.request('get', 'users', params={'login': f'user{i}'})
+                                       for i in range(5)))
+        self.assertEqual([i['data'][0]['login'] for i in users], [f'user{i}' for i in range(5)])
+        self.assertEqual(self.refreshes, 1)
+        await self.helix.request('get', 'users', params={'login': 'a'})
+        self.assertEqual(self.refreshes, 1)
+
+    async def test_errors(self):
+        self.token = 'valid'
+        with self.assertRaises(HelixError) as cm:
+            await self.helix.request('post', 'clips', params={'broadcaster_id': '1'})
+        self.assertEqual(cm.exception.status, 404)
+        self.assertEqual(cm.exception.message, 'Clipping is not possible for an offline channel.')
+
+    async def test_batching(self):
+        self.token = 'valid'
+        logins = [f'user{i}' for i in range(250)]
+        users = await self.helix.get_users(logins, ids=['1', '2'])
+        self.assertEqual([i['login'] for i in users], logins + ['user1', 'user2'])
+        self.assertEqual(len(self.requests), 3)
+
+    async def test_get_user(self):
+        self.token = 'valid'
+        users = await asyncio.gather(*(self.helix.get_user(login=i) for i in ('Foo', 'bar', 'foo', 'missing')),
+                                     self.helix.get_user(id=5))
+        self.assertEqual(users, [{'id': '3', 'login': 'foo'}, {'id': '3', 'login': 'bar'},
+                                 {'id': '3', 'login': 'foo'}, None, {'id': '5', 'login': 'user5'}])
+        self.assertEqual(sorted(i[1] for i in self.requests), ['id=5', 'login=foo&login=bar&login=missing'])
+
+    async def test_rate_limit(self):
+        self.token = 'valid'
+        self.remaining = 2
+        self.reset_in = 0.3
+        start = time.monotonic()
+        await self.helix.request('get', 'users', params={'login': 'a'})
+        await self.helix.request('get', 'users', params={'login': 'a'})
+        self.assertLess(time.monotonic() - start, 0.25)
+        await self.helix.request('get', 'users', params={'login': 'a'})
+        self.assertGreaterEqual(time.monotonic() - start, 0.25)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,104 @@
+#  This is a simple utility bot
+#  Copyright (C) 2020 Mm2PL
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import io
+import os
+import tempfile
+import unittest
+
+from aiohttp import web
+from PIL import Image
+
+try:
+    from ..helpers import image_download
+except ImportError:
+    from .helpers import image_download
+
+
+def _png() -> bytes:
+    f = io.BytesIO()
+    Image.new('RGBA', (28, 28), (255, 0, 0, 255)).save(f, 'png')
+    return f.getvalue()
+
+
+class DownloadTests(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.requests = []
+        self.png = _png()
+        app = web.Application()
+        app.router.add_get('/emote.png', self._emote)
+        app.router.add_get('/chunked', self._chunked)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, '127.0.0.1', 0)
+        await site.start()
+        port = self.runner.addresses[0][1]
+        self.base = f'http://127.0.0.1:{port}'
+
+        self.tmp = tempfile.TemporaryDirectory()
+        self.old_cache = image_download.disk_cache
+        image_download.disk_cache = image_download.DiskCache(self.tmp.name, 4 * len(self.png))
+
+    async def asyncTearDown(self):
+        image_download.disk_cache = self.old_cache
+        await image_download.close_session()
+        await self.runner.cleanup()
+        self.tmp.cleanup()
+
+    async def _emote(self, request):
+        self.requests.append(request.path)
+        return web.Response(body=self.png, content_type='image/png')
+
+    async def _chunked(self, request):
+        # No Content-Length, the limit can only be enforced while reading.
+        self.requests.append(request.path)
+        r = web.StreamResponse()
+        await r.prepare(request)
+        for _ in range(64):
+            await r.write(b'\0' * 1024)
+        await r.write_eof()
+        return r
+
+    async def test_download_image(self):
+        img = await image_download.download_image(self.base + '/emote.png')
+        self.assertEqual(img.size, (28, 28))
+        self.assertEqual(img.format, 'PNG')
+
+    async def test_size_limit(self):
+        with self.assertRaises(ValueError):
+            await image_download.fetch_bytes(self.base + '/chunked', size_limit=16 * 1024)
+        self.assertEqual(len(await image_download.fetch_bytes(self.base + '/chunked')), 64 * 1024)
+
+    async def test_disk_cache(self):
+        url = self.base + '/emote.png'
+        self.assertEqual(await image_download.fetch_bytes(url, cache=True), self.png)
+        self.assertEqual(await image_download.fetch_bytes(url, cache=True), self.png)
+        self.assertEqual(self.requests, ['/emote.png'])
+        # Same content under a different url is stored once
+        await image_download.fetch_bytes(url + '?size=3x', cache=True)
+        self.assertEqual(len(os.listdir(os.path.join(self.tmp.name, 'blobs'))), 1)
+
+    async def test_disk_cache_eviction(self):
+        cache = image_download.disk_cache
+        for i in range(8):
+            cache.put(f'url{i}', bytes([i]) * len(self.png))
+        self.assertLessEqual(sum(os.path.getsize(os.path.join(cache.directory, 'blobs', i))
+                                 for i in os.listdir(os.path.join(cache.directory, 'blobs'))), cache.max_bytes)
+        self.assertIsNone(cache.get('url0'))
+        self.assertEqual(cache.get('url7'), bytes([7]) * len(self.png))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,198 @@
+#  This is a simple utility bot
+#  Copyright (C) 2021 Mm2PL
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import asyncio
+import datetime
+import os
+import re
+import stat
+import sys
+import tempfile
+import time
+import unittest
+
+try:
+    from ..helpers.justgrep import JobLimitError, JobScheduler, JustgrepError, LoggerRoutes, LogSearch, build_paste
+except ImportError:
+    from .helpers.justgrep import JobLimitError, JobScheduler, JustgrepError, LoggerRoutes, LogSearch, build_paste
+
+# Prints LINES lines, sleeping DELAY seconds after each, then ERROR to stderr if set.
+FAKE_JUSTGREP = f'''#!{sys.executable}
+import os, sys, time
+for i in range(int(os.environ['LINES'])):
+    print(f'@tmi-sent-ts={{i}} :user!user@user.tmi.twitch.tv PRIVMSG #channel :line {{i}}', flush=True)
+    time.sleep(float(os.environ.get('DELAY', 0)))
+if os.environ.get('ERROR'):
+    print(os.environ['ERROR'], file=sys.stderr)
+'''
+
+
+class LogSearchTests(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.executable = os.path.join(directory.name, 'justgrep')
+        with open(self.executable, 'w') as f:
+            f.write(FAKE_JUSTGREP)
+        os.chmod(self.executable, stat.S_IRWXU)
+        os.environ.pop('DELAY', None)
+        os.environ.pop('ERROR', None)
+
+    def _search(self, lines, count=100):
+        os.environ['LINES'] = str(lines)
+        return LogSearch('http://localhost', 'channel', ['a', 'b'], ['c'], re.compile('line'),
+                         datetime.datetime(2021, 1, 1), datetime.datetime(2021, 1, 2), count,
+                         executable=self.executable)
+
+    def test_arguments(self):
+        search = self._search(1)
+        self.assertEqual(search.args[1:], (
+            '-channel', 'channel',
+            '-start', '2021-01-01 00:00:00',
+            '-end', '2021-01-02 00:00:00',
+            '-url', 'http://localhost',
+            '-uregex', '-user', 'a|b', '-notuser', 'c',
+            '-regex', 'line',
+            '-max', '100'
+        ))
+
+    async def test_all_lines(self):
+        matched = await self._search(10).run()
+        self.assertEqual(len(matched), 10)
+        self.assertEqual(matched[3], '@tmi-sent-ts=3 :user!user@user.tmi.twitch.tv PRIVMSG #channel :line 3')
+
+    async def test_stops_at_max(self):
+        os.environ['DELAY'] = '0.01'
+        search = self._search(10_000, count=20)
+        start = time.monotonic()
+        matched = await search.run()
+        self.assertEqual(len(matched), 20)
+        self.assertLess(time.monotonic() - start, 5)
+
+    async def test_progress(self):
+        os.environ['DELAY'] = '0.02'
+        search = self._search(10_000)
+        task = asyncio.create_task(search.run())
+        while len(search.matched) < 5:
+            await asyncio.sleep(0.01)
+        self.assertRegex(search.progress, r'^\d+ messages matched in \d+\.\ds$')
+        task.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await task
+        self.assertLess(len(search.matched), 100)
+
+    async def test_error(self):
+        os.environ['ERROR'] = 'bad regex'
+        with self.assertRaises(JustgrepError) as ctx:
+            await self._search(1).run()
+        self.assertEqual(ctx.exception.errors[0], 'bad regex')
+
+    def test_build_paste(self):
+        self.assertEqual(build_paste(['Found 2'], ['a', 'b']),
+                         '@msg-id=log_info :tmi.twitch.tv NOTICE * :Found 2\na\r\nb\r\n')
+
+
+class FakeSearch:
+    def __init__(self):
+        self.started = asyncio.Event()
+        self.finish = asyncio.Event()
+
+    async def run(self):
+        self.started.set()
+        await self.finish.wait()
+        return ['done']
+
+
+class JobSchedulerTests(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.scheduler = JobScheduler(max_jobs=2, max_jobs_per_user=1, max_queued_per_user=2)
+
+    async def test_limits(self):
+        a1, a2 = FakeSearch(), FakeSearch()
+        b1, c1 = FakeSearch(), FakeSearch()
+        job_a1 = self.scheduler.submit('a', a1)
+        job_a2 = self.scheduler.submit('a', a2)
+        job_b1 = self.scheduler.submit('b', b1)
+        job_c1 = self.scheduler.submit('c', c1)
+        with self.assertRaises(JobLimitError):
+            self.scheduler.submit('a', FakeSearch())
+        await asyncio.sleep(0)
+        # a's second job waits for a's first, b's job doesn't wait for it
+        self.assertEqual([self.scheduler.position(i) for i in (job_a1, job_a2, job_b1, job_c1)], [0, 1, 0, 2])
+        self.assertTrue(a1.started.is_set() and b1.started.is_set())
+
+        a1.finish.set()
+        self.assertEqual(await job_a1.task, ['done'])
+        await asyncio.sleep(0)
+        self.assertTrue(a2.started.is_set())
+        self.assertEqual(self.scheduler.position(job_c1), 1)
+
+    async def test_cancel(self):
+        searches = [FakeSearch() for _ in range(3)]
+        jobs = [self.scheduler.submit(user, search) for user, search in zip('abc', searches)]
+        self.assertTrue(self.scheduler.cancel(jobs[2].id))  # queued
+        self.assertTrue(self.scheduler.cancel(jobs[0].id))  # running
+        self.assertFalse(self.scheduler.cancel(1000))
+        for job in jobs[0], jobs[2]:
+            with self.assertRaises(asyncio.CancelledError):
+                await job.task
+        await asyncio.sleep(0)  # let the done callbacks run
+        self.assertEqual(list(self.scheduler.jobs), [jobs[1].id])
+        searches[1].finish.set()
+        await jobs[1].task
+        await asyncio.sleep(0)
+        self.assertEqual(self.scheduler.jobs, {})
+        self.assertEqual(self.scheduler._running, 0)
+
+
+class FakeChannel:
+    def __init__(self, name):
+        self.name = name
+
+
+class FakeLogger:
+    def __init__(self, channels, fail=False):
+        self.channels = []
+        self._channels = channels
+        self.fail = fail
+        self.queries = 0
+
+    async def query_channels(self):
+        self.queries += 1
+        await asyncio.sleep(0.05)
+        if self.fail:
+            raise ConnectionError()
+        self.channels = [FakeChannel(i) for i in self._channels]
+
+
+class LoggerRoutesTests(unittest.IsolatedAsyncioTestCase):
+    async def test_routes(self):
+        first, second, broken = FakeLogger(['a', 'b']), FakeLogger(['b', 'c']), FakeLogger(['d'], fail=True)
+        routes = LoggerRoutes([first, second, broken], ttl=60, miss_ttl=60)
+        start = time.monotonic()
+        found = await asyncio.gather(*(routes.get(i) for i in 'abcd'))
+        self.assertLess(time.monotonic() - start, 0.1)  # queried at once, only once
+        self.assertEqual(found, [first, first, second, None])
+        self.assertEqual([i.queries for i in (first, second, broken)], [1, 1, 1])
+
+        await routes.get('unknown')
+        self.assertEqual(first.queries, 1)  # cached
+        routes.refreshed_at -= 61
+        await routes.get('a')
+        self.assertEqual(first.queries, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
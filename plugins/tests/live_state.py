@@ -0,0 +1,86 @@
+#  This is a simple utility bot
+#  Copyright (C) 2021 Mm2PL
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import asyncio
+import time
+import unittest
+
+from util_bot.live_state import LiveStateTracker
+
+
+class LiveStateTests(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.tracker = LiveStateTracker()
+
+    async def test_transitions(self):
+        self.assertTrue(self.tracker.mark_live('foo', 60, now=0))
+        self.assertFalse(self.tracker.mark_live('foo', 60, now=30))
+        self.assertTrue(self.tracker.is_live('foo', now=80))
+        self.assertTrue(self.tracker.mark_down('foo', now=80))
+        self.assertFalse(self.tracker.is_live('foo', now=80))
+        self.assertFalse(self.tracker.mark_down('foo', now=81))
+        self.assertTrue(self.tracker.mark_live('foo', 60, now=90))
+
+    async def test_expiry(self):
+        self.tracker.mark_live('foo', 120, now=0)
+        self.tracker.mark_live('bar', 60, now=0)
+        for i in range(1, 100):
+            self.tracker.mark_live('bar', 60, now=i)  # a live channel sending viewcounts
+        self.assertEqual(len(self.tracker._heap), 2)
+        self.assertEqual(self.tracker.expire(now=100), [])
+        self.assertEqual(self.tracker.expire(now=120), ['foo'])
+        self.assertEqual(self.tracker.expire(now=159), ['bar'])
+        self.assertEqual((len(self.tracker), len(self.tracker._heap)), (0, 0))
+
+    async def test_shorter_timeout(self):
+        self.tracker.mark_live('foo', 120, now=0)  # stream-up
+        self.tracker.mark_live('foo', 60, now=1)  # followed by a viewcount
+        self.assertEqual(self.tracker.expire(now=61), ['foo'])
+        self.assertEqual(self.tracker.expire(now=200), [])
+        self.assertFalse(self.tracker._heap)
+
+    async def test_futures(self):
+        up = self.tracker.wait_for_up('foo')
+        down = self.tracker.wait_for_down('foo')
+        self.assertTrue(down.done())
+        self.tracker.mark_live('foo', 60, {'type': 'stream-up'})
+        self.assertEqual(up.result(), {'type': 'stream-up'})
+
+        down = self.tracker.wait_for_down('foo')
+        self.tracker.mark_down('foo', {'type': 'stream-down'})
+        self.assertEqual(down.result(), {'type': 'stream-down'})
+
+        self.tracker.mark_live('foo', 0.05)
+        down = self.tracker.wait_for_down('foo')
+        task = asyncio.create_task(self.tracker.run())
+        try:
+            start = time.monotonic()
+            self.assertIsNone(await asyncio.wait_for(down, 1))
+            self.assertLess(time.monotonic() - start, 0.5)
+        finally:
+            task.cancel()
+
+    async def test_many(self):
+        start = time.monotonic()
+        for second in range(60):
+            for i in range(2000):
+                self.tracker.mark_live(f'chan{i}', 60, now=second)
+        self.assertLessEqual(len(self.tracker._heap), 2000)
+        self.assertEqual(len(self.tracker.expire(now=200)), 2000)
+        self.assertLess(time.monotonic() - start, 5)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,104 @@
+#  This is a simple utility bot
+#  Copyright (C) 2021 Mm2PL
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import time
+import unittest
+
+import sqlalchemy
+from sqlalchemy.orm import declarative_base
+from sqlalchemy.pool import StaticPool
+
+try:
+    from ..helpers.log_sink import LogSink
+    from ..models import logentry as logentry_model
+except ImportError:
+    from .helpers.log_sink import LogSink
+    from .models import logentry as logentry_model
+
+
+class LogSinkTests(unittest.TestCase):
+    def setUp(self):
+        self.batches = []
+
+    def _sink(self, **kwargs):
+        sink = LogSink(self.batches.append, **kwargs)
+        self.addCleanup(sink.stop, 5)
+        return sink
+
+    def test_timer_flush(self):
+        sink = self._sink(flush_interval=0.1)
+        sink.start()
+        sink.put('test', 0, 'hello', 3)
+        time.sleep(0.3)  # no other lines arrive, the timer alone has to flush
+        self.assertEqual([[row['message'] for row in batch] for batch in self.batches], [['hello']])
+        self.assertEqual(sink.queue_depth, 0)
+
+    def test_batch_size(self):
+        sink = self._sink(batch_size=10, flush_interval=60)
+        sink.start()
+        for i in range(25):
+            sink.put('test', 0, str(i), 3)
+        time.sleep(0.1)
+        self.assertEqual([len(i) for i in self.batches], [10, 10])
+        sink.stop(5)
+        self.assertEqual([len(i) for i in self.batches], [10, 10, 5])
+
+    def test_coalesce(self):
+        sink = self._sink()
+        for _ in range(5):
+            sink.put('test', -1, 'spam', 3)
+        sink.put('test', -1, 'other', 3)
+        sink.put('test', -1, 'spam', 3)
+        sink.start()
+        sink.stop(5)
+        self.assertEqual([row['message'] for row in self.batches[0]],
+                         ['spam (repeated 5 times)', 'other', 'spam'])
+        self.assertEqual(sink.coalesced, 4)
+
+    def test_limits(self):
+        sink = self._sink(max_queue=100, source_rate=1, source_burst=60)
+        for i in range(100):
+            sink.put('noisy', -1, str(i), 3)
+        self.assertEqual((sink.queue_depth, sink.rate_limited), (60, 40))
+        for i in range(50):
+            sink.put('quiet', 0, str(i), 3)
+        self.assertEqual((sink.queue_depth, sink.dropped), (100, 10))
+        sink.put('noisy', 3, 'error', 3)  # errors get through either way
+        self.assertEqual(sink.queue_depth, 101)
+
+    def test_bulk_insert(self):
+        base = declarative_base()
+        table = logentry_model.get(base).__table__
+        engine = sqlalchemy.create_engine('sqlite://', connect_args={'check_same_thread': False},
+                                          poolclass=StaticPool)
+        base.metadata.create_all(engine)
+
+        def _write(rows):
+            with engine.begin() as conn:
+                conn.execute(table.insert(), rows)
+
+        sink = LogSink(_write, batch_size=100)
+        for i in range(250):
+            sink.put('test', 0, f'line {i}', 3)
+        sink.start()
+        sink.stop(5)
+        with engine.connect() as conn:
+            rows = conn.execute(sqlalchemy.select(table.c.message).order_by(table.c.id)).fetchall()
+        self.assertEqual([i[0] for i in rows], [f'line {i}' for i in range(250)])
+        self.assertEqual((sink.flushes, sink.flushed_lines), (3, 250))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,167 @@
+#  This is a simple utility bot
+#  Copyright (C) 2020 Mm2PL
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import ast
+import unittest
+import warnings
+from unittest import TestCase, mock
+
+import numpy
+
+try:
+    from ..helpers import math_interpreter
+except ImportError:
+    from .helpers import math_interpreter
+
+# Lambda bodies that VectorizedLambda has to evaluate exactly like the scalar interpreter
+EXPRESSIONS = [
+    'x',
+    'x**2',
+    '-x + 3',
+    'x * 2 - x / 3',
+    '2**x',
+    '(-2)**x',
+    'x**0.5',
+    'x % 3',
+    '7 % x',
+    '1/x',
+    '1/sin(x)',
+    '1/(x-x)',
+    'sin(x)**x',
+    'abs(x) - fabs(x)',
+    'sqrt(abs(x)) * sin(x) + cos(x / 3)',
+    'sqrt(x)',
+    'log(x)',
+    'log(x, 2)',
+    'exp(x)',
+    'exp(x) ** 10',
+    'atan2(x, 1) + hypot(x, 2) + pow(2, x)',
+    'tanh(-x) + cosh(x / 10) * sinh(x / 10)',
+    'degrees(x) + radians(x)',
+    'pi * x + e ** x',
+    '(y := x * 2) + y',
+    'y + (y := x)',
+    'x * 1e9',
+    'x * 1e10',
+    'x ** 1001',
+    'x / 1e-10',
+    '0 / x',
+    '2**1500 * x',
+    '(lambda y: y * 2)(x)',
+    'floor(x)',
+    'gamma(x / 10 + 1)',
+    'max(x, 0)',
+    'str(x)',
+    'x ^ 2',
+    '5',
+    'unknown * x',
+]
+
+
+class Ctx:
+    source = 'test'
+    user = 'test'
+
+
+def _run(function, *args):
+    try:
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            return 'ok', function(*args)
+    except math_interpreter._NotVectorizable:
+        return 'fallback', None
+    except Exception as e:
+        return 'error', (type(e), str(e))
+
+
+class VectorizedLambdaTests(TestCase):
+    def _check(self, body: str, x: numpy.ndarray):
+        func = ast.parse(f'lambda x: {body}', mode='eval').body
+        expected = _run(lambda: [math_interpreter._call(func, i, ctx=Ctx) for i in x])
+        got = _run(lambda: math_interpreter.VectorizedLambda(func)(x, Ctx))
+        if got[0] == 'fallback':
+            return
+        self.assertEqual(got[0], expected[0], msg=f'{body}: {got[1]} vs {expected[1]}')
+        if got[0] == 'error':
+            # Subexpressions are evaluated for all elements at once, the error can come from a different element
+            self.assertEqual(got[1][0], expected[1][0], msg=body)
+        else:
+            numpy.testing.assert_allclose(numpy.array(got[1], dtype=float), numpy.array(expected[1], dtype=float),
+                                          rtol=1e-12, equal_nan=True, err_msg=body)
+
+    def test_equivalence(self):
+        ranges = [
+            numpy.arange(-10, 10, 0.25),
+            numpy.arange(0.5, 50, 0.5),
+            numpy.arange(-1000, 1000, 7.3),
+        ]
+        for body in EXPRESSIONS:
+            for x in ranges:
+                with self.subTest(body=body, start=x[0]):
+                    self._check(body, x)
+
+    def test_vectorizes_common_functions(self):
+        x = numpy.arange(0.5, 10, 0.5)
+        for body in ('x**2', 'sin(x) * x', '(y := sqrt(x)) * y - 1/x', 'abs(x) % 3'):
+            with self.subTest(body=body):
+                math_interpreter.VectorizedLambda(ast.parse(f'lambda x: {body}', mode='eval').body)(x, Ctx)
+        math_interpreter.VectorizedLambda(math_interpreter.Math.functions['sin'])(x, Ctx)
+
+    def test_interpreted_step_limit(self):
+        ctx = Ctx()
+        with self.assertRaises(ValueError):
+            math_interpreter.Math.eval_expr(f'plot(lambda x: floor(x), 0, 1, '
+                                            f'{1 / math_interpreter.MAX_INTERPRETED_STEPS})', ctx)
+        plot = math_interpreter.Math.eval_expr(f'plot(lambda x: x**2, 0, 1, '
+                                               f'{1 / math_interpreter.MAX_INTERPRETED_STEPS})', ctx)
+        self.assertIsInstance(plot, math_interpreter.Plot)
+
+    @mock.patch.object(math_interpreter, 'MAX_INTERPRETED_STEPS', 1000)
+    def test_interpreted_step_limit_is_shared(self):
+        ctx = Ctx()
+        plot = math_interpreter.Math.eval_expr('plots([lambda x: floor(x), lambda x: x**2], 0, 1, 1 / 600)', ctx)
+        self.assertIsInstance(plot, math_interpreter.Plot)
+        with self.assertRaises(ValueError):
+            math_interpreter.Math.eval_expr('plots([lambda x: floor(x), lambda x: x % 1 + floor(x)], 0, 1, 1 / 600)',
+                                            ctx)
+
+
+class DownsampleTests(TestCase):
+    def test_keeps_extremes(self):
+        x = numpy.arange(0, 1, 1 / 100_003)
+        y = numpy.sin(x * 50)
+        y[12_345] = 10
+        y[54_321] = -10
+        y[70_000:80_000] = numpy.nan
+        sampled_x, sampled_y = math_interpreter._downsample(x, y, 1000)
+        self.assertLessEqual(len(sampled_y), 1000)
+        self.assertTrue(numpy.all(numpy.diff(sampled_x) > 0))
+        self.assertEqual((numpy.nanmin(sampled_y), numpy.nanmax(sampled_y)), (-10, 10))
+        self.assertTrue(numpy.isnan(sampled_y).any())  # the gap stays
+
+    def test_small_input(self):
+        x = numpy.arange(10.0)
+        self.assertIs(math_interpreter._downsample(x, x, 10)[1], x)
+        x = numpy.full(5000, numpy.nan)
+        self.assertTrue(numpy.isnan(math_interpreter._downsample(x, x, 100)[1]).all())
+
+    def test_plot_max_steps(self):
+        plot = math_interpreter.Math.eval_expr(f'plots([lambda x: sin(x), lambda x: x**2], 0, 1, '
+                                               f'{2 / (math_interpreter.MAX_STEPS - 2)})', Ctx())
+        self.assertIsInstance(plot, math_interpreter.Plot)
+
+
+if __name__ == '__main__':
+    unittest.main()
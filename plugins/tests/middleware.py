@@ -0,0 +1,253 @@
+#  This is a simple utility bot
+#  Copyright (C) 2021 Mm2PL
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import asyncio
+import itertools
+import unittest
+
+import twitchirc
+
+import util_bot
+from util_bot.middleware import DISPATCHED_ACTIONS, MiddlewareList
+
+ACTIONS = DISPATCHED_ACTIONS + ('permission_error', 'userstate')
+
+
+class Recorder(twitchirc.AbstractMiddleware):
+    """Records calls to the AbstractMiddleware methods it overrides."""
+    calls = None  # list shared by all middleware in a test
+
+    def __init__(self, name):
+        super().__init__()
+        self.name = name
+
+    def _record(self, event):
+        self.calls.append((self.name, event.name))
+
+
+class SendAndCommand(Recorder):
+    def send(self, event):
+        self._record(event)
+
+    def command(self, event):
+        self._record(event)
+
+
+class Canceler(Recorder):
+    def command(self, event):
+        self._record(event)
+        if event.data['message'].text == 'cancel' and not event.canceled:
+            event.cancel()
+
+
+class ResultSetter(Recorder):
+    def permission_check(self, event):
+        self._record(event)
+        event.result = ['missing.permission']
+
+
+class CustomOnAction(Recorder):
+    def on_action(self, event):
+        self._record(event)
+
+
+class AsyncEverything(Recorder):
+    async def aon_action(self, event):
+        await asyncio.sleep(0)
+        self._record(event)
+
+
+class AsyncJoin(Recorder):
+    handled_actions = {'join', 'part'}
+
+    async def aon_action(self, event):
+        if event.name in self.handled_actions:
+            self._record(event)
+
+
+class Observer(Recorder):
+    handled_actions = observed_actions = {'send', 'receive', 'command'}
+
+    async def aon_action(self, event):
+        if event.name in self.observed_actions:
+            self._record(event)
+
+
+class Nothing(Recorder):
+    pass
+
+
+def _make_middleware():
+    return [SendAndCommand('send_and_command'), Canceler('canceler'), ResultSetter('result'),
+            CustomOnAction('custom'), AsyncEverything('async'), AsyncJoin('async_join'), Observer('observer'),
+            Nothing('nothing')]
+
+
+async def _linear_acall_middleware(middleware, action, arguments, cancelable):
+    """Bot.acall_middleware before MiddlewareList, over a copy of the list."""
+    event = twitchirc.Event(action, arguments, source=None, cancelable=cancelable)
+    for m in list(middleware):
+        if hasattr(m, 'aon_action'):
+            await m.aon_action(event)
+        else:
+            m.on_action(event)
+    if event.canceled:
+        return False
+    if event.result is not None:
+        return True, event.result
+    return True
+
+
+def _arguments():
+    return {'message': util_bot.StandardizedMessage('cancel', 'user', 'channel', util_bot.Platform.TWITCH),
+            'command': None, 'channel': 'channel'}
+
+
+class MiddlewareListTests(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.bot = util_bot.bot
+        old_middleware = self.bot.middleware
+        self.addCleanup(setattr, self.bot, 'middleware', old_middleware)
+        self.calls = Recorder.calls = []
+
+    async def _dispatch(self, action, cancelable):
+        self.calls.clear()
+        result = await self.bot.acall_middleware(action, _arguments(), cancelable)
+        for _ in range(3):
+            await asyncio.sleep(0)  # let the observers run
+        return result, list(self.calls)
+
+    async def _linear_dispatch(self, middleware, action, cancelable):
+        self.calls.clear()
+        result = await _linear_acall_middleware(middleware, action, _arguments(), cancelable)
+        return result, list(self.calls)
+
+    def _assert_same(self, dispatched, expected, cancelable):
+        (result, calls), (expected_result, expected_calls) = dispatched, expected
+        self.assertEqual(result, expected_result)
+        self.assertEqual(sorted(calls), sorted(expected_calls))
+        if cancelable:
+            # the chain keeps its order, observers run after it
+            self.assertEqual([i for i in calls if i[0] != 'observer'],
+                             [i for i in expected_calls if i[0] != 'observer'])
+
+    async def test_matches_linear_dispatch(self):
+        middleware = _make_middleware()
+        self.bot.middleware = list(middleware)
+        self.assertIsInstance(self.bot.middleware, MiddlewareList)
+        called = 0
+        for action, cancelable in itertools.product(ACTIONS, (True, False)):
+            with self.subTest(action=action, cancelable=cancelable):
+                expected = await self._linear_dispatch(middleware, action, cancelable)
+                dispatched = await self._dispatch(action, cancelable)
+                self._assert_same(dispatched, expected, cancelable)
+                called += len(dispatched[1])
+        self.assertGreater(called, len(ACTIONS))
+
+    async def test_sync_dispatch(self):
+        middleware = [i for i in _make_middleware() if not hasattr(i, 'aon_action')]
+        self.bot.middleware = list(middleware)
+        for action in ACTIONS:
+            with self.subTest(action=action):
+                expected_result, expected_calls = await self._linear_dispatch(middleware, action, True)
+                self.calls.clear()
+                self.assertEqual(self.bot.call_middleware(action, _arguments(), True), expected_result)
+                self.assertEqual(self.calls, expected_calls)
+
+    async def test_modified_while_dispatching(self):
+        late = SendAndCommand('late')
+
+        class SelfRemoving(Recorder):
+            armed = False
+
+            def command(self, event):
+                self._record(event)
+                if self.armed:
+                    util_bot.bot.middleware.remove(self)
+                    util_bot.bot.middleware.append(late)
+
+        class AsyncRemoving(Recorder):
+            handled_actions = {'join'}
+            armed = False
+
+            async def aon_action(self, event):
+                if event.name not in self.handled_actions:
+                    return
+                self._record(event)
+                await asyncio.sleep(0)
+                if self.armed:
+                    util_bot.bot.middleware.remove(victim)
+
+        middleware = _make_middleware()
+        victim = middleware[0]
+        self_removing = SelfRemoving('self_removing')
+        async_removing = AsyncRemoving('async_removing')
+        self.bot.middleware = [self_removing, *middleware, async_removing]
+
+        # changes made while dispatching apply from the next event on, every middleware that was there when the
+        # event started is still called once. Iterating over the list itself would skip the one after a removed one.
+        expected = await self._linear_dispatch(list(self.bot.middleware), 'command', True)
+        self_removing.armed = True
+        self._assert_same(await self._dispatch('command', True), expected, True)
+        self.assertEqual(list(self.bot.middleware), [*middleware, async_removing, late])
+
+        expected = await self._linear_dispatch(list(self.bot.middleware), 'command', True)
+        dispatched = await self._dispatch('command', True)
+        self._assert_same(dispatched, expected, True)
+        self.assertIn(('late', 'command'), dispatched[1])
+        self.assertNotIn(('self_removing', 'command'), dispatched[1])
+
+        # same for events that are dispatched concurrently
+        expected = await self._linear_dispatch(list(self.bot.middleware), 'join', False)
+        async_removing.armed = True
+        self._assert_same(await self._dispatch('join', False), expected, False)
+        self.assertNotIn(victim, self.bot.middleware)
+        async_removing.armed = False
+
+        expected = await self._linear_dispatch(list(self.bot.middleware), 'command', True)
+        dispatched = await self._dispatch('command', True)
+        self._assert_same(dispatched, expected, True)
+        self.assertNotIn((victim.name, 'command'), dispatched[1])
+
+    def test_mutations_invalidate(self):
+        middleware = MiddlewareList(_make_middleware())
+        extra = _make_middleware()
+
+        def check():
+            for action in ACTIONS:
+                with self.subTest(action=action, middleware=list(middleware)):
+                    self.assertEqual(middleware.for_action(action), MiddlewareList(list(middleware)).for_action(action))
+
+        mutations = [
+            lambda: middleware.append(extra[0]),
+            lambda: middleware.extend(extra[1:3]),
+            lambda: middleware.insert(0, extra[3]),
+            lambda: middleware.remove(extra[0]),
+            lambda: middleware.pop(),
+            lambda: middleware.pop(0),
+            lambda: middleware.__setitem__(1, extra[6]),
+            lambda: middleware.__setitem__(slice(2, 4), extra[4:6]),
+            lambda: middleware.__delitem__(0),
+            lambda: middleware.__iadd__([extra[7]]),
+            lambda: middleware.clear(),
+        ]
+        check()
+        for mutation in mutations:
+            mutation()
+            check()
+
+
+if __name__ == '__main__':
+    unittest.main()
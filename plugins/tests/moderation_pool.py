@@ -0,0 +1,167 @@
+#  This is a simple utility bot
+#  Copyright (C) 2021 Mm2PL
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import asyncio
+import unittest
+from unittest import mock
+
+try:
+    from ..helpers import moderation_pool
+except ImportError:
+    from .helpers import moderation_pool
+
+
+class FakeTmi:
+    """
+    Accepts any number of clients and records the PRIVMSGs each of them sends.
+
+    `mode` decides what happens after a client connects: 'welcome' logs it in, 'refuse' rejects its credentials,
+    'silent' never answers and 'drop' logs it in and disconnects right away.
+    """
+
+    def __init__(self):
+        self.mode = 'welcome'
+        self.server = None
+        self.port = None
+        self.writers = []
+        self.privmsgs = []
+
+    async def start(self, port=0):
+        self.server = await asyncio.start_server(self._handle, '127.0.0.1', port)
+        self.port = self.server.sockets[0].getsockname()[1]
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.writers.append(writer)
+        if self.mode == 'refuse':
+            writer.write(b':tmi.twitch.tv NOTICE * :Login authentication failed\r\n')
+            writer.close()
+            return
+        if self.mode in ('welcome', 'drop'):
+            writer.write(b':tmi.twitch.tv 001 bot :Welcome, GLHF!\r\n')
+        if self.mode == 'drop':
+            await writer.drain()
+            writer.close()
+            return
+        while True:
+            try:
+                line = await reader.readline()
+            except ConnectionError:
+                break
+            if not line:
+                break
+            if line.startswith(b'PRIVMSG'):
+                self.privmsgs.append((writer, line.rstrip(b'\r\n').decode()))
+        writer.close()
+
+    def stop_accepting(self):
+        self.server.close()
+
+    def close(self):
+        self.server.close()
+        for i in self.writers:
+            i.close()
+
+
+class ModerationPoolTests(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.tmi = FakeTmi()
+        await self.tmi.start()
+        # slow enough for a batch of 50 to still be going when a connection is killed
+        self.pool = moderation_pool.ModerationPool('127.0.0.1', self.tmi.port, False, lambda: ('bot', 'oauth:xd'),
+                                                   rate=100, burst=1)
+
+    async def asyncTearDown(self):
+        await self.pool.close()
+        self.tmi.close()
+        await asyncio.sleep(0.01)  # let the handlers see their connections close
+
+    def _messages(self, count):
+        return [f'PRIVMSG #channel :/timeout user{i} 1s\r\n' for i in range(count)]
+
+    async def _wait_for_messages(self, count):
+        while len(self.tmi.privmsgs) < count:
+            await asyncio.sleep(0.01)
+
+    async def test_batch(self):
+        progress = await asyncio.wait_for(self.pool.send_batch('channel', self._messages(50), 2), 5)
+        self.assertEqual(progress.sent, 50)
+        await asyncio.wait_for(self._wait_for_messages(50), 5)
+        self.assertEqual(sorted(i[1] for i in self.tmi.privmsgs), sorted(i.rstrip() for i in self._messages(50)))
+        self.assertEqual(len({i[0] for i in self.tmi.privmsgs}), 2)  # spread over both connections
+
+    @mock.patch.object(moderation_pool, 'CONNECT_ATTEMPTS', 2)
+    @mock.patch.object(moderation_pool, 'MAX_BACKOFF', 0.05)
+    async def test_connection_gives_up(self):
+        await self.pool.resize(2)
+        batch = asyncio.create_task(self.pool.send_batch('channel', self._messages(50), 2))
+        await asyncio.sleep(0.1)
+        self.tmi.stop_accepting()
+        self.tmi.writers[0].close()  # one connection drops and can't come back
+
+        progress = await asyncio.wait_for(batch, 5)
+        self.assertEqual(progress.sent, 50)  # the other connection picked up the rest
+        await asyncio.sleep(0.1)
+        sent_after_drop = [i for i in self.tmi.privmsgs[25:] if i[0] is self.tmi.writers[1]]
+        self.assertTrue(sent_after_drop)
+        self.assertTrue(self.pool.connections[0].task.done())
+
+        await self.pool.resize(2)  # the dead connection is dropped, the new one can't connect either
+        self.assertEqual(len(self.pool.connections), 1)
+
+    @mock.patch.object(moderation_pool, 'CONNECT_ATTEMPTS', 2)
+    @mock.patch.object(moderation_pool, 'MAX_BACKOFF', 0.05)
+    async def test_all_connections_give_up(self):
+        await self.pool.resize(1)
+        batch = asyncio.create_task(self.pool.send_batch('channel', self._messages(50), 1))
+        await asyncio.sleep(0.1)
+        self.tmi.stop_accepting()
+        self.tmi.writers[0].close()
+        progress = await asyncio.wait_for(batch, 5)  # doesn't hang on the dead connection
+        self.assertLess(progress.sent, 50)
+
+    async def test_login_refused(self):
+        self.tmi.mode = 'refuse'
+        with self.assertRaises(moderation_pool.LoginFailed):
+            await asyncio.wait_for(self.pool.resize(1), 5)
+        self.assertEqual(len(self.tmi.writers), 1)  # not retried
+
+    @mock.patch.object(moderation_pool, 'CONNECT_ATTEMPTS', 2)
+    @mock.patch.object(moderation_pool, 'MAX_BACKOFF', 0.05)
+    @mock.patch.object(moderation_pool, 'CONNECT_TIMEOUT', 0.2)
+    async def test_login_timeout(self):
+        self.tmi.mode = 'silent'
+        with self.assertRaises(ConnectionError):
+            await asyncio.wait_for(self.pool.resize(1), 5)
+        self.assertEqual(len(self.tmi.writers), 2)
+
+    async def test_ready_after_welcome(self):
+        self.tmi.mode = 'silent'
+        resize = asyncio.create_task(self.pool.resize(1))
+        await asyncio.sleep(0.1)
+        self.assertFalse(self.pool.connections[0].ready.is_set())
+        self.tmi.writers[0].write(b':tmi.twitch.tv 001 bot :Welcome, GLHF!\r\n')
+        await asyncio.wait_for(resize, 5)
+        self.assertTrue(self.pool.connections[0].ready.is_set())
+
+    async def test_backoff(self):
+        self.tmi.mode = 'drop'
+        await asyncio.wait_for(self.pool.resize(1), 5)
+        await asyncio.sleep(0.5)
+        self.assertLessEqual(len(self.tmi.writers), 2)  # waits a second before the next attempt
+        self.assertGreaterEqual(self.pool.connections[0].failures, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,161 @@
+#  This is a simple utility bot
+#  Copyright (C) 2021 Mm2PL
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import asyncio
+import json
+import time
+import unittest
+import warnings
+
+from websockets.asyncio.server import serve
+from websockets.exceptions import ConnectionClosed
+
+from apis.pubsub import PubsubClient, PubsubWarning
+
+
+class FakePubsub:
+    """Local stand-in for Twitch's PubSub server."""
+
+    def __init__(self):
+        self.connections = []
+        self.frames = []
+        self.topics = {}  # connection -> set of topics
+
+    async def handler(self, ws):
+        self.connections.append(ws)
+        self.topics[ws] = set()
+        try:
+            async for raw in ws:
+                await self._handle(ws, json.loads(raw))
+        except ConnectionClosed:
+            pass
+
+    async def _handle(self, ws, msg):
+        self.frames.append((ws, msg))
+        if msg['type'] == 'PING':
+            await ws.send(json.dumps({'type': 'PONG'}))
+        elif msg['type'] in ('LISTEN', 'UNLISTEN'):
+            if msg['type'] == 'LISTEN':
+                self.topics[ws].update(msg['data']['topics'])
+            else:
+                self.topics[ws].difference_update(msg['data']['topics'])
+            await ws.send(json.dumps({'type': 'RESPONSE', 'nonce': msg['nonce'], 'error': ''}))
+
+    async def publish(self, topic, message):
+        for ws, topics in self.topics.items():
+            if topic in topics:
+                await ws.send(json.dumps({
+                    'type': 'MESSAGE',
+                    'data': {'topic': topic, 'message': json.dumps(message)}
+                }))
+
+    def listen_frames(self, type_='LISTEN'):
+        return [msg for _, msg in self.frames if msg['type'] == type_]
+
+
+async def _wait_for(condition, timeout=5):
+    start = time.monotonic()
+    while not condition():
+        if time.monotonic() - start > timeout:
+            raise AssertionError('Condition not met')
+        await asyncio.sleep(0.01)
+
+
+class PubsubTests(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.server = FakePubsub()
+        self.ws_server = await serve(self.server.handler, '127.0.0.1', 0)
+        port = self.ws_server.sockets[0].getsockname()[1]
+        self.client = PubsubClient('token', url=f'ws://127.0.0.1:{port}', max_topics=50, max_connections=3,
+                                   min_backoff=0.05)
+        self.client.log_function = lambda *args, **kwargs: None
+        await self.client.initialize()
+
+    async def asyncTearDown(self):
+        await self.client.stop()
+        self.ws_server.close()
+        await self.ws_server.wait_closed()
+
+    def _listened(self):
+        return set().union(*self.server.topics.values()) if self.server.topics else set()
+
+    async def test_sharding(self):
+        topics = [f'video-playback.channel{i}' for i in range(120)]
+        self.client.listen(topics)
+        await _wait_for(lambda: self._listened() == set(topics))
+        self.assertEqual(sorted(len(i) for i in self.server.topics.values()), [20, 50, 50])
+        # one frame per connection
+        self.assertEqual(len(self.server.listen_frames()), 3)
+        self.assertTrue(all(i['data']['auth_token'] == 'token' for i in self.server.listen_frames()))
+
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            self.client.listen([f'video-playback.extra{i}' for i in range(31)])
+        self.assertEqual(self.client.rejected_topics, 1)
+        self.assertTrue(any(issubclass(i.category, PubsubWarning) for i in caught))
+
+    async def test_batched_unlisten(self):
+        for i in range(10):
+            self.client.listen([f'topic{i}'])
+        await _wait_for(lambda: len(self._listened()) == 10)
+        self.assertEqual(len(self.server.listen_frames()), 1)
+        for i in range(5):
+            self.client.unlisten([f'topic{i}'])
+        await _wait_for(lambda: len(self._listened()) == 5)
+        self.assertEqual(len(self.server.listen_frames('UNLISTEN')), 1)
+        # freed up room is reused
+        self.client.listen(['topic10'])
+        await _wait_for(lambda: 'topic10' in self._listened())
+        self.assertEqual(len(self.server.connections), 1)
+
+    async def test_slow_callback(self):
+        received = []
+        slow_started = asyncio.Event()
+
+        @self.client.register_callback('slow')
+        async def _slow(topic, data):
+            slow_started.set()
+            await asyncio.sleep(60)
+
+        @self.client.register_callback('fast')
+        def _fast(topic, data):
+            received.append(data['n'])
+
+        self.client.listen(['slow', 'fast'])
+        await _wait_for(lambda: self._listened() == {'slow', 'fast'})
+        await self.server.publish('slow', {})
+        await slow_started.wait()
+        for i in range(5):
+            await self.server.publish('fast', {'n': i})
+        await _wait_for(lambda: len(received) == 5)
+        self.assertEqual(received, list(range(5)))  # in order
+
+    async def test_reconnect(self):
+        topics = [f'topic{i}' for i in range(70)]
+        self.client.listen(topics)
+        await _wait_for(lambda: self._listened() == set(topics))
+        victim = next(ws for ws, t in self.server.topics.items() if len(t) == 20)
+        self.server.topics[victim] = set()
+        frames_before = len(self.server.listen_frames())
+        await victim.close()
+        await _wait_for(lambda: self._listened() == set(topics))
+        # only the topics of the broken connection are listened to again
+        new_frames = self.server.listen_frames()[frames_before:]
+        self.assertEqual([len(i['data']['topics']) for i in new_frames], [20])
+        self.assertEqual(len(self.server.connections), 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,163 @@
+#  This is a simple utility bot
+#  Copyright (C) 2021 Mm2PL
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import asyncio
+import contextlib
+import time
+import unittest
+from unittest import mock
+
+import sqlalchemy
+from sqlalchemy.orm import declarative_base, sessionmaker
+from sqlalchemy.pool import StaticPool
+
+try:
+    from ..helpers import reminder_scheduler
+    from ..helpers.reminder_scheduler import ReminderScheduler
+    from ..models import reminder as reminder_model
+except ImportError:
+    from .helpers import reminder_scheduler
+    from .helpers.reminder_scheduler import ReminderScheduler
+    from .models import reminder as reminder_model
+
+
+class SchedulerTests(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.fired = []
+        self.scheduler = ReminderScheduler(self.fired.append)
+
+    async def test_order(self):
+        now = time.time()
+        for i in (5, 1, 3, 2, 4):
+            self.scheduler.add('chan', 'user', str(i), i, due=now + i)
+        self.scheduler.fire_due(now + 3.5)
+        self.assertEqual([r.text for r in self.fired], ['1', '2', '3'])
+        self.assertEqual([r.text for r in self.scheduler.in_channel('chan')], ['4', '5'])
+        self.assertEqual(len(self.scheduler), 2)
+
+    async def test_cancel(self):
+        now = time.time()
+        reminders = [self.scheduler.add('chan', 'user', str(i), i, due=now + i) for i in range(200)]
+        for r in reminders[:150]:
+            self.scheduler.cancel(r)
+        self.assertEqual(len(self.scheduler), 50)
+        self.assertLess(len(self.scheduler._heap), 200)  # compacted
+        self.scheduler.fire_due(now + 1000)
+        self.assertEqual([r.text for r in self.fired], [str(i) for i in range(150, 200)])
+        self.assertNotIn('chan', self.scheduler.by_channel)
+
+    async def test_recurring(self):
+        now = time.time()
+        r = self.scheduler.add('chan', 'user', 'nr', 10, recurring=True, due=now)
+        self.scheduler.fire_due(now)
+        self.scheduler.fire_due(now + 5)
+        self.assertEqual(self.fired, [r])
+        self.assertEqual(r.due, now + 10)
+        self.scheduler.fire_due(now + 10)
+        self.assertEqual(self.fired, [r, r])
+        self.assertEqual(len(self.scheduler), 1)
+
+    async def test_wakes_up(self):
+        task = asyncio.create_task(self.scheduler.run())
+        self.scheduler.add('chan', 'user', 'later', 60)
+        await asyncio.sleep(0)
+        start = time.monotonic()
+        self.scheduler.add('chan', 'user', 'soon', 0, due=time.time() + 0.05)
+        while not self.fired:
+            await asyncio.sleep(0.01)
+        task.cancel()
+        self.assertEqual(self.fired[0].text, 'soon')
+        self.assertLess(time.monotonic() - start, 0.5)
+
+    async def test_many(self):
+        now = time.time()
+        start = time.monotonic()
+        reminders = [self.scheduler.add(f'chan{i % 100}', 'user', 'text', i, due=now + i) for i in range(100_000)]
+        for r in reminders[::2]:
+            self.scheduler.cancel(r)
+        self.scheduler.fire_due(now + 50_000)
+        self.assertEqual(len(self.fired), 25_000)
+        self.assertLess(time.monotonic() - start, 5)
+
+
+class PersistenceTests(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        base = declarative_base()
+        self.table = reminder_model.get(base).__table__
+        engine = sqlalchemy.create_engine('sqlite://', connect_args={'check_same_thread': False},
+                                          poolclass=StaticPool)
+        base.metadata.create_all(engine)
+        self.Session = sessionmaker(bind=engine)
+
+    @contextlib.contextmanager
+    def session_scope(self):
+        session = self.Session()
+        try:
+            yield session
+            session.commit()
+        finally:
+            session.close()
+
+    def _rows(self):
+        with self.session_scope() as session:
+            return {row.id: row for row in session.execute(sqlalchemy.select(self.table))}
+
+    async def test_round_trip(self):
+        scheduler = ReminderScheduler(lambda r: None, self.table, self.session_scope)
+        now = time.time()
+        once = scheduler.add('chan', 'user', 'once', 10, due=now)
+        recurring = scheduler.add('chan', 'user', 'every', 10, recurring=True, due=now)
+        cancelled = scheduler.add('chan', 'user', 'cancelled', 10)
+        scheduler.cancel(cancelled)  # coalesced with the insert
+        await scheduler.flush()
+        self.assertEqual(sorted(self._rows()), [once.id, recurring.id])
+        self.assertEqual(scheduler.writes, 1)
+
+        scheduler.fire_due(now)
+        await scheduler.flush()
+        rows = self._rows()
+        self.assertEqual(list(rows), [recurring.id])
+        self.assertEqual(rows[recurring.id].due, now + 10)
+
+        loaded = ReminderScheduler(lambda r: None, self.table, self.session_scope)
+        await loaded.load()
+        self.assertEqual(len(loaded), 1)
+        r = loaded.in_channel('chan')[0]
+        self.assertEqual((r.text, r.recurring, r.due), ('every', True, now + 10))
+        self.assertGreater(loaded.add('chan', 'user', 'new', 1).id, recurring.id)
+
+    @mock.patch.object(reminder_scheduler, 'MAX_WRITE_ATTEMPTS', 2)
+    async def test_failing_row(self):
+        with self.session_scope() as session:
+            session.execute(self.table.insert().values(id=2, channel='chan', user='user', text='taken', seconds=1,
+                                                       due=0, recurring=False))
+        scheduler = ReminderScheduler(lambda r: None, self.table, self.session_scope)
+        reminders = [scheduler.add('chan', 'user', str(i), 10) for i in range(1, 4)]  # the second one's id is taken
+        await scheduler.flush()
+        self.assertEqual(sorted(self._rows()), [1, 2, 3])
+        self.assertEqual(self._rows()[2].text, 'taken')
+        self.assertEqual(list(scheduler._dirty), [2])
+        self.assertFalse(reminders[1].persisted)
+
+        # doesn't hold up other changes
+        late = scheduler.add('chan', 'user', 'late', 10)
+        await scheduler.flush()
+        self.assertIn(late.id, self._rows())
+        self.assertEqual(scheduler._dirty, {})  # given up on
+        self.assertEqual(scheduler._write_attempts, {})
+
+
+if __name__ == '__main__':
+    unittest.main()
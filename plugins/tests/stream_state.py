@@ -0,0 +1,110 @@
+#  This is a simple utility bot
+#  Copyright (C) 2021 Mm2PL
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import asyncio
+import datetime
+import time
+import unittest
+
+from util_bot import stream_state
+
+
+class FakeHelix:
+    def __init__(self, live):
+        self.live = live
+        self.requests = []
+
+    async def request(self, method, path, params=None):
+        logins = [i[1] for i in params]
+        self.requests.append(logins)
+        await asyncio.sleep(0)
+        return {
+            'data': [
+                {
+                    'user_login': i,
+                    'started_at': '2021-01-01T12:00:00Z',
+                    'title': f'{i} stream',
+                    'viewer_count': 10
+                }
+                for i in logins if i in self.live
+            ]
+        }
+
+
+class StreamStateTests(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.helix = FakeHelix({'live1', 'live2'})
+        self.store = stream_state.StreamStateStore(self.helix)
+
+    async def test_pubsub_events(self):
+        self.store.handle_pubsub('foo', {'type': 'stream-up', 'server_time': 1609502400.5})
+        state = await self.store.lookup('foo')
+        self.assertTrue(state.live)
+        self.assertEqual(state.started_at, datetime.datetime(2021, 1, 1, 12, 0, 0, 500000))
+        self.store.handle_pubsub('foo', {'type': 'viewcount', 'server_time': 1609502460, 'viewers': 5})
+        self.assertEqual(state.viewers, 5)
+        self.store.handle_pubsub('foo', {'type': 'stream-down', 'server_time': 1609509600})
+        state = await self.store.lookup('foo')
+        self.assertFalse(state.live)
+        self.assertEqual(state.ended_at, datetime.datetime(2021, 1, 1, 14))
+        self.assertEqual(self.helix.requests, [])
+        self.assertEqual((self.store.hits, self.store.misses), (2, 0))
+
+        # the title only comes from the API
+        self.store.handle_pubsub('foo', {'type': 'stream-up', 'server_time': 1609516800})
+        await self.store.lookup('foo', need_title=True)
+        self.assertEqual(self.helix.requests, [['foo']])
+
+    async def test_viewcount_without_stream_up(self):
+        self.store.handle_pubsub('live1', {'type': 'viewcount', 'server_time': time.time(), 'viewers': 5})
+        state = await self.store.lookup('live1')
+        self.assertEqual(state.started_at, datetime.datetime(2021, 1, 1, 12))
+        self.assertEqual(self.helix.requests, [['live1']])
+
+    async def test_lookup_single_flight(self):
+        states = await asyncio.gather(*(self.store.lookup(i) for i in ('live1', 'live1', 'offline', 'live1')))
+        self.assertEqual([i.live for i in states], [True, True, False, True])
+        self.assertEqual(sorted(self.helix.requests), [['live1'], ['offline']])
+
+    async def test_stale(self):
+        self.store.handle_pubsub('live1', {'type': 'stream-up', 'server_time': time.time()})
+        self.store.states['live1'].checked_at -= stream_state.STALE_AFTER + 1
+        self.store.track('live1')
+        self.assertEqual(self.store.stale_channels, 1)
+        self.assertGreater(self.store.max_age, stream_state.STALE_AFTER)
+        await self.store.lookup('live1')
+        self.assertEqual(self.store.stale_channels, 0)
+        self.assertEqual(self.store.states['live1'].title, 'live1 stream')
+
+    async def test_batched_poll(self):
+        channels = [f'channel{i}' for i in range(250)] + ['live1', 'live2']
+        await self.store.poll(channels)
+        self.assertEqual([len(i) for i in self.helix.requests], [100, 100, 52])
+        self.assertEqual(sorted(i for i, state in self.store.states.items() if state.live), ['live1', 'live2'])
+
+    async def test_poller(self):
+        for i in ('live1', 'offline', '#irc-channel'):
+            self.store.track(i)
+        self.store.poll_interval = 0.01
+        task = asyncio.create_task(self.store.run())
+        await asyncio.sleep(0.05)
+        self.store.poll_interval = None
+        await task
+        self.assertEqual(sorted(self.helix.requests[0]), ['live1', 'offline'])
+        self.assertEqual(len(self.helix.requests), 1)  # fresh afterwards
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,160 @@
+#  This is a simple utility bot
+#  Copyright (C) 2020 Mm2PL
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import asyncio
+import random
+import time
+import unittest
+
+import twitchirc
+
+from util_bot.clients.twitch import convert_twitchirc_to_standarized
+from util_bot.clients.twitch_connection import AsyncConnection
+from util_bot.clients.twitch_parser import LazyTags
+
+RECORDED_TRAFFIC = [
+    b':tmi.twitch.tv 001 mm2pl_bot :Welcome, GLHF!',
+    b':tmi.twitch.tv 376 mm2pl_bot :>',
+    b':tmi.twitch.tv CAP * ACK :twitch.tv/commands twitch.tv/tags',
+    b':mm2pl_bot!mm2pl_bot@mm2pl_bot.tmi.twitch.tv JOIN #pajlada',
+    b'@badge-info=subscriber/26;badges=moderator/1,subscriber/24;color=#FF0000;display-name=Mm2PL;emotes=;flags=;'
+    b'id=3f2b4f5d-4a6a-4c4f-9a9e-2c3a8d1c6a1b;mod=1;room-id=11148817;subscriber=1;tmi-sent-ts=1600000000000;'
+    b'turbo=0;user-id=117691339;user-type=mod :mm2pl!mm2pl@mm2pl.tmi.twitch.tv PRIVMSG #pajlada :!ping',
+    b'PING :tmi.twitch.tv',
+    b'@badge-info=;badges=;color=;display-name=SomeUser;emotes=25:0-4;flags=;id=c0ffee00-0000-4000-8000-000000000000;'
+    b'mod=0;room-id=11148817;subscriber=0;tmi-sent-ts=1600000001000;turbo=0;user-id=12345;user-type= '
+    b':someuser!someuser@someuser.tmi.twitch.tv PRIVMSG #pajlada :Kappa \xc5\xbc\xc3\xb3\xc5\x82w \\s escaped?',
+    b'@login=someuser;room-id=;target-msg-id=c0ffee00-0000-4000-8000-000000000000;tmi-sent-ts=1600000002000 '
+    b':tmi.twitch.tv CLEARMSG #pajlada :Kappa',
+]
+
+
+class FakeIrcServer:
+    """Accepts a single client, records what it sends and replays recorded traffic in randomly sized chunks."""
+
+    def __init__(self, traffic):
+        self.traffic = traffic
+        self.received = []
+        self.received_at = []
+        self.server = None
+        self.port = None
+        self.done = asyncio.Event()
+
+    async def start(self):
+        self.server = await asyncio.start_server(self._handle, '127.0.0.1', 0)
+        self.port = self.server.sockets[0].getsockname()[1]
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        data = b''.join(line + b'\r\n' for line in self.traffic)
+        rng = random.Random(1)
+        pos = 0
+        while pos < len(data):
+            size = rng.randint(1, 40)
+            writer.write(data[pos:pos + size])
+            await writer.drain()
+            pos += size
+            await asyncio.sleep(0)
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            self.received.append(line.rstrip(b'\r\n'))
+            self.received_at.append(time.monotonic())
+        writer.close()
+        self.done.set()
+
+    def close(self):
+        self.server.close()
+
+
+class AsyncConnectionTests(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.server = FakeIrcServer(RECORDED_TRAFFIC)
+        await self.server.start()
+        self.conn = AsyncConnection('127.0.0.1', self.server.port, message_cooldown=0)
+        await self.conn.aconnect('mm2pl_bot', 'oauth:xd')
+
+    async def asyncTearDown(self):
+        await self.conn.adisconnect()
+        self.server.close()
+
+    async def _receive_all(self):
+        messages = []
+        while len(messages) < len(RECORDED_TRAFFIC):
+            await asyncio.wait_for(self.conn.areceive(), 5)
+            messages.extend(self.conn.process_messages(1000))
+        return messages
+
+    async def test_replay(self):
+        messages = await self._receive_all()
+        expected = convert_twitchirc_to_standarized(
+            [twitchirc.auto_message(line.decode(), parent=self.conn) for line in RECORDED_TRAFFIC],
+            self.conn
+        )
+        self.assertEqual([type(i) for i in messages], [type(i) for i in expected])
+        for got, exp in zip(messages, expected):
+            self.assertEqual((got.action, got.source, got.args, got.new_args),
+                             (exp.action, exp.source, exp.args, exp.new_args))
+            self.assertEqual(got.flags, exp.flags)
+            if isinstance(exp, twitchirc.ChannelMessage):
+                self.assertEqual((got.user, got.channel, got.text, got.platform),
+                                 (exp.user, exp.channel, exp.text, exp.platform))
+        self.assertEqual(self.conn.receive_bytes, b'')
+
+    async def test_lazy_tags(self):
+        messages = await self._receive_all()
+        msg = messages[4]
+        self.assertIsInstance(msg.flags, LazyTags)
+        self.assertFalse(msg.flags.decoded)
+        self.assertEqual(msg.text, '!ping')
+        self.assertFalse(msg.flags.decoded)
+        self.assertEqual(msg.flags['badges'], 'moderator/1,subscriber/24')
+        self.assertTrue(msg.flags.decoded)
+        self.assertIs(msg.flags['room-id'], messages[6].flags['room-id'])
+        self.assertEqual(dict(messages[6].flags)['user-type'], '')
+
+    async def test_login_and_send(self):
+        await self._receive_all()
+        self.conn.join('pajlada')
+        self.conn.send(twitchirc.ChannelMessage('test 1', 'mm2pl_bot', 'pajlada', outgoing=True))
+        await asyncio.sleep(0.05)
+        await self.conn.wait_writable()
+        await self.conn.adisconnect()
+        await asyncio.wait_for(self.server.done.wait(), 5)
+        self.assertEqual(self.server.received, [
+            b'PASS oauth:xd',
+            b'NICK mm2pl_bot',
+            b'JOIN #pajlada',
+            b'PRIVMSG #pajlada :test 1',
+            b'QUIT',
+        ])
+
+    async def test_channel_cooldown(self):
+        await self._receive_all()
+        self.conn.message_cooldown = 0.2
+        self.conn.join('pajlada')
+        for i in range(3):
+            self.conn.send(twitchirc.ChannelMessage(f'msg {i}', 'mm2pl_bot', 'pajlada', outgoing=True))
+        await asyncio.sleep(0.6)
+        await self.conn.adisconnect()
+        await asyncio.wait_for(self.server.done.wait(), 5)
+        times = [t for line, t in zip(self.server.received, self.server.received_at) if line.startswith(b'PRIVMSG')]
+        self.assertEqual(len(times), 3)
+        for previous, current in zip(times, times[1:]):
+            self.assertGreaterEqual(current - previous, 0.15)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,98 @@
+#  This is a simple utility bot
+#  Copyright (C) 2021 Mm2PL
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import copy
+import json
+import pickle
+import unittest
+
+import twitchirc
+
+from util_bot.clients.twitch_parser import LazyTags, parse_line
+from util_bot.msg import StandardizedMessage, StandardizedWhisperMessage
+
+PRIVMSG = (b'@badges=moderator/1;color=#FF0000;display-name=Mm2PL;emotes=;room-id=11148817;user-id=117691339 '
+           b':mm2pl!mm2pl@mm2pl.tmi.twitch.tv PRIVMSG #pajlada :!ping')
+ESCAPED = (b'@system-msg=Some\\sUser\\ssubscribed\\:\\sback\\\\path\\r\\nnewline;empty=;trailing=abc\\ '
+           b':someuser!someuser@someuser.tmi.twitch.tv PRIVMSG #pajlada :\xc5\xbc\xc3\xb3\xc5\x82w')
+
+
+class ParserTests(unittest.TestCase):
+    def _expected_tags(self, line: bytes) -> dict:
+        return twitchirc.auto_message(line.decode()).flags
+
+    def test_lazy_decoding(self):
+        msg = parse_line(b'junk' + PRIVMSG + b'\r\n', 4, 4 + len(PRIVMSG))
+        self.assertIsInstance(msg, StandardizedMessage)
+        self.assertEqual((msg.user, msg.channel, msg.text), ('mm2pl', 'pajlada', '!ping'))
+        self.assertIsInstance(msg.flags, LazyTags)
+        self.assertFalse(msg.flags.decoded)
+        self.assertEqual(msg.flags['display-name'], 'Mm2PL')
+        self.assertTrue(msg.flags.decoded)
+        self.assertEqual(msg.flags, self._expected_tags(PRIVMSG))
+
+    def test_escapes(self):
+        msg = parse_line(ESCAPED)
+        self.assertEqual(msg.text, 'żółw')
+        self.assertEqual(dict(msg.flags), self._expected_tags(ESCAPED))
+        self.assertEqual(msg.flags['system-msg'], 'Some User subscribed; back\\path\r\nnewline')
+        self.assertEqual(msg.flags['empty'], '')
+
+    def test_other_messages(self):
+        whisper = parse_line(b'@badges=;color= :mm2pl!mm2pl@mm2pl.tmi.twitch.tv WHISPER mm2pl_bot :hi')
+        self.assertIsInstance(whisper, StandardizedWhisperMessage)
+        self.assertEqual((whisper.user_from, whisper.user_to, whisper.text), ('mm2pl', 'mm2pl_bot', 'hi'))
+        self.assertEqual(whisper.flags, {'badges': '', 'color': ''})
+        untagged = parse_line(b':mm2pl!mm2pl@mm2pl.tmi.twitch.tv PRIVMSG #pajlada :hi')
+        self.assertEqual(untagged.flags, {})
+        self.assertIsInstance(parse_line(b'PING :tmi.twitch.tv'), twitchirc.PingMessage)
+
+    def test_copy_and_pickle(self):
+        for decode_first in (False, True):
+            tags = parse_line(ESCAPED).flags
+            if decode_first:
+                tags.get('empty')
+            with self.subTest(decode_first=decode_first):
+                expected = self._expected_tags(ESCAPED)
+                for copied in (copy.copy(tags), copy.deepcopy(tags), pickle.loads(pickle.dumps(tags)),
+                               pickle.loads(pickle.dumps(tags, protocol=0))):
+                    self.assertIsInstance(copied, LazyTags)
+                    self.assertTrue(copied.decoded)
+                    self.assertEqual(copied, expected)
+                    copied['new'] = 'value'
+                    self.assertNotIn('new', tags)
+                self.assertEqual(tags.copy(), expected)
+
+    def test_plain_dict_copies(self):
+        expected = self._expected_tags(ESCAPED)
+        copies = {
+            'dict': dict,
+            'unpack': lambda tags: {**tags},
+            'union': lambda tags: {} | tags,
+            'tags': lambda tags: tags.tags,
+        }
+        for name, make_copy in copies.items():
+            with self.subTest(name):
+                tags = parse_line(ESCAPED).flags
+                self.assertFalse(tags.decoded)
+                self.assertEqual(make_copy(tags), expected)
+        tags = parse_line(ESCAPED).flags
+        with self.assertRaises(TypeError):
+            json.dumps(tags)
+        self.assertEqual(json.loads(json.dumps(tags.tags)), expected)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,126 @@
+#  This is a simple utility bot
+#  Copyright (C) 2020 Mm2PL
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import asyncio
+import os
+import time
+import unittest
+
+try:
+    from ..helpers import math_interpreter, worker_pool
+except ImportError:
+    from .helpers import math_interpreter, worker_pool
+
+
+def _pid():
+    return os.getpid()
+
+
+def _parent_pid():
+    return os.getppid()
+
+
+def _sleep(seconds: float, value=None):
+    time.sleep(seconds)
+    return value
+
+
+def _spin():
+    while True:
+        pass
+
+
+def _allocate():
+    return len(bytearray(512 * 1024 * 1024))
+
+
+class Unpicklable(Exception):
+    def __init__(self, a, b):
+        super().__init__()  # args stay empty, unpickling calls Unpicklable()
+
+
+def _raise_unpicklable():
+    raise Unpicklable(1, 2)
+
+
+class WorkerPoolTests(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.pool = worker_pool.WorkerPool(1, queue_size=4, per_user=2, timeout=5, cpu_seconds=1,
+                                           memory_bytes=256 * 1024 * 1024, preload=[math_interpreter.__name__])
+        self.pool.start()
+
+    async def asyncTearDown(self):
+        self.pool.close()
+
+    async def test_result(self):
+        pid = await self.pool.submit('a', _pid)
+        self.assertNotEqual(pid, os.getpid())
+        self.assertEqual(await self.pool.submit('a', _pid), pid)  # workers are reused
+        self.assertNotEqual(await self.pool.submit('a', _parent_pid), os.getpid())  # forked by the fork server
+
+    async def test_math(self):
+        self.assertEqual(await self.pool.submit('a', math_interpreter.evaluate, '2**6', 'a'), '64')
+        plot = await self.pool.submit('a', math_interpreter.evaluate, 'plot(lambda x: x**2, 0, 1, 0.01)', 'a')
+        self.assertTrue(plot.image.getvalue().startswith(b'\x89PNG'))
+        with self.assertRaises(math_interpreter.UnsafeError) as cm:
+            await self.pool.submit('a', math_interpreter.evaluate, '9**9999', 'a')
+        self.assertTrue(cm.exception.from_eval)
+
+    async def test_wall_clock_limit(self):
+        pid = await self.pool.submit('a', _pid)
+        with self.assertRaises(worker_pool.WorkerTimeout):
+            await self.pool.submit('a', _sleep, 10, timeout=0.2)
+        self.assertNotEqual(await self.pool.submit('a', _pid), pid)
+
+    async def test_cpu_limit(self):
+        with self.assertRaises(worker_pool.WorkerCrashed):
+            await self.pool.submit('a', _spin)
+        self.assertEqual(await self.pool.submit('a', _sleep, 0, 'alive'), 'alive')
+
+    async def test_memory_limit(self):
+        with self.assertRaises(MemoryError):
+            await self.pool.submit('a', _allocate)
+
+    async def test_pickling_errors(self):
+        with self.assertRaises(Exception):
+            await asyncio.wait_for(self.pool.submit('a', lambda: 1), 5)  # lambdas can't be sent to the worker
+        with self.assertRaises(TypeError):
+            await asyncio.wait_for(self.pool.submit('a', _raise_unpicklable), 5)
+        self.assertEqual(await asyncio.wait_for(self.pool.submit('a', _sleep, 0, 'alive'), 5), 'alive')
+        self.assertEqual((len(self.pool._idle), len(self.pool._busy)), (1, 0))
+
+    async def test_fairness(self):
+        order = []
+
+        async def _job(user, value):
+            order.append(await self.pool.submit(user, _sleep, 0.01, value))
+
+        running = self.pool.submit('x', _sleep, 0.2)  # occupies the only worker while the rest is queued
+        jobs = [
+            _job('a', 'a1'),
+            _job('a', 'a2'),
+            _job('b', 'b1'),
+        ]
+        tasks = [asyncio.create_task(i) for i in jobs]
+        await asyncio.sleep(0)
+        with self.assertRaises(worker_pool.QueueFull):
+            self.pool.submit('a', _sleep, 0)
+        await running
+        await asyncio.gather(*tasks)
+        self.assertEqual(order, ['a1', 'b1', 'a2'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,10 +1,8 @@
 #!/bin/bash
 
-for i in $(ls plugins/tests/); do
-  if [ "$i" = "__pycache__" ]; then
-    continue
-  fi
-  if [ "$i" = "__init__" ]; then
+for i in plugins/tests/*.py; do
+  i=$(basename "$i")
+  if [ "$i" = "__init__.py" ]; then
     continue
   fi
 
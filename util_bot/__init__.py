@@ -44,7 +44,9 @@ from util_bot.constants import *
 from util_bot.plugin import Plugin, PluginStorage
 from util_bot.uptime import uptime
 from util_bot.userstate import UserStateCapturingMiddleware, bot_user_state, check_moderation
-from util_bot.pubsub import channel_live_state, init_pubsub
+from util_bot.pubsub import init_pubsub, live_state
+from util_bot.helix import Helix, HelixError
+from util_bot.stream_state import StreamState, StreamStateStore
 import plugins.models.user as user_model
 # noinspection PyUnresolvedReferences
 from apis.supibot import ApiError, SupibotApi, SupibotAuth, SupibotEndpoint
@@ -236,7 +238,8 @@ class PluginMetaPathFinder(_import_abc.MetaPathFinder):
 
 _sys.meta_path.append(PluginMetaPathFinder())
 
-User, flush_users = user_model.get(Base, session_scope, log)
+User, user_writer = user_model.get(Base, session_scope, log)
+flush_users = user_writer
 
 
 class AliasCommand(Command):
@@ -348,7 +351,7 @@ def verify_signed_code(code: str, sign: bytes):
 def check_spamming_allowed(channel: str, enable_online_spam=False):
     if channel == 'whispers':
         return False
-    if channel in channel_live_state and channel_live_state[channel]:  # channel is live
+    if live_state.is_live(channel):
         return enable_online_spam and check_spamming_allowed(channel, False)
     if channel in bot_user_state:
         return bot_user_state[channel]['mode'] in ('mod', 'vip')
@@ -357,13 +360,23 @@ def check_spamming_allowed(channel: str, enable_online_spam=False):
 
 
 twitch_auth = None
+helix: _t.Optional[Helix] = None
+stream_states = StreamStateStore()
+
+
+def _refresh_twitch_auth():
+    twitch_auth.refresh()
+    twitch_auth.save()
 
 
 def init_twitch_auth():
-    global twitch_auth
+    global twitch_auth, helix
     # noinspection PyUnresolvedReferences
     import twitch_auth as _ta
     twitch_auth = _ta
+    helix = Helix(lambda: (twitch_auth.json_data['client_id'], twitch_auth.json_data['access_token']),
+                  _refresh_twitch_auth)
+    stream_states.helix = helix
 
 
 other_platform_auth = {}
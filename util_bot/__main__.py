@@ -41,7 +41,7 @@ import util_bot
 from util_bot.msg import StandardizedMessage
 from util_bot.pubsub import init_pubsub, PubsubMiddleware
 from util_bot.rpc import init_server
-from util_bot import languages
+from util_bot import languages, stream_state
 
 @dataclass
 class Args:
@@ -173,7 +173,9 @@ def chat_msg_handler(event: str, msg: StandardizedMessage, *args):
     # ignore other platforms
 
 
-bot.schedule_repeated_event(0.1, 100, flush_users, args=(), kwargs={})
+util_bot.user_writer.batch_size = bot.storage.data.get('user_flush_batch_size', user_model.FLUSH_BATCH_SIZE)
+util_bot.user_writer.flush_interval = bot.storage.data.get('user_flush_interval', user_model.FLUSH_INTERVAL)
+user_writer_task = asyncio.get_event_loop().create_task(util_bot.user_writer.run())
 
 
 def reload_users():
@@ -228,6 +230,7 @@ async def command_reload(msg: twitchirc.ChannelMessage):
                         uses_settings = True
                     if isinstance(value, twitchirc.Command):
                         util_bot.bot.commands.remove(value)
+            util_bot.bot.command_index.invalidate()
 
             # capture ids
             id_of_plugin = id(plugin)
@@ -365,12 +368,7 @@ async def main():
     if 'self_id' in bot.storage.data:
         uid = bot.storage['self_id']
     else:
-        try:
-            uid = util_bot.twitch_auth.new_api.get_users(login=bot.username.lower())[0].json()['data'][0]['id']
-        except KeyError:
-            util_bot.twitch_auth.refresh()
-            util_bot.twitch_auth.save()
-            uid = util_bot.twitch_auth.new_api.get_users(login=bot.username.lower())[0].json()['data'][0]['id']
+        uid = (await util_bot.helix.get_user(login=bot.username))['id']
         bot.storage['self_id'] = uid
 
     await init_server(grpc_listen_addresses)
@@ -411,6 +409,10 @@ async def main():
     bot.middleware.append(pubsub_middleware)
     for i in bot.channels_connected:
         pubsub_middleware.join(twitchirc.Event('join', {'channel': i}, bot, cancelable=False, has_result=False))
+    util_bot.stream_states.poll_interval = bot.storage.data.get('stream_state_poll_interval',
+                                                                stream_state.POLL_INTERVAL)
+    stream_state_task = asyncio.create_task(util_bot.stream_states.run())
+    live_state_task = asyncio.create_task(util_bot.live_state.run())
 
     await bot.join(bot.username.lower())
 
@@ -536,11 +538,7 @@ finally:
             log('warn', f'Failed to call on_reload for plugin {name!r}')
             traceback.print_exc()
     log('debug', 'flush cached users')
-    user_model.users_lock.acquire()
-    for k, v in user_model.modified_users.items():
-        user_model.modified_users[k]['expire_time'] = 0
-    user_model.users_lock.release()
-    flush_users()
+    util_bot.user_writer.flush(force=True)
     log('debug', 'flush cached users: done')
     log('debug', 'update channels and counters')
     bot.storage.auto_save = False
@@ -15,6 +15,7 @@
 #  along with this program.  If not, see <https://www.gnu.org/licenses/>.
 import asyncio
 import inspect
+import time
 import traceback
 import typing
 import warnings
@@ -29,7 +30,8 @@ from util_bot.msg import StandardizedMessage, StandardizedWhisperMessage
 from . import Platform
 from .channel import Channel
 from .clients import CLIENTS
-from .command import Command, CommandCooldown, CommandResult
+from .command import Command, CommandCooldown, CommandIndex, CommandResult
+from .middleware import MiddlewareEntry, MiddlewareList
 from .utils import Reconnect, deprecated
 
 bot_instance = None
@@ -53,8 +55,9 @@ class Bot(twitchirc.Bot):
         bot_instance = self
 
         self.clients: typing.Dict[Platform, typing.Union[AbstractClient, TwitchClient]] = {}
-        self.middleware = []
+        self.middleware = MiddlewareList()
         self.commands = []
+        self.command_index = CommandIndex()
         self.repeated_events = []
         self.recv_q = []
         self._username = ''
@@ -121,20 +124,36 @@ class Bot(twitchirc.Bot):
 
             cmd.permissions_required.extend(required_permissions)
             self.commands.append(cmd)
+            self.command_index.invalidate()
             self.call_middleware('add_command', (cmd,), cancelable=False)
             return cmd
 
         return decorator
 
+    @property
+    def middleware(self) -> MiddlewareList:
+        return self._middleware
+
+    @middleware.setter
+    def middleware(self, value):
+        if not isinstance(value, MiddlewareList):
+            value = MiddlewareList(value)
+        self._middleware = value
+
     def call_middleware(self, action, arguments, cancelable) -> typing.Union[bool, typing.Tuple[bool, typing.Any]]:
         if cancelable:
             event = twitchirc.Event(action, arguments, source=self, cancelable=cancelable)
             canceler: typing.Optional[twitchirc.AbstractMiddleware] = None
-            for m in self.middleware:
-                if hasattr(m, 'aon_action'):
+            blocking, observers = self.middleware.for_action(action)
+            for m, is_async in blocking + observers:
+                if is_async:
                     warnings.warn('Middleware has async on_action variant, but function was called from sync context')
-                else:
+                    continue
+                start = time.perf_counter()
+                try:
                     m.on_action(event)
+                finally:
+                    self.middleware.record_latency(m, action, time.perf_counter() - start)
                 if not canceler and event.canceled:
                     canceler = m
             if event.canceled:
@@ -146,11 +165,35 @@ class Bot(twitchirc.Bot):
         else:
             asyncio.get_event_loop().create_task(self.acall_middleware(action, arguments, cancelable))
 
+    async def _acall_single_middleware(self, entry: MiddlewareEntry, event: twitchirc.Event):
+        start = time.perf_counter()
+        try:
+            if entry.is_async:
+                await entry.middleware.aon_action(event)
+            else:
+                entry.middleware.on_action(event)
+        finally:
+            self.middleware.record_latency(entry.middleware, event.name, time.perf_counter() - start)
+
+    async def _acall_observers(self, observers: typing.List[MiddlewareEntry], event: twitchirc.Event):
+        results = await asyncio.gather(*(self._acall_single_middleware(entry, event) for entry in observers),
+                                       return_exceptions=True)
+        for entry, result in zip(observers, results):
+            if isinstance(result, BaseException):
+                twitchirc.log('warn', f'Middleware {entry.middleware.__class__.__name__} failed to handle '
+                                      f'{event.name!r}: '
+                                      + ''.join(traceback.format_exception(type(result), result,
+                                                                           result.__traceback__)))
+
     async def acall_middleware(self, action, arguments, cancelable) -> typing.Union[bool,
                                                                                     typing.Tuple[bool, typing.Any]]:
         """
         Call all middleware. Shamelessly taken from my IRC library.
 
+        Middleware that can cancel the event are called in order, if the event isn't cancelable they are called
+        concurrently. Middleware that only observe the action (see MiddlewareList) are called in the background
+        after that.
+
         :param action: Action to run.
         :param arguments: Arguments to give, depends on which action you use, for more info see
         AbstractMiddleware.
@@ -159,13 +202,19 @@ class Bot(twitchirc.Bot):
         """
         event = twitchirc.Event(action, arguments, source=self, cancelable=cancelable)
         canceler: typing.Optional[twitchirc.AbstractMiddleware] = None
-        for m in self.middleware:
-            if hasattr(m, 'aon_action'):
-                await m.aon_action(event)
-            else:
-                m.on_action(event)
-            if not canceler and event.canceled:
-                canceler = m
+        blocking, observers = self.middleware.for_action(action)
+        if cancelable:
+            for entry in blocking:
+                await self._acall_single_middleware(entry, event)
+                if not canceler and event.canceled:
+                    canceler = entry.middleware
+        elif len(blocking) == 1:
+            await self._acall_single_middleware(blocking[0], event)
+        elif blocking:
+            await asyncio.gather(*(self._acall_single_middleware(entry, event) for entry in blocking))
+
+        if observers:
+            asyncio.get_event_loop().create_task(self._acall_observers(observers, event))
         if event.canceled:
             twitchirc.log('debug', f'Event {action!r} was canceled by {canceler.__class__.__name__}.')
             return False
@@ -431,30 +480,25 @@ class Bot(twitchirc.Bot):
 
         prefix = self.get_prefix(message.channel, message.platform, message)
         # print(prefix, message.text.startswith(prefix))
-        was_handled = False
         if ' ' not in message.text:
             message.text += ' '
-        for handler in self.commands:
-            handler: Command
-            if handler.matcher_function(message, prefix):
-                print('call command!', handler.chat_command)
-                await self._call_command(handler, message)
-                was_handled = True
-                break
-        if not was_handled:
-            if not await self._acall_forced_prefix_commands(message):
-                self._do_unknown_command(message)
+        self.command_index.ensure_built(self.commands)
+        handler = self.command_index.find(message, prefix)
+        if handler is not None:
+            print('call command!', handler.chat_command)
+            await self._call_command(handler, message)
+        elif not await self._acall_forced_prefix_commands(message):
+            self._do_unknown_command(message)
 
     def _call_forced_prefix_commands(self, message):
         raise NotImplementedError('sync function')
 
     async def _acall_forced_prefix_commands(self, message):
-        for handler in self.commands:
-            if handler.forced_prefix is None:
-                continue
-            elif message.text.startswith(handler.ef_command):
-                await self._call_command(handler, message)
-                return True
+        self.command_index.ensure_built(self.commands)
+        handler = self.command_index.find_forced_prefix(message)
+        if handler is not None:
+            await self._call_command(handler, message)
+            return True
         return False
 
     def _do_unknown_command(self, message):
@@ -498,7 +542,7 @@ class Bot(twitchirc.Bot):
     async def _platform_message_flush_loop(self, platform):
         while 1:
             await self.clients[platform].flush_queues()
-            await asyncio.sleep(1)
+            await asyncio.sleep(self.clients[platform].flush_interval)
 
     async def _platform_recv_loop(self, platform):
         while 1:
@@ -554,7 +598,8 @@ class Bot(twitchirc.Bot):
         scheduler_task = asyncio.create_task(self._run_scheduler())
         awaiter_task = asyncio.create_task(self._command_task_awaiter())
         platform_recv_tasks = [self._platform_recv_loop(platform) for platform in self.clients.keys()]
-        platform_flush_tasks = [self._platform_message_flush_loop(platform) for platform in self.clients.keys()]
+        platform_flush_tasks = [self._platform_message_flush_loop(platform)
+                                for platform, client in self.clients.items() if client.flush_interval is not None]
         await asyncio.wait((scheduler_task, *platform_recv_tasks, *platform_flush_tasks, awaiter_task),
                            return_when=asyncio.FIRST_COMPLETED)
         await self.disconnect()
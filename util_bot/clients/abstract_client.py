@@ -21,6 +21,9 @@ import util_bot
 
 
 class AbstractClient(abc.ABC):
+    # How often flush_queues() should be called, None if the client sends queued messages by itself.
+    flush_interval: typing.Optional[float] = 1
+
     def __init__(self, auth):
         self.auth = auth
 
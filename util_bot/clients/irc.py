@@ -133,6 +133,7 @@ class _Irc(_BaseIrc):
 
 class IrcClient(AbstractClient):
     platform = Platform.IRC
+    flush_interval = None
 
     networks: List[_Irc]
     network_hosts: List[dict]
@@ -13,30 +13,31 @@
 #
 #  You should have received a copy of the GNU General Public License
 #  along with this program.  If not, see <https://www.gnu.org/licenses/>.
-import ssl
 import typing
 
 import twitchirc
 from twitchirc import Event
 
 from util_bot.clients.abstract_client import AbstractClient
+from util_bot.clients.twitch_connection import AsyncConnection
 from util_bot.msg import StandardizedMessage, StandardizedWhisperMessage
 from util_bot.platform import Platform
-from util_bot.utils import watch, Reconnect
+from util_bot.utils import Reconnect
 import util_bot
 
 
 class TwitchClient(AbstractClient):
     platform = Platform.TWITCH
+    flush_interval = None
 
     def __init__(self, auth):
         super().__init__(auth)
-        self.connection = twitchirc.Connection('irc.chat.twitch.tv', 6697, secure=True)
+        self.connection = AsyncConnection('irc.chat.twitch.tv', 6697, secure=True)
         self.middleware = EventPassingMiddleware(util_bot.bot)
         self.connection.middleware.append(self.middleware)
 
     async def connect(self):
-        self.connection.connect(*self.auth)
+        await self.connection.aconnect(*self.auth)
         self.connection.cap_reqs(False)
         if self.connection.channels_connected:
             channels = self.connection.channels_connected.copy()
@@ -45,27 +46,18 @@ class TwitchClient(AbstractClient):
                 await self.join(i)
 
     async def disconnect(self):
-        try:
-            self.connection.disconnect()
-        except ssl.SSLZeroReturnError as e:
-            return  # connection is dead eShrug
+        await self.connection.adisconnect()
 
     async def send(self, msg: typing.Union[StandardizedMessage, StandardizedWhisperMessage]):
         msg = convert_standarized_to_twitchirc(msg)
         try:
-            self.connection.send(msg)
-        except ssl.SSLZeroReturnError as e:
+            await self.connection.wait_writable()
+        except ConnectionError as e:
             raise Reconnect(self.platform) from e
+        self.connection.send(msg)
 
     async def receive(self):
-        await watch(self.connection.socket.fileno())
-
-        try:
-            should_reconnect = self.connection.receive() == 'RECONNECT'
-        except (ConnectionResetError, BrokenPipeError) as e:
-            raise Reconnect(self.platform) from e
-
-        if should_reconnect:
+        if await self.connection.areceive() == twitchirc.connection.RECONNECT:
             raise Reconnect(self.platform)
         return convert_twitchirc_to_standarized(self.connection.process_messages(1000, mode=-1), self.connection)
 
@@ -76,7 +68,7 @@ class TwitchClient(AbstractClient):
         self.connection.part(channel)
 
     async def flush_queues(self):
-        return self.connection.flush_queue(100)
+        return self.connection.flush_queue()
 
     async def format_mention(self, msg: StandardizedMessage) -> str:
         return f'@{msg.user}'
@@ -84,8 +76,7 @@ class TwitchClient(AbstractClient):
     async def reconnect(self):
         self.connection.call_middleware('reconnect', (), False)
         await self.disconnect()
-        util_bot.twitch_auth.refresh()
-        util_bot.twitch_auth.save()
+        await util_bot.helix.refresh_token()
         self.auth = (self.auth[0], 'oauth:' + util_bot.twitch_auth.json_data['access_token'])
         await self.connect()
 
@@ -112,7 +103,9 @@ def convert_twitchirc_to_standarized(l: typing.List[typing.Union[twitchirc.Chann
         typing.List[typing.Union[StandardizedMessage, StandardizedWhisperMessage]]:
     output = []
     for i in l:
-        if isinstance(i, twitchirc.ChannelMessage):
+        if isinstance(i, (StandardizedMessage, StandardizedWhisperMessage)):
+            new = i  # already converted by the parser
+        elif isinstance(i, twitchirc.ChannelMessage):
             new = StandardizedMessage(i.text, i.user, i.channel, Platform.TWITCH, False, parent=message_parent,
                                       source_message=i)
             # noinspection PyProtectedMember
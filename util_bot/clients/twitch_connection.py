@@ -0,0 +1,225 @@
+#  This is a simple utility bot
+#  Copyright (C) 2020 Mm2PL
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import asyncio
+import collections
+import ssl
+import time
+import typing
+
+import twitchirc
+
+from util_bot.clients import twitch_parser
+
+READ_SIZE = 65536
+# Senders wait in AsyncConnection.wait_writable() while more than this many bytes wait to be written to the socket.
+WRITE_HIGH_WATER = 64 * 1024
+
+
+class AsyncConnection(twitchirc.Connection):
+    """
+    twitchirc Connection that does its I/O using asyncio streams.
+
+    Everything that twitchirc would send straight to the socket is put into an outgoing buffer written out by a
+    separate task, so sending never blocks the event loop. Per-channel send queues are flushed by timers armed for
+    the moment the channel's cooldown ends instead of being polled.
+    """
+
+    def __init__(self, address: str, port: int = 6667, message_cooldown: int = 3, secure: bool = False):
+        super().__init__(address, port, message_cooldown, no_atexit=True, secure=secure)
+        self.reader: typing.Optional[asyncio.StreamReader] = None
+        self.writer: typing.Optional[asyncio.StreamWriter] = None
+        self.receive_bytes = bytearray()
+
+        self._outgoing: typing.Deque[bytes] = collections.deque()
+        self._outgoing_size = 0
+        self._outgoing_ready = asyncio.Event()
+        self._writable = asyncio.Event()
+        self._writable.set()
+        self._writer_task: typing.Optional[asyncio.Task] = None
+        self._write_error: typing.Optional[BaseException] = None
+        self._flush_timers: typing.Dict[str, asyncio.TimerHandle] = {}
+
+    async def aconnect(self, username, password: typing.Union[str, None] = None) -> None:
+        """Async version of :py:meth:`connect`."""
+        self.call_middleware('connect', dict(username=username), cancelable=False)
+        twitchirc.info('Connecting...')
+        if self.secure:
+            self._ssl_context = ssl.create_default_context()
+            self.reader, self.writer = await asyncio.open_connection(self.address, self.port,
+                                                                     ssl=self._ssl_context)
+        else:
+            self.reader, self.writer = await asyncio.open_connection(self.address, self.port)
+        self.socket = self.writer.get_extra_info('socket')
+        self.receive_bytes.clear()
+        self._write_error = None
+        self._writer_task = asyncio.create_task(self._write_loop(self.writer))
+        twitchirc.log('debug', 'Logging in...')
+        self._login(username, password)
+        twitchirc.log('debug', 'OK.')
+
+    def connect(self, username, password: typing.Union[str, None] = None) -> None:
+        raise RuntimeError('AsyncConnection has to be connected using aconnect()')
+
+    async def adisconnect(self):
+        """Async version of :py:meth:`disconnect`. Sends out everything that was already queued before closing."""
+        if self.writer is None:
+            return
+        self.call_middleware('disconnect', {}, cancelable=False)
+        self._send(b'QUIT\r\n')
+        writer_task = self._writer_task
+        self._writer_task = None
+        self._outgoing_ready.set()
+        for handle in self._flush_timers.values():
+            handle.cancel()
+        self._flush_timers.clear()
+        writer = self.writer
+        self.writer = self.reader = None
+        self.socket = None
+
+        try:
+            if writer_task is not None:
+                await asyncio.wait_for(writer_task, 5)
+        except (asyncio.TimeoutError, ConnectionError, ssl.SSLError):
+            pass
+        writer.close()
+        try:
+            await writer.wait_closed()
+        except (ConnectionError, ssl.SSLError):
+            pass  # connection is already dead
+
+    def disconnect(self):
+        asyncio.get_event_loop().create_task(self.adisconnect())
+
+    def _send(self, message: bytes):
+        if self.writer is None:
+            return
+        self._outgoing.append(message)
+        self._outgoing_size += len(message)
+        if self._outgoing_size > WRITE_HIGH_WATER:
+            self._writable.clear()
+        self._outgoing_ready.set()
+
+    async def _write_loop(self, writer: asyncio.StreamWriter):
+        try:
+            while self._writer_task is not None or self._outgoing:
+                if not self._outgoing:
+                    self._outgoing_ready.clear()
+                    await self._outgoing_ready.wait()
+                    continue
+                data = b''.join(self._outgoing)
+                self._outgoing.clear()
+                self._outgoing_size = 0
+                writer.write(data)
+                await writer.drain()
+                if self._outgoing_size <= WRITE_HIGH_WATER:
+                    self._writable.set()
+        except (ConnectionError, ssl.SSLError) as e:
+            self._write_error = e
+            twitchirc.log('warn', f'Failed to write to {self.address}:{self.port}: {e!r}')
+        finally:
+            # Never leave senders waiting for a dead connection.
+            self._writable.set()
+
+    async def wait_writable(self):
+        """
+        Wait until the outgoing buffer drops below `WRITE_HIGH_WATER`.
+
+        :raises ConnectionError: if writing to the socket failed.
+        """
+        await self._writable.wait()
+        if self._write_error is not None:
+            raise ConnectionError('Writing to the socket failed') from self._write_error
+
+    def send(self, message: typing.Union[str, twitchirc.ChannelMessage], queue='misc') -> None:
+        super().send(message, queue)
+        if isinstance(message, twitchirc.ChannelMessage):
+            queue = message.channel
+        self._schedule_flush(queue)
+
+    def _schedule_flush(self, queue: str):
+        if queue in self._flush_timers or not self.queue.get(queue):
+            return
+        loop = asyncio.get_event_loop()
+        delay = max(0.0, self.message_wait[queue] - time.time())
+        self._flush_timers[queue] = loop.call_later(delay, self._flush_timer, queue)
+
+    def _flush_timer(self, queue: str):
+        del self._flush_timers[queue]
+        if queue not in self.queue:
+            return
+        if self.hold_send:
+            # Can't send now, try again later.
+            self._flush_timers[queue] = asyncio.get_event_loop().call_later(1, self._flush_timer, queue)
+            return
+        self.flush_single_queue(queue)
+        if self.queue[queue]:
+            self._schedule_flush(queue)
+        elif queue in self.channels_to_remove:
+            self._remove_parted_channels()
+
+    def flush_queue(self, max_messages: int = 1) -> int:
+        """Queues are flushed automatically when their cooldown expires. Only arms missing timers."""
+        for queue_name in list(self.queue):
+            self._schedule_flush(queue_name)
+        return 0
+
+    async def areceive(self) -> typing.Optional[str]:
+        """
+        Wait for data from the server and put it in :py:attr:`receive_bytes`.
+
+        :return: RECONNECT if the connection was closed, None otherwise.
+        """
+        try:
+            data = await self.reader.read(READ_SIZE)
+        except (ConnectionError, ssl.SSLError) as e:
+            twitchirc.log('warn', f'Failed to read from {self.address}:{self.port}: {e!r}')
+            return twitchirc.connection.RECONNECT
+        if not data:
+            twitchirc.log('warn', 'Empty message')
+            return twitchirc.connection.RECONNECT
+        self.receive_bytes += data
+
+    def receive(self):
+        raise RuntimeError('AsyncConnection has to receive data using areceive()')
+
+    def process_messages(self, max_messages: int = 1, mode=-1) -> typing.List[twitchirc.Message]:
+        """
+        Parse complete lines from :py:attr:`receive_bytes` using :py:func:`twitch_parser.parse_line`. Incomplete
+        lines are left in the buffer until the rest of them arrives. Only mode -1 (return every message) is
+        supported.
+        """
+        if mode != -1:
+            raise ValueError('AsyncConnection only supports returning every message')
+        self._remove_parted_channels()
+        buf = self.receive_bytes
+        output = []
+        start = 0
+        for _ in range(max_messages):
+            end = buf.find(b'\n', start)
+            if end == -1:
+                break
+            line_end = end - 1 if end > start and buf[end - 1] == 13 else end  # strip \r
+            line_start = start
+            start = end + 1
+            if line_end == line_start:
+                continue
+            m = twitch_parser.parse_line(buf, line_start, line_end, parent=self)
+            o = self.call_middleware('receive', dict(message=m), True)
+            if o is False:
+                continue
+            output.append(m)
+        del buf[:start]
+        return output
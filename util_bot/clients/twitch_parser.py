@@ -0,0 +1,189 @@
+#  This is a simple utility bot
+#  Copyright (C) 2020 Mm2PL
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import collections.abc
+import sys
+import typing
+
+import twitchirc
+
+from util_bot.msg import StandardizedMessage, StandardizedWhisperMessage
+from util_bot.platform import Platform
+
+# Tag values that repeat between messages, interning them keeps one copy of every distinct value.
+INTERNED_TAGS = frozenset({'badges', 'badge-info', 'color', 'room-id', 'user-type', 'mod', 'subscriber', 'turbo',
+                           'first-msg', 'returning-chatter', 'flags', 'emotes'})
+
+
+class LazyTags(collections.abc.MutableMapping):
+    """
+    IRCv3 tags that are only split and unescaped once something reads them.
+
+    Behaves like the dict twitchirc puts in `Message.flags`, the raw tag string is decoded on the first access.
+    This is a mapping wrapping a dict rather than a dict subclass: C code like `json.dumps` or `{**tags}` reads a
+    dict's storage directly and would see nothing before the first access. Use :py:attr:`tags` for a plain dict.
+    """
+    __slots__ = ('_raw', '_tags')
+
+    def __init__(self, raw: typing.Optional[bytes]):
+        self._raw = raw
+        self._tags = {}
+
+    def _decode(self):
+        raw = self._raw
+        self._raw = None
+        tags = self._tags
+        intern = sys.intern
+        for pair in str(raw, 'utf-8', errors='ignore').split(';'):
+            key, _, value = pair.partition('=')
+            key = intern(key)
+            if '\\' in value:
+                value = twitchirc.Message._unescape_tag_value(value)
+            elif key in INTERNED_TAGS:
+                value = intern(value)
+            tags[key] = value
+
+    @property
+    def decoded(self) -> bool:
+        return self._raw is None
+
+    @property
+    def tags(self) -> dict:
+        """The decoded tags as a plain dict, shared with this object."""
+        if self._raw is not None:
+            self._decode()
+        return self._tags
+
+    def __getitem__(self, key):
+        return self.tags[key]
+
+    def __setitem__(self, key, value):
+        self.tags[key] = value
+
+    def __delitem__(self, key):
+        del self.tags[key]
+
+    def __contains__(self, key):
+        return key in self.tags
+
+    def __iter__(self):
+        return iter(self.tags)
+
+    def __len__(self):
+        return len(self.tags)
+
+    def __eq__(self, other):
+        if isinstance(other, LazyTags):
+            other = other.tags
+        return self.tags == other
+
+    def __or__(self, other):
+        return self.tags | other
+
+    def __ror__(self, other):
+        return other | self.tags
+
+    def __ior__(self, other):
+        self.tags.update(other)
+        return self
+
+    def __repr__(self):
+        return repr(self.tags)
+
+    def get(self, key, default=None):
+        return self.tags.get(key, default)
+
+    def copy(self) -> dict:
+        return self.tags.copy()
+
+    def __reduce__(self):
+        # copies and pickles start out decoded
+        return LazyTags, (None,), None, None, iter(self.tags.items())
+
+
+_EMPTY_TAGS = b''
+
+
+def _make_privmsg(tags, source: str, params: str, parent) -> StandardizedMessage:
+    channel, _, text = params.partition(' ')
+    if text.startswith(':'):
+        text = text[1:]
+    # Same state StandardizedMessage.__init__ + _copy_from() would produce, without building it twice.
+    msg = StandardizedMessage.__new__(StandardizedMessage)
+    msg.action = 'PRIVMSG'
+    msg.source = source
+    msg.args = params
+    msg.outgoing = False
+    msg.parent = parent
+    msg.raw_data = None
+    msg.flags = tags
+    msg.text = text
+    msg.channel = sys.intern(channel.lstrip('#'))
+    msg.platform = Platform.TWITCH
+    msg.source_message = None
+    return msg
+
+
+def _make_whisper(tags, source: str, params: str) -> StandardizedWhisperMessage:
+    user_to, _, text = params.partition(' ')
+    if text.startswith(':'):
+        text = text[1:]
+    user_from = source.split('!', 1)[0]
+    msg = StandardizedWhisperMessage(user_from, user_to, text, Platform.TWITCH, tags)
+    msg.source = source
+    msg.args = params
+    msg.new_args = [user_to, text]
+    return msg
+
+
+def parse_line(buf: typing.Union[bytes, bytearray], start: int = 0, end: typing.Optional[int] = None,
+               parent=None) -> twitchirc.Message:
+    """
+    Parse a single IRC line from `buf[start:end]`, without the line ending.
+
+    PRIVMSGs and WHISPERs become StandardizedMessages and StandardizedWhisperMessages directly, with `flags` being
+    :py:class:`LazyTags`. Everything else is handed to :py:func:`twitchirc.auto_message`. Only the raw tags are
+    copied out of `buf`, the rest of the line is decoded straight from it.
+
+    :param buf: Receive buffer.
+    :param start: Where the line starts.
+    :param end: Where the line ends, defaults to the end of the buffer.
+    :param parent: Connection the line was received from.
+    """
+    if end is None:
+        end = len(buf)
+    with memoryview(buf) as view:
+        tags_raw = _EMPTY_TAGS
+        pos = start
+        if buf[start:start + 1] == b'@':
+            pos = buf.find(b' ', start, end)
+            if pos == -1:
+                return twitchirc.auto_message(str(view[start:end], 'utf-8', errors='ignore'), parent=parent)
+            tags_raw = bytes(view[start + 1:pos])
+            pos += 1
+        rest = str(view[pos:end], 'utf-8', errors='ignore')
+
+        source = None
+        if rest.startswith(':'):
+            source, _, rest = rest.partition(' ')
+            source = source[1:]
+        command, _, params = rest.partition(' ')
+
+        if source is not None and command in ('PRIVMSG', 'WHISPER'):
+            tags = LazyTags(tags_raw) if tags_raw else {}
+            if command == 'PRIVMSG':
+                return _make_privmsg(tags, source, params, parent)
+            return _make_whisper(tags, source, params)
+        return twitchirc.auto_message(str(view[start:end], 'utf-8', errors='ignore'), parent=parent)
@@ -85,6 +85,8 @@ class Command(twitchirc.Command):
     @matcher_function.setter
     def matcher_function(self, value):
         self._legacy_matcher = value
+        if isinstance(getattr(self, 'parent', None), util_bot.Bot):
+            self.parent.command_index.invalidate()
 
     async def check_cooldown(self, msg) -> bool:
         per_channel_key, per_platform_key, per_user_key = self.cooldown_keys(msg)
@@ -200,3 +202,110 @@ class Command(twitchirc.Command):
             self.matcher_function,
             self.cooldown
         ))
+
+
+class CommandIndex:
+    """
+    Dispatch table for :py:class:`Command` objects.
+
+    Commands using the default :py:meth:`Command.subprefix_matcher` are indexed by their casefolded name and
+    aliases, commands with custom matchers are kept aside and checked using the legacy linear scan. Lookups
+    return the same command the linear scan over ``commands`` would, the first one in list order wins.
+    """
+
+    def __init__(self):
+        self._by_word: typing.Dict[str, typing.List[typing.Tuple[int, Command, bool]]] = {}
+        self._forced: typing.Dict[str, typing.Tuple[int, Command]] = {}
+        self._legacy: typing.List[typing.Tuple[int, Command]] = []
+        self._legacy_forced: typing.List[typing.Tuple[int, Command]] = []
+        self._source_length = -1
+        self.dirty = True
+
+    def invalidate(self):
+        self.dirty = True
+
+    def ensure_built(self, commands: typing.List[Command]):
+        if self.dirty or self._source_length != len(commands):
+            self.rebuild(commands)
+
+    @staticmethod
+    def _uses_default_matcher(command) -> bool:
+        if not isinstance(command, Command) or command._legacy_matcher is not None:
+            return False
+        return (getattr(command._matcher_function, '__func__', None) is Command.subprefix_matcher
+                and type(command).default_matcher is Command.default_matcher)
+
+    def rebuild(self, commands: typing.List[Command]):
+        self._by_word = {}
+        self._forced = {}
+        self._legacy = []
+        self._legacy_forced = []
+        for pos, cmd in enumerate(commands):
+            if cmd.forced_prefix is not None:
+                if ' ' in cmd.ef_command[:-1] or not cmd.ef_command.endswith(' '):
+                    self._legacy_forced.append((pos, cmd))
+                else:
+                    self._forced.setdefault(cmd.ef_command[:-1], (pos, cmd))
+
+            if not self._uses_default_matcher(cmd):
+                self._legacy.append((pos, cmd))
+                continue
+            words = [cmd.ef_command[:-1].casefold()] + cmd.aliases
+            if not cmd.ef_command.endswith(' ') or any(' ' in w for w in words):
+                self._legacy.append((pos, cmd))
+                continue
+
+            # commands without the subprefix can only be used as-is in channels with custom prefixes,
+            # see Command.subprefix_matcher
+            subprefix_only = not cmd.chat_command.startswith(COMMAND_SUBPREFIX)
+            for word in words:
+                self._by_word.setdefault(word, []).append((pos, cmd, subprefix_only))
+        self._source_length = len(commands)
+        self.dirty = False
+
+    def _find_indexed(self, msg, prefix: str) -> typing.Tuple[int, typing.Optional[Command]]:
+        prefix = prefix.casefold()
+        temp_txt = msg.text.casefold()
+        if not temp_txt.startswith(prefix):
+            return -1, None
+        can_use_no_subprefix = (
+                (msg.channel, msg.platform) in util_bot.bot.prefixes or
+
+                (msg.platform in util_bot.bot.prefixes
+                 and isinstance(msg, util_bot.StandardizedWhisperMessage))
+        )
+        best_pos = -1
+        best = None
+        word = temp_txt[len(prefix):].split(' ', 1)[0]
+        for pos, cmd, subprefix_only in self._by_word.get(word, ()):
+            if subprefix_only and not can_use_no_subprefix:
+                continue
+            best_pos, best = pos, cmd
+            break
+
+        if temp_txt.startswith(prefix + COMMAND_SUBPREFIX):
+            word = temp_txt.replace(prefix + COMMAND_SUBPREFIX, prefix)[len(prefix):].split(' ', 1)[0]
+            for pos, cmd, _ in self._by_word.get(word, ()):
+                if best is None or pos < best_pos:
+                    best_pos, best = pos, cmd
+                break
+        return best_pos, best
+
+    def find(self, msg, prefix: str) -> typing.Optional[Command]:
+        """Find the command that should handle `msg`. Text of the message must contain a space."""
+        best_pos, best = self._find_indexed(msg, prefix)
+        for pos, cmd in self._legacy:
+            if best is not None and pos > best_pos:
+                break
+            if cmd.matcher_function(msg, prefix):
+                return cmd
+        return best
+
+    def find_forced_prefix(self, msg) -> typing.Optional[Command]:
+        best_pos, best = self._forced.get(msg.text.split(' ', 1)[0], (-1, None))
+        for pos, cmd in self._legacy_forced:
+            if best is not None and pos > best_pos:
+                break
+            if msg.text.startswith(cmd.ef_command):
+                return cmd
+        return best
@@ -0,0 +1,202 @@
+#  This is a simple utility bot
+#  Copyright (C) 2021 Mm2PL
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import asyncio
+import time
+import typing
+
+import aiohttp
+
+from util_bot.constants import USER_AGENT
+
+HELIX_URL = 'https://api.twitch.tv/helix/'
+TIMEOUT = aiohttp.ClientTimeout(total=20, sock_connect=10)
+CONNECTION_LIMIT = 16
+BATCH_SIZE = 100  # maximum number of repeated id/login parameters Helix accepts
+
+
+class HelixError(Exception):
+    def __init__(self, status: int, message: str):
+        super().__init__(f'Helix returned {status}: {message}')
+        self.status = status
+        self.message = message
+
+
+class RateLimit:
+    """
+    Tracks the rate limit bucket Helix reports in the `Ratelimit-Remaining` and `Ratelimit-Reset` headers.
+
+    Requests are let through as long as the last known number of remaining points covers them and the requests
+    still waiting for a response. Once the bucket is empty requests wait for the reset time.
+    """
+
+    def __init__(self):
+        self.remaining: typing.Optional[int] = None
+        self.reset_at = 0.0
+        self.pending = 0
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:
+            while self.remaining is not None and self.remaining - self.pending <= 0:
+                delay = self.reset_at - time.time()
+                if delay <= 0:
+                    self.remaining = None
+                    break
+                await asyncio.sleep(delay)
+            self.pending += 1
+
+    def release(self, headers: typing.Optional[typing.Mapping[str, str]]):
+        self.pending -= 1
+        if headers is None:
+            return
+        try:
+            remaining = int(headers['Ratelimit-Remaining'])
+            reset_at = float(headers['Ratelimit-Reset'])
+        except (KeyError, ValueError):
+            return
+        if reset_at >= self.reset_at:
+            self.remaining = remaining
+            self.reset_at = reset_at
+
+
+class Helix:
+    """
+    Twitch Helix API client. All requests go through one pooled session.
+
+    :param credentials: Returns the client id and the current access token.
+    :param refresh: Blocking function getting a new access token, run in an executor. Concurrent requests failing
+    with 401 share a single refresh.
+    """
+
+    def __init__(self, credentials: typing.Callable[[], typing.Tuple[str, str]],
+                 refresh: typing.Callable[[], None], base_url: str = HELIX_URL):
+        self.credentials = credentials
+        self.refresh = refresh
+        self.base_url = base_url
+        self.rate_limit = RateLimit()
+
+        self._session: typing.Optional[aiohttp.ClientSession] = None
+        self._refreshing: typing.Optional[asyncio.Future] = None
+        self._user_batches: typing.Dict[str, typing.Dict[str, typing.List[asyncio.Future]]] = {}
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=CONNECTION_LIMIT),
+                                                  timeout=TIMEOUT, headers={'User-Agent': USER_AGENT})
+        return self._session
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def refresh_token(self, failed_token: typing.Optional[str] = None):
+        """
+        Get a new access token. If `failed_token` was already replaced nothing is done, if a refresh is already
+        running this waits for it instead of starting another one.
+        """
+        if failed_token is not None and self.credentials()[1] != failed_token:
+            return
+        if self._refreshing is None:
+            self._refreshing = asyncio.get_event_loop().run_in_executor(None, self.refresh)
+            self._refreshing.add_done_callback(self._refresh_done)
+        await asyncio.shield(self._refreshing)
+
+    def _refresh_done(self, _):
+        self._refreshing = None
+
+    async def request(self, method: str, path: str, *, params=None, json=None) -> dict:
+        """
+        Make a Helix request, refreshing the token once if it was rejected.
+
+        :param params: Query parameters, use a list of pairs to repeat a parameter.
+        :return: Deserialized response.
+        :raises HelixError: if the API returned an error status.
+        """
+        for attempt in range(3):
+            client_id, token = self.credentials()
+            headers = {
+                'Authorization': f'Bearer {token}',
+                'Client-ID': client_id
+            }
+            await self.rate_limit.acquire()
+            response_headers = None
+            try:
+                async with self.session.request(method, self.base_url + path, params=params, json=json,
+                                                headers=headers) as r:
+                    response_headers = r.headers
+                    data = await r.json(content_type=None) if r.status != 204 else {}
+                    status = r.status
+            finally:
+                self.rate_limit.release(response_headers)
+
+            if status == 401 and attempt == 0:
+                await self.refresh_token(token)
+                continue
+            if status == 429 and attempt < 2:
+                continue  # the rate limit has been updated from the headers, acquire() waits for the reset
+            if status >= 400:
+                message = data.get('message', '') if isinstance(data, dict) else ''
+                raise HelixError(status, message)
+            return data
+
+    async def get_users(self, logins: typing.Iterable[str] = (), ids: typing.Iterable[str] = ()) \
+            -> typing.List[dict]:
+        """Look up users by login and id, in as few requests as possible."""
+        params = [('login', i) for i in logins] + [('id', i) for i in ids]
+        chunks = [params[i:i + BATCH_SIZE] for i in range(0, len(params), BATCH_SIZE)]
+        results = await asyncio.gather(*(self.request('get', 'users', params=chunk) for chunk in chunks))
+        return [user for result in results for user in result['data']]
+
+    def get_user(self, login: str = None, id: str = None) -> typing.Awaitable[typing.Optional[dict]]:
+        """
+        Look up a single user. Lookups made during the same event loop iteration are sent as one request.
+
+        :return: The user's data or None if they don't exist.
+        """
+        if (login is None) == (id is None):
+            raise TypeError('Exactly one of login and id has to be given')
+        key, value = ('login', login.lower()) if login is not None else ('id', str(id))
+        future = asyncio.get_event_loop().create_future()
+        batch = self._user_batches.get(key)
+        if batch is None:
+            batch = self._user_batches[key] = {}
+            asyncio.get_event_loop().call_soon(self._send_user_batch, key)
+        batch.setdefault(value, []).append(future)
+        return future
+
+    def _send_user_batch(self, key: str):
+        batch = self._user_batches.pop(key)
+        values = list(batch)
+        for i in range(0, len(values), BATCH_SIZE):
+            chunk = {value: batch[value] for value in values[i:i + BATCH_SIZE]}
+            asyncio.create_task(self._resolve_users(key, chunk))
+
+    async def _resolve_users(self, key: str, futures: typing.Dict[str, typing.List[asyncio.Future]]):
+        try:
+            result = await self.request('get', 'users', params=[(key, i) for i in futures])
+        except Exception as e:
+            for waiting in futures.values():
+                for future in waiting:
+                    if not future.done():
+                        future.set_exception(e)
+            return
+        users = {user[key]: user for user in result['data']}
+        for value, waiting in futures.items():
+            for future in waiting:
+                if not future.done():
+                    future.set_result(users.get(value))
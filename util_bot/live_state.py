@@ -0,0 +1,151 @@
+#  This is a simple utility bot
+#  Copyright (C) 2021 Mm2PL
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import asyncio
+import heapq
+import time
+import typing
+
+VIEW_COUNT_TIMEOUT = 60
+STREAM_UP_TIMEOUT = 120
+
+
+class LiveStateTracker:
+    """
+    Which channels are live right now, according to pubsub.
+
+    A channel is live until its deadline passes, every event moves the deadline. Moving a deadline later is only a
+    dict assignment: the heap keeps one entry per channel, and an entry that comes up before its channel's deadline
+    is pushed back to that deadline. Events cost O(1) and expiry costs O(log n) per timeout, with no scans.
+    """
+
+    def __init__(self):
+        self.deadlines: typing.Dict[str, float] = {}
+        self._heap: typing.List[typing.Tuple[float, str]] = []
+        self._scheduled: typing.Dict[str, float] = {}  # channel -> time of its current heap entry
+        self._up_waiters: typing.Dict[str, typing.List[asyncio.Future]] = {}
+        self._down_waiters: typing.Dict[str, typing.List[asyncio.Future]] = {}
+        self._wake = asyncio.Event()
+
+        self.expirations = 0
+        self.transitions = 0
+
+    def __len__(self):
+        return len(self.deadlines)
+
+    def is_live(self, channel: str, now: typing.Optional[float] = None) -> bool:
+        deadline = self.deadlines.get(channel)
+        return deadline is not None and deadline > (time.monotonic() if now is None else now)
+
+    @property
+    def live_channels(self) -> typing.List[str]:
+        now = time.monotonic()
+        return [k for k, v in self.deadlines.items() if v > now]
+
+    @staticmethod
+    def _resolve(waiters: typing.Dict[str, typing.List[asyncio.Future]], channel: str, result):
+        for future in waiters.pop(channel, ()):
+            if not future.done():
+                future.set_result(result)
+
+    def mark_live(self, channel: str, timeout: float, message: typing.Optional[dict] = None,
+                  now: typing.Optional[float] = None) -> bool:
+        """Keep `channel` live for `timeout` more seconds. Returns True if the channel just went live."""
+        now = time.monotonic() if now is None else now
+        went_up = not self.is_live(channel, now)
+        deadline = self.deadlines[channel] = now + timeout
+        scheduled = self._scheduled.get(channel)
+        if scheduled is None or deadline < scheduled:
+            # the old entry, if any, is skipped once it comes up
+            self._scheduled[channel] = deadline
+            heapq.heappush(self._heap, (deadline, channel))
+            if self._heap[0][1] == channel:
+                self._wake.set()
+        if went_up:
+            self.transitions += 1
+            self._resolve(self._up_waiters, channel, message)
+        return went_up
+
+    def mark_down(self, channel: str, message: typing.Optional[dict] = None,
+                  now: typing.Optional[float] = None) -> bool:
+        """Forget that `channel` is live. Returns True if it was."""
+        was_live = self.is_live(channel, now)
+        # the heap entry is dropped once it comes up
+        self.deadlines.pop(channel, None)
+        if was_live:
+            self.transitions += 1
+        self._resolve(self._down_waiters, channel, message)
+        return was_live
+
+    def expire(self, now: typing.Optional[float] = None) -> typing.List[str]:
+        """Drop channels whose deadline passed, returns their names."""
+        now = time.monotonic() if now is None else now
+        expired = []
+        while self._heap and self._heap[0][0] <= now:
+            scheduled, channel = self._heap[0]
+            if self._scheduled.get(channel) != scheduled:
+                heapq.heappop(self._heap)  # superseded by an earlier entry
+                continue
+            deadline = self.deadlines.get(channel)
+            if deadline is not None and deadline > now:
+                self._scheduled[channel] = deadline
+                heapq.heapreplace(self._heap, (deadline, channel))
+                continue
+            heapq.heappop(self._heap)
+            del self._scheduled[channel]
+            if deadline is not None:
+                del self.deadlines[channel]
+                self.expirations += 1
+                expired.append(channel)
+                self._resolve(self._down_waiters, channel, None)
+        return expired
+
+    def wait_for_up(self, channel: str) -> asyncio.Future:
+        """
+        Future resolved with the pubsub message that made `channel` go live.
+
+        Already resolved (with None) if the channel is live.
+        """
+        future = asyncio.get_event_loop().create_future()
+        if self.is_live(channel):
+            future.set_result(None)
+        else:
+            self._up_waiters.setdefault(channel, []).append(future)
+        return future
+
+    def wait_for_down(self, channel: str) -> asyncio.Future:
+        """
+        Future resolved when `channel` stops being live.
+
+        The result is the stream-down message or None if pubsub went quiet about the channel. Already resolved if the
+        channel isn't live.
+        """
+        future = asyncio.get_event_loop().create_future()
+        if not self.is_live(channel):
+            future.set_result(None)
+        else:
+            self._down_waiters.setdefault(channel, []).append(future)
+        return future
+
+    async def run(self):
+        """Expire channels as their deadlines pass."""
+        while True:
+            self._wake.clear()
+            self.expire()
+            timeout = self._heap[0][0] - time.monotonic() if self._heap else None
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
@@ -0,0 +1,147 @@
+#  This is a simple utility bot
+#  Copyright (C) 2020 Mm2PL
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import bisect
+import typing
+
+import twitchirc
+
+# Actions dispatched to methods by AbstractMiddleware.on_action
+DISPATCHED_ACTIONS = ('send', 'receive', 'command', 'permission_check', 'join', 'part', 'disconnect', 'connect',
+                      'add_command', 'reconnect')
+LATENCY_BUCKETS = (0.0005, 0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, float('inf'))
+
+
+def handles_action(middleware, action: str) -> bool:
+    """
+    Check if `middleware` needs to be called for `action`.
+
+    Middleware can declare the actions they care about using a `handled_actions` attribute. Otherwise middleware
+    with an `aon_action` method or a custom `on_action` are assumed to handle everything, while those relying on
+    `AbstractMiddleware.on_action` only handle actions whose methods they override.
+    """
+    handled = getattr(middleware, 'handled_actions', None)
+    if handled is not None:
+        return action in handled
+    if hasattr(middleware, 'aon_action'):
+        return True
+    if getattr(type(middleware), 'on_action', None) is not twitchirc.AbstractMiddleware.on_action:
+        return True
+    if action not in DISPATCHED_ACTIONS:
+        return False
+    return getattr(type(middleware), action, None) is not getattr(twitchirc.AbstractMiddleware, action)
+
+
+class MiddlewareEntry(typing.NamedTuple):
+    middleware: typing.Any
+    is_async: bool
+
+
+class LatencyHistogram:
+    def __init__(self):
+        self.counts = [0] * len(LATENCY_BUCKETS)
+        self.total = 0.0
+        self.count = 0
+        self.max = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(LATENCY_BUCKETS, value)] += 1
+        self.total += value
+        self.count += 1
+        if value > self.max:
+            self.max = value
+
+
+class MiddlewareList(list):
+    """
+    List of middleware that remembers which middleware handle which action.
+
+    :py:meth:`for_action` returns two lists: middleware that have to be awaited in order, because they can cancel
+    the event or set its result, and observers. Observers are middleware that listed the action in their
+    `observed_actions` attribute, they only produce side effects and can be run concurrently after the event is
+    handled. The lists are recomputed after the list is modified.
+    """
+
+    def __init__(self, *args):
+        super().__init__(*args)
+        self._by_action: typing.Dict[str, typing.Tuple[typing.List[MiddlewareEntry],
+                                                       typing.List[MiddlewareEntry]]] = {}
+        self.latencies: typing.Dict[typing.Tuple[str, str], LatencyHistogram] = {}
+        self.latency_listeners: typing.List[typing.Callable[[str, str, float], None]] = []
+
+    def _changed(self):
+        self._by_action.clear()
+
+    def for_action(self, action: str) -> typing.Tuple[typing.List[MiddlewareEntry], typing.List[MiddlewareEntry]]:
+        entries = self._by_action.get(action)
+        if entries is None:
+            blocking = []
+            observers = []
+            for m in self:
+                if not handles_action(m, action):
+                    continue
+                entry = MiddlewareEntry(m, hasattr(m, 'aon_action'))
+                if action in getattr(m, 'observed_actions', ()):
+                    observers.append(entry)
+                else:
+                    blocking.append(entry)
+            entries = self._by_action[action] = (blocking, observers)
+        return entries
+
+    def record_latency(self, middleware, action: str, value: float):
+        name = middleware.__class__.__name__
+        histogram = self.latencies.get((name, action))
+        if histogram is None:
+            histogram = self.latencies[(name, action)] = LatencyHistogram()
+        histogram.observe(value)
+        for listener in self.latency_listeners:
+            listener(name, action, value)
+
+    def append(self, item):
+        super().append(item)
+        self._changed()
+
+    def extend(self, items):
+        super().extend(items)
+        self._changed()
+
+    def insert(self, index, item):
+        super().insert(index, item)
+        self._changed()
+
+    def remove(self, item):
+        super().remove(item)
+        self._changed()
+
+    def pop(self, index=-1):
+        item = super().pop(index)
+        self._changed()
+        return item
+
+    def clear(self):
+        super().clear()
+        self._changed()
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self._changed()
+
+    def __delitem__(self, key):
+        super().__delitem__(key)
+        self._changed()
+
+    def __iadd__(self, other):
+        self.extend(other)
+        return self
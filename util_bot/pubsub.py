@@ -14,8 +14,6 @@
 #  You should have received a copy of the GNU General Public License
 #  along with this program.  If not, see <https://www.gnu.org/licenses/>.
 import asyncio
-import time
-from typing import Dict
 import typing
 
 import twitchirc
@@ -23,12 +21,9 @@ from twitchirc import Event
 
 from apis.pubsub import PubsubClient
 import util_bot
+from util_bot.live_state import LiveStateTracker, STREAM_UP_TIMEOUT, VIEW_COUNT_TIMEOUT
 
-CHANNEL_VIEW_COUNT_TIMEOUT = 60
-CHANNEL_STREAM_UP_TIMEOUT = 120
-channel_live_state: Dict[str, typing.Union[float, None]] = {
-    # 'channel': False
-}
+live_state = LiveStateTracker()
 listened_channels = set()
 
 
@@ -40,7 +35,9 @@ class PubsubMiddleware(twitchirc.AbstractMiddleware):
         pubsub.listen([
             topic
         ])
-        pubsub.register_callback(topic)(self.live_handler)
+        if self.live_handler not in pubsub.callbacks[topic]:
+            pubsub.register_callback(topic)(self.live_handler)
+        util_bot.stream_states.track(channel)
 
     def part(self, event: Event) -> None:
         channel: str = event.data['channel']
@@ -48,25 +45,15 @@ class PubsubMiddleware(twitchirc.AbstractMiddleware):
         pubsub.unlisten([
             topic
         ])
-
-    def _clean_up_cache(self):
-        now = time.monotonic()
-        to_delete = set()
-        for k, v in channel_live_state.items():
-            if v is None or v < now:
-                to_delete.add(k)
-
-        for key in to_delete:
-            del channel_live_state[key]
+        util_bot.stream_states.untrack(channel)
+        live_state.mark_down(channel)
 
     async def live_handler(self, topic: str, msg: dict):
-        self._clean_up_cache()
         channel_name = topic.replace('video-playback.', '')
-        if channel_name not in channel_live_state:
-            channel_live_state[channel_name] = time.monotonic()
+        util_bot.stream_states.handle_pubsub(channel_name, msg)
 
         if msg['type'] == 'viewcount':
-            if not channel_live_state.get(channel_name):
+            if live_state.mark_live(channel_name, VIEW_COUNT_TIMEOUT, msg):
                 await util_bot.bot.acall_middleware('stream-up', {
                     'channel_name': channel_name,
                     'message': msg,
@@ -78,23 +65,20 @@ class PubsubMiddleware(twitchirc.AbstractMiddleware):
                 'message': msg,
                 'topic': topic
             }, False)
-            channel_live_state[channel_name] = time.monotonic() + CHANNEL_VIEW_COUNT_TIMEOUT
         elif msg['type'] == 'stream-up':
-            if not channel_live_state.get(channel_name):
+            if live_state.mark_live(channel_name, STREAM_UP_TIMEOUT, msg):
                 await util_bot.bot.acall_middleware('stream-up', {
                     'channel_name': channel_name,
                     'message': msg,
                     'topic': topic
                 }, False)
-            channel_live_state[channel_name] = time.monotonic() + CHANNEL_STREAM_UP_TIMEOUT
         elif msg['type'] == 'stream-down':
-            if channel_live_state.get(channel_name):
+            if live_state.mark_down(channel_name, msg):
                 await util_bot.bot.acall_middleware('stream-down', {
                     'channel_name': channel_name,
                     'message': msg,
                     'topic': topic
                 }, False)
-            del channel_live_state[channel_name]
         else:
             await util_bot.bot.acall_middleware('unknown_pubsub_stream_event', {
                 'channel_name': channel_name,
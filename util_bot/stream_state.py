@@ -0,0 +1,191 @@
+#  This is a simple utility bot
+#  Copyright (C) 2021 Mm2PL
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import asyncio
+import dataclasses
+import datetime
+import re
+import time
+import typing
+
+import twitchirc
+
+from util_bot.helix import BATCH_SIZE
+
+POLL_INTERVAL = 60
+STALE_AFTER = 180  # seconds without pubsub events or a poll before the live status is re-checked
+TITLE_MAX_AGE = 300  # the title of a live stream can only be polled, pubsub doesn't send it
+TWITCH_LOGIN = re.compile(r'^[a-z0-9_]{1,25}$')
+
+
+def _parse_time(timestamp: str) -> datetime.datetime:
+    return datetime.datetime.strptime(timestamp, '%Y-%m-%dT%H:%M:%SZ')
+
+
+@dataclasses.dataclass
+class StreamState:
+    channel: str
+    live: bool
+    started_at: typing.Optional[datetime.datetime] = None
+    ended_at: typing.Optional[datetime.datetime] = None
+    title: typing.Optional[str] = None
+    viewers: typing.Optional[int] = None
+    checked_at: float = 0.0  # monotonic time of the last event or poll confirming `live`
+    polled_at: float = 0.0  # monotonic time of the last Helix data, `title` is as old as this
+
+    @property
+    def age(self) -> float:
+        return time.monotonic() - self.checked_at
+
+    @property
+    def stale(self) -> bool:
+        return self.age > STALE_AFTER
+
+
+class StreamStateStore:
+    """
+    In-memory state of the streams of joined channels.
+
+    Kept up to date by pubsub `video-playback` events, with a batched Helix poll as a fallback for channels pubsub
+    was quiet about and for titles. Commands read from here and only go to the API if the state is stale.
+    """
+
+    def __init__(self, helix=None, poll_interval: typing.Optional[float] = POLL_INTERVAL):
+        self.helix = helix
+        self.poll_interval = poll_interval
+        self.states: typing.Dict[str, StreamState] = {}
+        self.channels: typing.Set[str] = set()
+        self._loading: typing.Dict[str, asyncio.Future] = {}
+
+        self.hits = 0
+        self.misses = 0
+        self.polls = 0
+        self.polled_channels = 0
+        self.failed_polls = 0
+
+    def track(self, channel: str):
+        if TWITCH_LOGIN.match(channel):
+            self.channels.add(channel)
+
+    def untrack(self, channel: str):
+        self.channels.discard(channel)
+        self.states.pop(channel, None)
+
+    def get(self, channel: str) -> typing.Optional[StreamState]:
+        return self.states.get(channel)
+
+    def _state(self, channel: str, live: bool) -> StreamState:
+        state = self.states.get(channel)
+        if state is None:
+            state = self.states[channel] = StreamState(channel, live)
+        return state
+
+    def handle_pubsub(self, channel: str, msg: dict):
+        """Update the state of `channel` from a `video-playback` pubsub message."""
+        now = time.monotonic()
+        server_time = datetime.datetime.utcfromtimestamp(msg.get('server_time', time.time()))
+        if msg['type'] == 'viewcount':
+            state = self._state(channel, True)
+            if not state.live:
+                # missed the stream-up, the start time has to be polled
+                state.live = True
+                state.started_at = None
+                state.polled_at = 0.0
+            state.viewers = msg.get('viewers')
+        elif msg['type'] == 'stream-up':
+            state = self._state(channel, True)
+            state.live = True
+            state.started_at = server_time
+            state.ended_at = None
+            state.viewers = None
+        elif msg['type'] == 'stream-down':
+            state = self._state(channel, False)
+            if state.live:
+                state.ended_at = server_time
+            state.live = False
+            state.viewers = None
+        else:
+            return
+        state.checked_at = now
+
+    def _needs_poll(self, state: typing.Optional[StreamState], need_title: bool) -> bool:
+        if state is None or state.stale:
+            return True
+        if not state.live:
+            return False
+        return state.started_at is None or (need_title and time.monotonic() - state.polled_at > TITLE_MAX_AGE)
+
+    async def lookup(self, channel: str, need_title=False) -> StreamState:
+        """Return the state of `channel`, polling it first if what is known is stale or incomplete."""
+        state = self.states.get(channel)
+        if not self._needs_poll(state, need_title):
+            self.hits += 1
+            return state
+        self.misses += 1
+        future = self._loading.get(channel)
+        if future is None:
+            future = self._loading[channel] = asyncio.ensure_future(self.poll([channel]))
+            future.add_done_callback(lambda _: self._loading.pop(channel, None))
+        await asyncio.shield(future)
+        return self.states[channel]
+
+    async def poll(self, channels: typing.Collection[str]):
+        """Fetch the streams of `channels` from Helix, up to :py:data:`BATCH_SIZE` channels per request."""
+        channels = list(channels)
+        chunks = [channels[i:i + BATCH_SIZE] for i in range(0, len(channels), BATCH_SIZE)]
+        results = await asyncio.gather(*(
+            self.helix.request('get', 'streams', params=[('user_login', i) for i in chunk]) for chunk in chunks
+        ))
+        self.polls += len(chunks)
+        self.polled_channels += len(channels)
+
+        now = time.monotonic()
+        live = {stream['user_login']: stream for result in results for stream in result['data']}
+        for channel in channels:
+            stream = live.get(channel)
+            state = self._state(channel, stream is not None)
+            if stream is not None:
+                state.live = True
+                state.started_at = _parse_time(stream['started_at'])
+                state.ended_at = None
+                state.title = stream['title']
+                state.viewers = stream['viewer_count']
+            else:
+                if state.live:
+                    state.ended_at = None  # sometime since the last check, the last VOD knows better
+                state.live = False
+                state.viewers = None
+            state.checked_at = state.polled_at = now
+
+    async def run(self):
+        """Poll tracked channels whose state went stale every :py:attr:`poll_interval` seconds."""
+        while self.poll_interval:
+            await asyncio.sleep(self.poll_interval)
+            channels = [i for i in self.channels if self._needs_poll(self.states.get(i), True)]
+            if not channels or self.helix is None:
+                continue
+            try:
+                await self.poll(channels)
+            except Exception as e:
+                self.failed_polls += 1
+                twitchirc.log('warn', f'Failed to poll stream state: {e!r}')
+
+    @property
+    def stale_channels(self) -> int:
+        return sum(1 for i in self.channels if i not in self.states or self.states[i].stale)
+
+    @property
+    def max_age(self) -> float:
+        return max((self.states[i].age for i in self.channels if i in self.states), default=0.0)